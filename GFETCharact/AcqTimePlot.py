@@ -10,6 +10,8 @@ from pyqtgraph.parametertree.parameterTypes import PenParameter, SliderParameter
 from PyQt5 import Qt
 import pyqtgraph as pg
 
+from GFETCharact.DataBuffers import Buffer2D, MinMaxPyramid, Envelope
+
 
 class SelectChannels(pTypes.GroupParameter):
     def __init__(self, Channels, **kwargs):
@@ -59,6 +61,7 @@ class AcqTimePlotConfig(pTypes.GroupParameter):
     def __init__(self, SampSettings, HardConf, **kwargs):
         super(AcqTimePlotConfig, self).__init__(**kwargs)
         self.Viewtime = None
+        self.ViewtimeAC = None
         self.cDCChannels = HardConf.AInputs.GetDCChannels()
         self.cACChannels = HardConf.AInputs.GetACChannels()
 
@@ -70,8 +73,24 @@ class AcqTimePlotConfig(pTypes.GroupParameter):
                                      precision=3, )
         self.addChild(self.tView)
         self.tView.sigValueChanged.connect(self.on_tView_change)
+
+        self.tViewAC = SliderParameter(name='tViewAC',
+                                       title='AC View time [s]',
+                                       limits=[0.01, SampSettings['tBufferView']],
+                                       value=0.1,
+                                       step=0.01,
+                                       precision=3, )
+        self.addChild(self.tViewAC)
+        self.tViewAC.sigValueChanged.connect(self.on_tView_change)
         self.on_tView_change()
 
+        self.addChild({'title': 'Refresh rate [FPS]',
+                       'name': 'FPS',
+                       'type': 'int',
+                       'value': 20,
+                       'default': 20,
+                       'limits': (1, 60)})
+
         self.addChild({'title': 'Apply',
                        'type': 'action',
                        'name': 'Apply'})
@@ -122,6 +141,7 @@ class AcqTimePlotConfig(pTypes.GroupParameter):
 
     def on_tView_change(self):
         self.Viewtime = self.tView.value()
+        self.ViewtimeAC = self.tViewAC.value()
 
     def on_Apply(self):
         self.ApplyChangesReady.emit()
@@ -159,62 +179,119 @@ class PgPlotWindow(Qt.QWidget):
         self.show()
 
 
-class Buffer2D(np.ndarray):
-    def __new__(subtype, Fs, nChannels, ViewBuffer,
-                dtype=float, buffer=None, offset=0,
-                strides=None, order=None, info=None):
-        # Create the ndarray instance of our type, given the usual
-        # ndarray input arguments.  This will call the standard
-        # ndarray constructor, but return an object of our type.
-        # It also triggers a call to InfoArray.__array_finalize__
-        BufferSize = int(ViewBuffer * Fs)
-        shape = (BufferSize, nChannels)
-        obj = super(Buffer2D, subtype).__new__(subtype, shape, dtype,
-                                               buffer, offset, strides,
-                                               order)
-        # set the new 'info' attribute to the value passed
-        obj.counter = 0
-        obj.totalind = 0
-        obj.Fs = float(Fs)
-        obj.Ts = 1 / obj.Fs
-        # Finally, we must return the newly created object:
-        return obj
-
-    def __array_finalize__(self, obj):
-        # see InfoArray.__array_finalize__ for comments
-        if obj is None:
-            return
-        self.bufferind = getattr(obj, 'bufferind', None)
-
-    def AddData(self, NewData):
-        newsize = NewData.shape[0]
-        if newsize > self.shape[0]:
-            self[:, :] = NewData[:self.shape[0], :]
-        else:
-            self[0:-newsize, :] = self[newsize:, :]
-            self[-newsize:, :] = NewData
-        self.counter += newsize
-        self.totalind += newsize
-
-    def IsFilled(self):
-        return self.counter >= self.shape[0]
-
-    def GetData(self, ViewTime):
-        size = int(ViewTime/self.Ts)
-        self.counter = 0
-        return self[-size:], self.GetTimes(size)
-
-    def GetTimes(self, Size):
-        stop = self.Ts * self.totalind
-        start = stop - self.Ts * Size
-        times = np.arange(start, stop, self.Ts)
-        return times[-Size:]
+class TimeView():
+    '''
+    Buffers and plots of one band (DC or AC) of AcqPlotter
+    '''
+
+    def __init__(self, Name, Channels, Fs, BufferSize):
+        self.Name = Name
+        self.Channels = list(Channels)
+        self.Buffer = Buffer2D(BufferSize=BufferSize,
+                               nChannels=len(self.Channels),
+                               Fs=Fs)
+        self.Pyramid = MinMaxPyramid(BufferSize=BufferSize,
+                                     nChannels=len(self.Channels),
+                                     Fs=Fs)
+        self.RenderedInd = None
+
+        self.Wind = PgPlotWindow()
+        self.Wind.resize(1000, 750)
+        self.Wind.setWindowTitle('{} Time Plot'.format(Name))
+        self.Curves = {}
+        self.Plots = {}
+        for chn in self.Channels:
+            p = pg.PlotItem(name=chn)
+            p.setLabel('left', '', units='A')
+            self.Curves[chn] = pg.PlotCurveItem(name=chn)
+            p.addItem(self.Curves[chn])
+            self.Plots[chn] = p
 
-    def Reset(self):
-        self.counter = 0
+    def AddData(self, Data):
+        self.Buffer.AddData(Data)
+        self.Pyramid.AddData(Data)
 
+    def UpdatePlots(self, Selected, Pens, labelStyle):
+        xlink = None
+        px = None
+        for chn, sel in Selected.items():
+            if chn not in self.Plots:
+                continue
+            p = self.Plots[chn]
+            if sel:
+                px = p
+                p.hideAxis('bottom')
+                if p.parent() is not None:
+                    continue
+                else:
+                    self.Wind.pgLayout.nextRow()
+                    self.Wind.pgLayout.addItem(p)
+                    if xlink is not None:
+                        p.setXLink(xlink)
+                    xlink = p
+                    p.setParent(self.Wind.pgLayout)
+            else:
+                if p.parent() is not None:
+                    self.Wind.pgLayout.removeItem(p)
+                    p.setParent(None)
 
-class AcqPlotter(Qt.QThread):
+        if px is not None:
+            # p.setClipToView(True)
+            px.showAxis('bottom')
+            px.setLabel('bottom', 'Time', units='s', **labelStyle)
+
+        for chn, c in self.Curves.items():
+            c.setPen(Pens[chn])
+        self.RenderedInd = None
+
+    def GetPixels(self):
+        # Width of the widest plot on screen
+        Width = [p.getViewBox().width() for p in self.Plots.values()
+                 if p.parent() is not None]
+        return max(max(Width, default=0), 100)
+
+    def Draw(self, ViewTime):
+        '''
+        Draws the last ViewTime seconds, returns False if the frame was
+        skipped
+        '''
+        if self.Buffer.totalind == self.RenderedInd:
+            return False
+        TotalInd = self.Buffer.totalind
+        Size = ViewTime * self.Buffer.Fs
+        Level = self.Pyramid.GetLevel(Size, self.GetPixels())
+        if Level is None:
+            Snap = self.Buffer.GetSnapshot(Size)
+            if Snap is not None:
+                Data, TotalInd = Snap
+                t = self.Buffer.GetTimes(Data.shape[0], TotalInd)
+        else:
+            Snap = self.Pyramid.GetSnapshot(Level, Size)
+            if Snap is not None:
+                t, Data = Envelope(*Snap)
+        if Snap is None:
+            return False
+        for i, c in enumerate(self.Curves.values()):
+            c.setData(x=t,
+                      y=Data[:, i])
+        self.RenderedInd = TotalInd
+        return True
+
+
+class AcqPlotter(Qt.QObject):
+    '''
+    Time plots of the acquired DC and AC channels, each band in its own
+    window and TimeView. The data is added by AddData and the curves are
+    redrawn by a timer in the GUI thread at the FPS of the view
+    configuration, from a snapshot of the buffers. A band is not redrawn
+    if there are no new samples and the view did not change. Long views
+    are drawn from the Pyramid level with about one min/max bin per
+    pixel, so the spikes are kept and the points per frame do not depend
+    on the view time.
+
+    ACChannels are the acquired AC channels, all the AC channels of
+    HardConf by default.
+    '''
     PSDInterpolationPoints = 100
     labelStyle = {'color': '#FFF',
                   'font-size': '7pt',
@@ -225,16 +302,16 @@ class AcqPlotter(Qt.QThread):
         self.ParWindow.show()
         self.ViewConf = self.ParWindow.ViewConfig
         self.ViewConf.ApplyChangesReady.connect(self.UpdatePlotsConfig)
+        self.ViewConf.param('tView').sigValueChanged.connect(self.on_ViewChange)
+        self.ViewConf.param('tViewAC').sigValueChanged.connect(self.on_ViewChange)
+        self.ViewConf.param('FPS').sigValueChanged.connect(self.on_FPSChange)
         self.SelDCChs = self.ViewConf.param('SelChs').param('DCSel')
         self.SelACChs = self.ViewConf.param('SelChs').param('ACSel')
 
-    def BuffersInit(self, SampSettings, HardConf):
-        self.DCBuffer = Buffer2D(Fs=SampSettings['Fs'],
-                                 nChannels=len(HardConf.AInputs.GetDCChannels()),
-                                 ViewBuffer=SampSettings['tBufferView'])
-
-    def __init__(self, SampSettings, HardConf):
+    def __init__(self, SampSettings, HardConf, ACChannels=None):
         super(AcqPlotter, self).__init__()
+        self.nFrames = 0
+        self.nSkipped = 0
         self.ChnPens = None
         self.SelDCChs = None
         self.SelACChs = None
@@ -242,81 +319,54 @@ class AcqPlotter(Qt.QThread):
         self.ParWindow = None
         self.WindowParamsInit(SampSettings, HardConf)
 
-        self.BuffersInit(SampSettings, HardConf)
-
-        # Create Plotter windows
-        self.WindDC = PgPlotWindow()
-        self.WindDC.resize(1000, 750)
-        self.WindDC.setWindowTitle('DC Time Plot')
-
-        DCChns = HardConf.AInputs.GetDCChannels()
-        self.DCCurves = {}
-        self.DCPlots = {}
-        for chn in DCChns.keys():
-            p = pg.PlotItem(name=chn)
-            p.setDownsampling(auto=True,
-                              mode='subsample',
-                              )
-            p.setLabel('left', '', units='A')
-            self.DCCurves[chn] = pg.PlotCurveItem(name=chn)
-            p.addItem(self.DCCurves[chn])
-            self.DCPlots[chn] = p
-
-        # Create Plotter windows
-        self.WindAC = PgPlotWindow()
-        self.WindAC.resize(1000, 750)
-        self.WindAC.setWindowTitle('AC Time Plot')
+        Fs = SampSettings['Fs']
+        BufferSize = int(SampSettings['tBufferView'] * Fs)
+        self.DCView = TimeView('DC', HardConf.AInputs.GetDCChannels().keys(),
+                               Fs, BufferSize)
+        if ACChannels is None:
+            ACChannels = HardConf.AInputs.GetACChannels().keys()
+        self.ACView = None
+        if len(ACChannels):
+            self.ACView = TimeView('AC', ACChannels, Fs, BufferSize)
 
-        ACChns = HardConf.AInputs.GetACChannels()
-        self.ACCurves = {}
-        for chn in ACChns.keys():
-            c = pg.PlotCurveItem(name=chn)
-            self.ACCurves[chn] = c
+        self.Timer = Qt.QTimer(self)
+        self.Timer.timeout.connect(self.on_Frame)
 
         self.UpdatePlotsConfig()
 
-    def UpdatePlotsConfig(self):
-        xlink = None
-        px = None
-        for chn, sel in self.SelDCChs.GetSelected().items():
-            p = self.DCPlots[chn]
-            if sel:
-                px = p
-                p.hideAxis('bottom')
-                if p.parent() is not None:
-                    continue
-                else:
-                    self.WindDC.pgLayout.nextRow()
-                    self.WindDC.pgLayout.addItem(p)
-                    if xlink is not None:
-                        p.setXLink(xlink)
-                    xlink = p
-                    p.setParent(self.WindDC.pgLayout)
-            else:
-                if p.parent() is not None:
-                    self.WindDC.pgLayout.removeItem(p)
-                    p.setParent(None)
+    def Start(self):
+        self.on_FPSChange()
 
-        if px is not None:
-            # p.setClipToView(True)
-            px.showAxis('bottom')
-            px.setLabel('bottom', 'Time', units='s', **self.labelStyle)
+    def Stop(self):
+        self.Timer.stop()
 
-        self.ChnPens = self.ViewConf.GetPens()
-        for chn, c in self.DCCurves.items():
-            c.setPen(self.ChnPens[chn])
-
-    def run(self):
-        while True:
-            if self.DCBuffer.counter > 10000:
-                Dat, t = self.DCBuffer.GetData(self.ViewConf.Viewtime)
-                for i, (chn, c) in enumerate(self.DCCurves.items()):
-                    c.setData(x=t,
-                              y=Dat[:, i])
-            else:
-                Qt.QThread.msleep(100)
+    def on_FPSChange(self):
+        self.Timer.start(int(1000 / self.ViewConf.param('FPS').value()))
 
-    def AddData(self, Data):
-        self.DCBuffer.AddData(Data)
+    def on_ViewChange(self):
+        # next frame is drawn even without new data
+        for View in (self.DCView, self.ACView):
+            if View is not None:
+                View.RenderedInd = None
 
+    def UpdatePlotsConfig(self):
+        self.ChnPens = self.ViewConf.GetPens()
+        self.DCView.UpdatePlots(self.SelDCChs.GetSelected(), self.ChnPens,
+                                self.labelStyle)
+        if self.ACView is not None:
+            self.ACView.UpdatePlots(self.SelACChs.GetSelected(), self.ChnPens,
+                                    self.labelStyle)
+
+    def on_Frame(self):
+        Drawn = self.DCView.Draw(self.ViewConf.Viewtime)
+        if self.ACView is not None:
+            Drawn |= self.ACView.Draw(self.ViewConf.ViewtimeAC)
+        if Drawn:
+            self.nFrames += 1
+        else:
+            self.nSkipped += 1
 
+    def AddData(self, DCData, ACData=None):
+        self.DCView.AddData(DCData)
+        if ACData is not None and self.ACView is not None:
+            self.ACView.AddData(ACData)
@@ -5,14 +5,20 @@
 """
 
 from PyQt5 import Qt
-from GFETCharact.DaqInterface import ReadAnalog, WriteAnalog
+from GFETCharact.DaqBackend import ReadAnalog, WriteAnalog, SetBoard
 from GFETCharact.AcqTimePlot import AcqPlotter
+from GFETCharact.RawFile import RawRecorder, ACSuffix
 
 
 class HardwareInterface(Qt.QThread):
+    '''
+    Continuous read of the DC channels and, with AcqAC, of the AC channels
+    with their own inputs in the same task. The blocks hold the DC columns
+    followed by the AC ones, SplitData scales them to currents.
+    '''
     NewDataReady = Qt.pyqtSignal(object)
 
-    def __init__(self, HardConf):
+    def __init__(self, HardConf, AcqAC=True):
         super(HardwareInterface, self).__init__()
         self.Ains = None
         self.Aouts = None
@@ -23,10 +29,22 @@ class HardwareInterface(Qt.QThread):
         self.cACChannels = self.HardConf.AInputs.GetACChannels()
         self.cAouts = self.HardConf.AOutputs.GetAOuts()
 
-        self.aiDC = self.cDCChannels.values()
-        self.aiAC = self.cACChannels.values()
-        self.aiChNames = self.cDCChannels.keys()
-
+        self.aiDC = list(self.cDCChannels.values())
+        self.aiChNames = list(self.cDCChannels.keys())
+        self.ACNames = []
+        self.aiAC = []
+        if AcqAC:
+            for ch, ai in self.cACChannels.items():
+                # boards with an AC/DC switch read both from the same input
+                if ai in self.aiDC:
+                    continue
+                self.ACNames.append(ch)
+                self.aiAC.append(ai)
+
+        SetBoard(Gains=self.cGains,
+                 DCChannels=self.cDCChannels,
+                 ACChannels=self.cACChannels,
+                 AOuts=self.cAouts)
         self.InitAouts()
         self.InitAins()
         self.SetBias(0, 0)
@@ -46,7 +64,22 @@ class HardwareInterface(Qt.QThread):
         self.BiasVd = Vds - Vgs
 
     def InitAins(self):
-        self.Ains = ReadAnalog(self.aiDC)
+        self.Ains = ReadAnalog(self.aiDC + self.aiAC)
+
+    def GetChannelMap(self):
+        # Raw file columns, the AC ones with the ACSuffix
+        Map = dict(self.cDCChannels)
+        for ch, ai in zip(self.ACNames, self.aiAC):
+            Map[ch + ACSuffix] = ai
+        return Map
+
+    def SplitData(self, Data):
+        nDC = len(self.aiDC)
+        DCData = (Data[:, :nDC] - self.BiasVd) / self.cGains['DCGain']
+        ACData = None
+        if len(self.aiAC):
+            ACData = Data[:, nDC:] / self.cGains['ACGain']
+        return DCData, ACData
 
     def run(self, *args, **kwargs):
         self.Ains.ReadContData(**self.SamplingSettings)
@@ -54,7 +87,14 @@ class HardwareInterface(Qt.QThread):
         loop = Qt.QEventLoop()
         loop.exec_()
 
+    def StopAcq(self):
+        self.Ains.StopRead()
+        self.quit()
+        self.wait()
+
     def NewData(self, Data):
+        # The block is released by the receiver once it has been consumed
+        Data.Retain()
         self.NewDataReady.emit(Data)
 
 
@@ -64,6 +104,8 @@ class AdquisitionCore(Qt.QObject):
     def __init__(self, SamplingConf, InfoOut=None):
         super(AdquisitionCore, self).__init__()
         self.CharPlot = None
+        self.AcqPlot = None
+        self.Recorder = None
         self.StartTime = None
         self.HardInt = None
         self.SamplingConf = SamplingConf
@@ -72,11 +114,31 @@ class AdquisitionCore(Qt.QObject):
 
     def InitPlot(self, HardConf):
         self.AcqPlot = AcqPlotter(SampSettings=self.SamplingConf.GetParams(),
-                                  HardConf=HardConf)
-
-    def StartAcquisition(self, HardConf):
-        self.HardInt = HardwareInterface(HardConf)
-        self.HardInt.SamplingSettings = self.SamplingConf.GetParams()
+                                  HardConf=HardConf,
+                                  ACChannels=self.HardInt.ACNames)
+
+    def Report(self, Text):
+        if self.InfoOut is not None:
+            self.InfoOut.setValue(Text)
+        print(Text)
+
+    def StartAcquisition(self, HardConf, FileName=None):
+        SamplingSettings = self.SamplingConf.GetParams()
+        self.HardInt = HardwareInterface(HardConf,
+                                         AcqAC=SamplingSettings['AcqAC'])
+        self.HardInt.SamplingSettings = SamplingSettings
+        self.Recorder = None
+        if FileName is not None:
+            ChannelMap = self.HardInt.GetChannelMap()
+            self.Recorder = RawRecorder(FileName,
+                                        Fs=SamplingSettings['Fs'],
+                                        ChNames=list(ChannelMap.keys()),
+                                        ChannelMap=ChannelMap,
+                                        Gains=self.HardInt.cGains,
+                                        Kinds=['DC'] * len(self.HardInt.aiDC) + ['AC'] * len(self.HardInt.aiAC),
+                                        BiasVd=self.HardInt.BiasVd)
+            self.Recorder.Start()
+            self.Report('Recording to {}'.format(FileName))
 
         self.HardInt.NewDataReady.connect(self.on_NewData)
 
@@ -84,10 +146,19 @@ class AdquisitionCore(Qt.QObject):
         self.InitPlot(HardConf=HardConf)
         self.AdcRunning = True
         self.HardInt.start()
-        self.AcqPlot.start()
+        self.AcqPlot.Start()
 
     def StopAcquisition(self):
+        self.HardInt.StopAcq()
+        self.AcqPlot.Stop()
+        if self.Recorder is not None:
+            self.Recorder.Stop()
+            self.Report(self.Recorder.GetReport())
+            self.Recorder = None
         self.AdcRunning = False
 
     def on_NewData(self, Data):
-        self.AcqPlot.AddData(Data)
+        if self.Recorder is not None:
+            self.Recorder.AddData(Data)
+        self.AcqPlot.AddData(*self.HardInt.SplitData(Data))
+        Data.Release()
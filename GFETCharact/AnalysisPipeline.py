@@ -0,0 +1,146 @@
+# -*- coding: utf-8 -*-
+"""
+Analysis of the characterization steps overlapped with the acquisition.
+
+@author: aguimera
+"""
+
+import time
+import traceback
+from concurrent.futures import ThreadPoolExecutor
+from PyQt5 import Qt
+
+
+class AnalysisPipeline(Qt.QObject):
+    '''
+    Runs the step analysis on a pool of nWorkers threads while the next
+    steps are acquired, numpy releases the GIL in the FFTs and matmuls.
+
+    Submit(Funct, Args, Merge, Stage, Tag) computes Funct(*Args) on the pool and
+    then calls Merge(Result) on the Qt thread, with Funct None the Args are
+    merged as they are. Merges are done in the order of submission, so the
+    data file sees the same sequence as in the serial mode. With nWorkers=0
+    everything runs synchronously in Submit. JobCallback(Job) gets the
+    Stage, Tag, Time and Wait of the analysis jobs as they are merged.
+
+    A job whose Funct or Merge raises is not merged, ErrorCallback(Job)
+    gets it in the merge order with Failed ('Analysis' or 'Merge') and the
+    traceback in Error.
+    '''
+    SigDone = Qt.pyqtSignal(object)
+
+    def __init__(self, nWorkers=0):
+        super(AnalysisPipeline, self).__init__()
+        self.nWorkers = int(nWorkers)
+        self.Executor = None
+        if self.nWorkers > 0:
+            self.Executor = ThreadPoolExecutor(max_workers=self.nWorkers)
+        self.nSubmitted = 0
+        self.nMerged = 0
+        self.Results = {}
+        self.DrainCallback = None
+        self.JobCallback = None
+        self.ErrorCallback = None
+        self.Timings = {}
+        self.StartTime = time.perf_counter()
+        # Emitted from the workers, queued to the Qt thread
+        self.SigDone.connect(self.on_Done)
+
+    def AddTiming(self, Stage, Time):
+        self.Timings.setdefault(Stage, []).append(Time)
+
+    @staticmethod
+    def Run(Seq, Funct, Args, Merge, Stage, Tag, tSubmit):
+        Job = {'Seq': Seq,
+               'Merge': Merge,
+               'Stage': Stage,
+               'Tag': Tag,
+               'Wait': time.perf_counter() - tSubmit,
+               'Failed': None,
+               'Error': None}
+        t0 = time.perf_counter()
+        try:
+            Job['Result'] = Args if Funct is None else Funct(*Args)
+        except Exception:
+            Job['Failed'] = 'Analysis'
+            Job['Error'] = traceback.format_exc()
+        Job['Time'] = time.perf_counter() - t0
+        return Job
+
+    def Submit(self, Funct, Args, Merge, Stage=None, Tag=None):
+        Seq = self.nSubmitted
+        self.nSubmitted += 1
+        if self.Executor is None:
+            self.on_Done(self.Run(Seq, Funct, Args, Merge, Stage, Tag,
+                                  time.perf_counter()))
+            return
+        Future = self.Executor.submit(self.Run, Seq, Funct, Args, Merge,
+                                      Stage, Tag, time.perf_counter())
+        Future.add_done_callback(lambda f: self.SigDone.emit(f.result()))
+
+    def on_Done(self, Job):
+        self.Results[Job['Seq']] = Job
+        while self.nMerged in self.Results:
+            Job = self.Results.pop(self.nMerged)
+            self.nMerged += 1
+            if Job['Stage'] is not None:
+                self.AddTiming(Job['Stage'], Job['Time'])
+                self.AddTiming('Queue', Job['Wait'])
+                if self.JobCallback is not None:
+                    self.JobCallback(Job)
+            if Job['Error'] is None:
+                t0 = time.perf_counter()
+                try:
+                    Job['Merge'](Job['Result'])
+                except Exception:
+                    Job['Failed'] = 'Merge'
+                    Job['Error'] = traceback.format_exc()
+                self.AddTiming('Merge', time.perf_counter() - t0)
+            if Job['Error'] is not None:
+                self.on_Error(Job)
+
+        if self.DrainCallback is not None and self.Pending() == 0:
+            Callback = self.DrainCallback
+            self.DrainCallback = None
+            Callback()
+
+    def on_Error(self, Job):
+        if self.ErrorCallback is not None:
+            self.ErrorCallback(Job)
+        else:
+            print('WARNING {} {} failed, not saved'.format(Job['Stage'], Job['Failed']))
+            print(Job['Error'])
+
+    def Pending(self):
+        return self.nSubmitted - self.nMerged
+
+    def Drain(self, Callback):
+        # Callback once all the submitted steps are merged
+        if self.Pending() == 0:
+            Callback()
+        else:
+            self.DrainCallback = Callback
+
+    def Shutdown(self):
+        if self.Executor is not None:
+            self.Executor.shutdown(wait=False)
+            self.Executor = None
+
+    def GetReport(self):
+        '''
+        Lines with the total and mean time of each stage. The sum of the
+        stages above the wall time is the overlap gained by the pipeline.
+        '''
+        Wall = time.perf_counter() - self.StartTime
+        Lines = ['Stage timings, workers {}, wall {:.1f} s'.format(self.nWorkers,
+                                                                  Wall)]
+        Busy = 0
+        for Stage, Times in sorted(self.Timings.items()):
+            Lines.append('  {}: n {}, total {:.2f} s, mean {:.1f} ms'.format(Stage,
+                                                                            len(Times),
+                                                                            sum(Times),
+                                                                            1e3 * sum(Times) / len(Times)))
+            if Stage != 'Queue':
+                Busy += sum(Times)
+        Lines.append('  Overlap: {:.2f} s'.format(max(Busy - Wall, 0)))
+        return Lines
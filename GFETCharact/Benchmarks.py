@@ -0,0 +1,402 @@
+# -*- coding: utf-8 -*-
+"""
+Micro benchmarks of the acquisition and processing hot paths.
+
+Run with: python -m GFETCharact.Benchmarks
+
+@author: aguimera
+"""
+
+import os
+import pickle
+import tempfile
+import threading
+import time
+import numpy as np
+
+from GFETCharact.DataBuffers import Buffer2D, MinMaxPyramid, Envelope
+from GFETCharact.StatusLog import StatusLog
+from GFETCharact.RawFile import RawRecorder, RawReader
+from GFETCharact.ParamConf.SweepSteps import BuildCharactSteps, CalcPSDKwargs
+from GFETCharact.DCStability import LinearTracker, EvalStability
+from GFETCharact.SpectralAnalysis import DemodBode
+from GFETCharact.ParamConf.BodeSignals import CalcFFTavg, CalcBodePlans
+from GFETCharact.ParamConf.BodeSignals import GenSignal, PhaseStrategies
+
+
+def TimeCall(Funct, nCalls):
+    t0 = time.perf_counter()
+    for i in range(nCalls):
+        Funct()
+    return (time.perf_counter() - t0) / nCalls
+
+
+def ShiftAddData(Buffer, NewData):
+    # Former Buffer2D.AddData, moves the whole buffer on every call
+    newsize = NewData.shape[0]
+    Buffer[0:-newsize, :] = Buffer[newsize:, :]
+    Buffer[-newsize:, :] = NewData
+
+
+def BenchBuffer2D(nChannels=16, Fs=20e3, EverySamps=1000,
+                  tViews=(1, 10, 30, 60), nCalls=20):
+    print('Buffer2D.AddData -- {} channels, Fs {} Hz, {} samples per callback'.format(nChannels, Fs, EverySamps))
+    print('{:>10} {:>16} {:>16}'.format('tView [s]', 'shift [ms]', 'ring [ms]'))
+    NewData = np.random.randn(EverySamps, nChannels)
+    for tView in tViews:
+        BufferSize = int(tView * Fs)
+        Shift = np.zeros((BufferSize, nChannels))
+        Ring = Buffer2D(BufferSize=BufferSize, nChannels=nChannels, Fs=Fs)
+        tShift = TimeCall(lambda: ShiftAddData(Shift, NewData), nCalls)
+        tRing = TimeCall(lambda: Ring.AddData(NewData), nCalls)
+        print('{:>10} {:>16.3f} {:>16.3f}'.format(tView, tShift * 1e3, tRing * 1e3))
+
+
+def IsConsistent(Data, TotalInd):
+    # The writer fills each sample with its absolute index
+    Col = Data[:, 0]
+    return Col.size == 0 or (Col[-1] == TotalInd - 1 and
+                             np.all(np.diff(Col) == 1))
+
+
+def BenchSnapshot(nChannels=16, Fs=20e3, EverySamps=200, tView=1,
+                  Margin=1, tRun=2, FPS=30):
+    '''
+    Reader frames against a writer thread at the real time rate, torn
+    frames of the unsynchronized copy (read totalind, then copy) versus
+    the seqlock snapshot. The buffer is Margin blocks longer than the view.
+    '''
+    print('Buffer2D snapshot -- {} channels, Fs {} Hz, {} samples per callback, margin {} blocks, {} FPS'.format(nChannels, Fs, EverySamps, Margin, FPS))
+    print('{:>10} {:>8} {:>8} {:>10} {:>14}'.format('Read', 'Frames', 'Torn', 'Skipped', 'frame [ms]'))
+    Block = np.ones((EverySamps, nChannels))
+    Ramp = np.arange(EverySamps)[:, None]
+    for Mode in ('Copy', 'Snapshot'):
+        Buf = Buffer2D(BufferSize=int(tView * Fs) + Margin * EverySamps,
+                       nChannels=nChannels, Fs=Fs)
+        Stop = threading.Event()
+
+        def Writer():
+            n = 0
+            while not Stop.wait(EverySamps / Fs):
+                Buf.AddData(Block * (Ramp + n))
+                n += EverySamps
+
+        Th = threading.Thread(target=Writer)
+        Th.start()
+        Frames, Torn, Skipped, tRead = 0, 0, 0, 0
+        tEnd = time.perf_counter() + tRun
+        while time.perf_counter() < tEnd:
+            t0 = time.perf_counter()
+            if Mode == 'Copy':
+                TotalInd = Buf.totalind
+                Snap = (Buf.GetOrdered(tView * Fs).copy(), TotalInd)
+            else:
+                Snap = Buf.GetSnapshot(tView * Fs)
+            tRead += time.perf_counter() - t0
+            if Snap is None:
+                Skipped += 1
+            else:
+                Frames += 1
+                Torn += not IsConsistent(*Snap)
+            time.sleep(1 / FPS)
+        Stop.set()
+        Th.join()
+        print('{:>10} {:>8} {:>8} {:>10} {:>14.3f}'.format(Mode, Frames, Torn, Skipped,
+                                                          1e3 * tRead / max(Frames + Skipped, 1)))
+
+
+def BenchPyramid(nChannels=16, Fs=20e3, EverySamps=1000, tBuffer=60,
+                 tViews=(1, 10, 60), nPixels=1000, nCalls=20):
+    '''
+    Frame preparation of the raw view, subsampled as pyqtgraph does, and
+    the min/max level. Spike tells if a single sample spike is in the
+    drawn points.
+    '''
+    print('MinMaxPyramid -- {} channels, Fs {} Hz, {} s buffer, {} px'.format(nChannels, Fs, tBuffer, nPixels))
+    BufferSize = int(tBuffer * Fs)
+    Buf = Buffer2D(BufferSize=BufferSize, nChannels=nChannels, Fs=Fs)
+    Pyr = MinMaxPyramid(BufferSize=BufferSize, nChannels=nChannels, Fs=Fs)
+    NewData = np.random.randn(EverySamps, nChannels)
+    tRaw = TimeCall(lambda: Buf.AddData(NewData), nCalls)
+    tPyr = TimeCall(lambda: Pyr.AddData(NewData), nCalls)
+    print('AddData: ring {:.3f} ms, pyramid {:.3f} ms'.format(tRaw * 1e3, tPyr * 1e3))
+    for i in range(BufferSize // EverySamps):
+        Block = np.random.randn(EverySamps, nChannels)
+        if i == BufferSize // EverySamps - 10:
+            Block[EverySamps // 2 + 1, :] = 100
+        Buf.AddData(Block)
+        Pyr.AddData(Block)
+
+    print('{:>10} {:>10} {:>12} {:>8} {:>10} {:>12} {:>8}'.format('tView [s]', 'raw pts', 'raw [ms]', 'spike',
+                                                               'level pts', 'level [ms]', 'spike'))
+    for tView in tViews:
+        Size = tView * Fs
+        Step = max(int(Size // nPixels), 1)
+
+        def Raw():
+            Data, TotalInd = Buf.GetSnapshot(Size)
+            return Data[::Step]
+
+        def Level():
+            Snap = Pyr.GetSnapshot(Pyr.GetLevel(Size, nPixels), Size)
+            return Envelope(*Snap)[1]
+
+        yRaw = Raw()
+        yLev = Level()
+        print('{:>10} {:>10} {:>12.2f} {:>8} {:>10} {:>12.2f} {:>8}'.format(tView, yRaw.shape[0],
+                                                                          1e3 * TimeCall(Raw, 5),
+                                                                          str(yRaw.max() > 50),
+                                                                          yLev.shape[0],
+                                                                          1e3 * TimeCall(Level, 5),
+                                                                          str(yLev.max() > 50)))
+
+
+def BenchRawRecorder(nChannels=16, Fs=20e3, EverySamps=1000, tRec=60):
+    '''
+    tRec seconds of blocks offered as fast as possible, AddData is the
+    cost in the acquisition callback, the rate is how many times faster
+    than real time the writer stored them
+    '''
+    print('RawRecorder -- {} channels, Fs {} Hz, {} samples per callback, {} s'.format(nChannels, Fs, EverySamps, tRec))
+    Block = np.random.randn(EverySamps, nChannels)
+    nBlocks = int(tRec * Fs / EverySamps)
+    with tempfile.TemporaryDirectory() as Dir:
+        Rec = RawRecorder(os.path.join(Dir, 'Bench.raw'), Fs,
+                          ['Ch{:02}'.format(i) for i in range(nChannels)])
+        Rec.Start()
+        t0 = time.perf_counter()
+        tAdd = 0
+        for i in range(nBlocks):
+            t1 = time.perf_counter()
+            Rec.AddData(Block)
+            tAdd += time.perf_counter() - t1
+            # paced at 10x real time, a burst would only fill the queue
+            time.sleep(max(0, t0 + (i + 1) * EverySamps / Fs / 10 - time.perf_counter()))
+        Stats = Rec.Stop()
+        tTotal = time.perf_counter() - t0
+    print('AddData {:.3f} ms, write mean {:.2f} ms, max {:.2f} ms, dropped {}, queue max {}, {:.1f}x real time'.format(1e3 * tAdd / nBlocks,
+                                                                                                                 1e3 * Stats['WriteMean'],
+                                                                                                                 1e3 * Stats['WriteMax'],
+                                                                                                                 Stats['Dropped'],
+                                                                                                                 Stats['QueueMax'],
+                                                                                                                 tRec / tTotal))
+
+
+def BenchRawReader(nChannels=16, Fs=20e3, tRec=60, tWindow=1, nCalls=20):
+    '''
+    Random windows of one channel from a tRec seconds recording, loading
+    the whole file as before versus the memory mapped reader, and the
+    chunked pass over all the data
+    '''
+    print('RawReader -- {} channels, Fs {} Hz, {} s, {} s windows'.format(nChannels, Fs, tRec, tWindow))
+    Block = np.random.randn(int(Fs), nChannels)
+    with tempfile.TemporaryDirectory() as Dir:
+        FileName = os.path.join(Dir, 'Bench.raw')
+        Rec = RawRecorder(FileName, Fs, ['Ch{:02}'.format(i) for i in range(nChannels)],
+                          Gains={'DCGain': 10e3},
+                          MaxQueue=int(tRec) + 1)
+        Rec.Start()
+        for i in range(int(tRec)):
+            Rec.AddData(Block)
+        Rec.Stop()
+
+        Rnd = np.random.RandomState(0)
+        Starts = Rnd.rand(nCalls) * (tRec - tWindow)
+
+        def Load():
+            Reader = RawReader(FileName)
+            Data = np.array(Reader.Data)
+            i = int(Starts[0] * Fs)
+            return Data[i:i + int(tWindow * Fs), 3] / 10e3
+
+        Reader = RawReader(FileName)
+        tLoad = TimeCall(Load, 3)
+        tMap = TimeCall(lambda: [Reader.GetData(t, t + tWindow, 'Ch03') for t in Starts], 1) / nCalls
+        t0 = time.perf_counter()
+        Total = 0
+        for t, Data in Reader.IterChunks(ChunkTime=10):
+            Total += Data.std(axis=0).sum()
+        tIter = time.perf_counter() - t0
+        Reader.Close()
+        del Reader
+    print('Window: load {:.1f} ms, memmap {:.3f} ms -- chunked pass {:.0f} MB/s'.format(1e3 * tLoad,
+                                                                                     1e3 * tMap,
+                                                                                     tRec * Fs * nChannels * 4 / tIter / 1e6))
+
+
+def PolyfitStabDetector(Data, Fs, MaxSlope, StabCriteria):
+    # Former StabDetector
+    r = Data.shape[0]
+    t = np.arange(0, (1/Fs)*r, (1/Fs))
+    Slope, Ids = np.polyfit(t, Data, 1)
+    return EvalStability(Slope, MaxSlope, StabCriteria), Slope, Ids
+
+
+def BenchStabDetector(nChannels=(16, 64), Fs=1000, nSamps=1000,
+                      nCalls=50):
+    print('DC stability fit -- Fs {} Hz, {} samples per callback'.format(Fs, nSamps))
+    print('{:>10} {:>16} {:>16} {:>16} {:>16}'.format('Channels', 'polyfit [ms]',
+                                                     'Block [ms]', 'Window [ms]',
+                                                     'Forgetting [ms]'))
+    for nch in nChannels:
+        Data = np.random.randn(nSamps, nch) * 1e-9 + 1e-6
+        tPoly = TimeCall(lambda: PolyfitStabDetector(Data, Fs, 1e-8,
+                                                     'All channels'), nCalls)
+        Times = []
+        for Mode in ('Block', 'Window', 'Forgetting'):
+            Tracker = LinearTracker(Fs=Fs, nChannels=nch, Mode=Mode)
+
+            def Update():
+                Tracker.AddData(Data)
+                Slope, Ids = Tracker.GetFit()
+                EvalStability(Slope, 1e-8, 'All channels')
+            Times.append(TimeCall(Update, nCalls))
+        print('{:>10} {:>16.3f} {:>16.3f} {:>16.3f} {:>16.3f}'.format(nch, tPoly * 1e3,
+                                                                      *[t * 1e3 for t in Times]))
+
+
+def LoopDemodBode(Data, nFFT, FFTInds, FFTAmps):
+    # Former on_bode_data, CalcFFTavg per channel (nAvg=-1 gives -nAvg times
+    # the mean spectrum, the timing is the same)
+    gmF = np.ones((len(FFTAmps), Data.shape[1])) * np.nan * complex(1)
+    for ic, d in enumerate(Data.transpose()):
+        g = CalcFFTavg(Data=d, nFFT=nFFT, nAvg=-1)
+        gmF[:, ic] = g[FFTInds] / FFTAmps
+    return gmF
+
+
+def BenchBodeDemod(nChannels=16, nFFT=2**19, nAvg=2, nTones=(4, 13, 37),
+                   nCalls=3):
+    print('Bode demodulation -- {} channels, nFFT {}, nAvg {}'.format(nChannels, nFFT, nAvg))
+    print('{:>10} {:>16} {:>16}'.format('Tones', 'loop [ms]', 'batched [ms]'))
+    Data = np.random.randn(nFFT * nAvg, nChannels)
+    for nt in nTones:
+        FFTInds = np.unique(np.round(np.logspace(1, np.log10(nFFT / 4), nt))).astype(int)
+        FFTAmps = np.ones(FFTInds.size)
+        tLoop = TimeCall(lambda: LoopDemodBode(Data, nFFT, FFTInds, FFTAmps), nCalls)
+        tBatch = TimeCall(lambda: DemodBode(Data, nFFT, FFTInds, FFTAmps), nCalls)
+        print('{:>10} {:>16.1f} {:>16.1f}'.format(FFTInds.size, tLoop * 1e3, tBatch * 1e3))
+
+
+def LoopGenSignal(Freqs, nFFT, Fs, Amp, FFTInds, PhOptim, nAvg=1, Seed=None,
+                  **kwargs):
+    # Former GenSignal, one cos per tone over the whole signal
+    Ts = 1/float(Fs)
+    t = np.arange(0, nFFT * nAvg * Ts, Ts)
+
+    def Synth(Phs):
+        Signal = np.zeros(t.size)
+        for f, p in zip(Freqs, Phs):
+            Signal = Signal + Amp * np.cos(f * 2 * np.pi * t + p)
+        return Signal
+
+    if PhOptim == 'Random':
+        Rnd = np.random.RandomState(Seed)
+        Tries = [Rnd.rand(len(Freqs))*2*np.pi - np.pi for i in range(10)]
+        Vpps = [np.ptp(Synth(Phs)) for Phs in Tries]
+        Phs = Tries[np.argmin(Vpps)]
+    else:
+        Phs = np.zeros(len(Freqs))
+    Signal = Synth(Phs)
+    return np.max(Signal) - np.min(Signal)
+
+
+def BenchGenSignal(nCalls=1, **BodeKwargs):
+    Kwargs = {'FreqMin': 1, 'FreqMax': 10e3, 'nFreqs': 50, 'FsHigh': 500e3,
+              'FsLow': 30e3, 'FreqSplit': 10, 'nAvg': 2, 'Amp': 1}
+    Kwargs.update(BodeKwargs)
+    print('Bode test signals -- {}'.format(Kwargs))
+    print('{:>12} {:>6} {:>12} {:>12} {:>12}'.format('Phases', 'Tones', 'loop [ms]',
+                                                     'irfft [ms]', 'Vpp/tone'))
+    for Strategy in PhaseStrategies:
+        for Plan in CalcBodePlans(PhOptim=Strategy, **Kwargs):
+            nTones = len(Plan['FFTInds'])
+            if Strategy in ('None', 'Random'):
+                tLoop = '{:.1f}'.format(TimeCall(lambda: LoopGenSignal(**Plan), nCalls) * 1e3)
+            else:
+                tLoop = '-'
+            tGen = TimeCall(lambda: GenSignal(**Plan), nCalls)
+            Vpp = GenSignal(**Plan)['Vpp']
+            print('{:>12} {:>6} {:>12} {:>12.1f} {:>12.3f}'.format(Strategy, nTones, tLoop,
+                                                                   tGen * 1e3, Vpp / nTones))
+
+
+def BenchStatusLog(nMessages=(1000, 5000, 20000)):
+    print('Status log -- time of the last 100 messages')
+    print('{:>10} {:>16} {:>16}'.format('Messages', 'prepend [ms]', 'StatusLog [ms]'))
+    Txt = '1234 - Vds 0.05 V, Vgs 0.1 V -- Settled by prediction'
+    for n in nMessages:
+        # Former Report, the whole history is copied on each message
+        st = ''
+        for i in range(n - 100):
+            st = '{} \n {}'.format(Txt, st)
+        t0 = time.perf_counter()
+        for i in range(100):
+            st = '{} \n {}'.format(Txt, st)
+        tPrepend = (time.perf_counter() - t0) / 100
+        Log = StatusLog()
+        for i in range(n - 100):
+            Log.Add(Txt)
+        tLog = TimeCall(lambda: Log.Add(Txt), 100)
+        print('{:>10} {:>16.4f} {:>16.4f}'.format(n, tPrepend * 1e3, tLog * 1e3))
+
+
+def ListSteps(Table):
+    # Former step list, one dict per step
+    return [Table.GetStep(i) for i in range(len(Table))]
+
+
+def BenchStepScheduler(nVgs=(100, 200, 1000, 2000, 5000, 10000), nVds=4):
+    # Build is the step list (former) or the table, the list run pops the
+    # prebuilt dicts and the table run builds each dict in Next() and
+    # estimates the time left as ExecuteStep does
+    print('Step scheduling -- {} Vds, PSD at every Vgs'.format(nVds))
+    print('{:>8} {:>8} {:>12} {:>12} {:>12} {:>12} {:>12} {:>12}'.format('Vgs', 'Steps',
+                                                                     'list build', 'list pop',
+                                                                     'table build', 'table run',
+                                                                     'pickle [kB]', 'table [kB]'))
+    AcqKwargs = {'TimeOut': 10, 'nSamps': 1000, 'Fs': 1000}
+    PSDKwargs = CalcPSDKwargs(Fs=30e3, nFFT=17, nAvg=4)
+    for nv in nVgs:
+        Vgs = np.linspace(0, 0.4, nv)
+        Vds = np.linspace(0.05, 0.2, nVds)
+        t0 = time.perf_counter()
+        Table = BuildCharactSteps(Vgs, Vds, list(range(nv)), AcqKwargs,
+                                  PSDKwargs=PSDKwargs)
+        tTableBuild = time.perf_counter() - t0
+        t0 = time.perf_counter()
+        Steps = ListSteps(Table)
+        tListBuild = time.perf_counter() - t0 + tTableBuild
+        t0 = time.perf_counter()
+        while len(Steps):
+            Steps.pop(0)
+        tList = time.perf_counter() - t0
+        t0 = time.perf_counter()
+        while Table.Next() is not None:
+            Table.EstimateTime()
+        tTable = time.perf_counter() - t0
+        szList = len(pickle.dumps(ListSteps(Table)))
+        szTable = len(pickle.dumps(Table))
+        print('{:>8} {:>8} {:>12.1f} {:>12.1f} {:>12.1f} {:>12.1f} {:>12.0f} {:>12.0f}'.format(nv, len(Table),
+                                                                                         tListBuild * 1e3, tList * 1e3,
+                                                                                         tTableBuild * 1e3, tTable * 1e3,
+                                                                                         szList / 1e3, szTable / 1e3))
+    print('Times in ms')
+
+
+def main():
+    BenchBuffer2D()
+    BenchSnapshot()
+    BenchSnapshot(Fs=200e3, EverySamps=20)
+    BenchPyramid()
+    BenchRawRecorder()
+    BenchRawReader()
+    BenchStabDetector()
+    BenchBodeDemod()
+    BenchGenSignal()
+    BenchStatusLog()
+    BenchStepScheduler()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,361 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Headless characterization runner.
+
+    gfetcharact run config.yaml
+    gfetcharact profile Data/Dev01     # time breakdown of a run
+
+Runs the CharacterizationMachine on a QCoreApplication event loop, without
+pyqtgraph, ParameterTree or plot windows. The configuration file is yaml
+(or json if yaml is not installed):
+
+    Backend: sim            # daqmx or sim
+    TimeScale: 10           # simulator only
+    Board: MainBoard        # key of HwConfig.Boards
+    Channels: [Ch01, Ch02]  # optional, all board channels by default
+    Gains: {DCGain: 10000}  # optional, overrides the board gains
+    FileName: Data/Dev01.pkl
+    Cycles: 1
+    Sweep:
+      Workers: 2            # analysis threads, 0 for serial steps
+      Order: Serpentine     # Forward, Serpentine, Hysteresis or MinJump
+      Refine: {Points: 4, Passes: 2}  # optional, adaptive Vgs points
+      VgsSweep: {Start: 0, Stop: 0.4, Points: 20}
+      VdsSweep: {Start: 0.05, Stop: 0.05, Points: 1}
+      Gate: false
+      DCConfig: {MaxSlope: 1.0e-8, TimeOut: 25}
+      ACIndexes: '0:20:4'
+      PSD: {Fs: 30000, nFFT: 17, nAvg: 4}
+      Bode: {FreqMin: 1, FreqMax: 10000, nFreqs: 50}
+
+The PSD and Bode sections are optional, their missing keys take the same
+defaults as the GUI. yaml reads exponents without a dot (1e-8) as text,
+the numeric values are converted by MergeConf.
+
+@author: aguimera
+"""
+
+import argparse
+import json
+import os
+import sys
+
+from PyQt5.QtCore import QCoreApplication, QTimer
+
+from GFETCharact import DaqBackend
+from GFETCharact.ParamConf import HwConfig
+from GFETCharact.ParamConf.SweepSteps import (CalcSweepVals, ParseIndexes,
+                                              CalcPSDKwargs, BuildSweepConf,
+                                              BuildCharactSteps)
+from GFETCharact.ParamConf.BodeSignals import CalcBodeSignals, GetTestSignals
+from GFETCharact.SaveData import GetFreeFileName
+from GFETCharact.StatusLog import StatusLog
+from GFETCharact.Telemetry import TelemetryFile, LoadTelemetry
+from GFETCharact.Telemetry import SummarizeTelemetry
+from GFETCharact.CracterizationCore import CharacterizationMachine
+
+DefaultSweep = {'Start': 0,
+                'Stop': 0.4,
+                'Points': 20,
+                'Step': 0.01,
+                'bPoints': True}
+
+DefaultDC = {'MaxSlope': 1e-8,
+             'StabCriteria': 'All channels',
+             'FitMode': 'Block',
+             'FitBlocks': 4,
+             'Forgetting': 0.5,
+             'Predict': False,
+             'PredTol': 1e-9,
+             'PredMinBlocks': 5,
+             'SettleRate': 50,
+             'TimeOut': 25,
+             'TimeBuffer': 1,
+             'nSamps': 1000,
+             'Fs': 1000}
+
+DefaultPSD = {'Fs': 30e3,
+              'nFFT': 17,
+              'nAvg': 4}
+
+DefaultBode = {'FreqMin': 1,
+               'FreqMax': 10e3,
+               'nFreqs': 50,
+               'Amp': 0.002,
+               'nAvg': 2,
+               'FreqSplit': 10,
+               'FsHigh': 500e3,
+               'FsLow': 30e3,
+               'PhOptim': 'None',
+               'Seed': 0}
+
+DefaultRefine = {'Points': 4,
+                 'Passes': 2,
+                 'MinStep': 1e-3}
+
+
+def ToNumber(Value, Key, Integer=False):
+    try:
+        Value = float(Value)
+    except (TypeError, ValueError):
+        raise ValueError('{}: {!r} is not a number'.format(Key, Value))
+    if Integer and Value.is_integer():
+        return int(Value)
+    return Value
+
+
+def MergeConf(Defaults, Conf, Section):
+    '''
+    Defaults updated with the Conf section, the values of numeric defaults
+    are converted to numbers, int when the default is an int and the value
+    is integral
+    '''
+    Merged = Defaults.copy()
+    for k, v in (Conf or {}).items():
+        d = Defaults.get(k)
+        if v is not None and isinstance(d, (int, float)) and not isinstance(d, bool):
+            v = ToNumber(v, '{}.{}'.format(Section, k),
+                         Integer=isinstance(d, int))
+        Merged[k] = v
+    return Merged
+
+
+def LoadConf(FileName):
+    with open(FileName, 'r') as f:
+        try:
+            import yaml
+        except ImportError:
+            return json.load(f)
+        return yaml.safe_load(f)
+
+
+class HeadlessSwitch():
+    def __init__(self, ACDCSwitch):
+        self.douts = ACDCSwitch['douts']
+        self.GateAI = ACDCSwitch['GateAI']
+        self.States = ACDCSwitch['states']
+
+
+class HeadlessBoard():
+    '''
+    Stands for HardwareConfig/BoardConfig, it provides the calls used by
+    HardwareInterface from a HwConfig.Boards entry
+    '''
+
+    def __init__(self, Board, Channels=None, Gains=None):
+        self.Board = HwConfig.Boards[Board]
+        self.cGains = dict(self.Board['Gains'])
+        if Gains is not None:
+            for k, v in Gains.items():
+                self.cGains[k] = ToNumber(v, 'Gains.{}'.format(k))
+        AInputs = self.Board['AnalogInputs']
+        if Channels is None:
+            Channels = sorted(AInputs.keys())
+        for ch in Channels:
+            if ch not in AInputs:
+                raise ValueError('Channel {} not in board {}'.format(ch, Board))
+        self.Channels = sorted(Channels)
+        if 'ACDCSwitch' in self.Board:
+            self.ACDCSwitch = HeadlessSwitch(self.Board['ACDCSwitch'])
+        else:
+            self.ACDCSwitch = None
+        self.Gains = self
+        self.AInputs = self
+        self.AOutputs = self
+
+    def param(self, Name):
+        return self
+
+    def GetGains(self):
+        return self.cGains
+
+    def GetDCChannels(self):
+        AInputs = self.Board['AnalogInputs']
+        return {ch: AInputs[ch][0] for ch in self.Channels}
+
+    def GetACChannels(self):
+        AInputs = self.Board['AnalogInputs']
+        return {ch: AInputs[ch][-1] for ch in self.Channels}
+
+    def GetAOuts(self):
+        return dict(self.Board['AnalogOutputs'])
+
+
+class HeadlessSweeps():
+    '''
+    Stands for SweepsConfig, the steps are built by the same functions
+    '''
+
+    def __init__(self, Sweep, Board):
+        VgsConf = MergeConf(DefaultSweep, Sweep.get('VgsSweep'), 'VgsSweep')
+        VdsDefault = DefaultSweep.copy()
+        VdsDefault.update({'Start': 0.05, 'Stop': 0.05, 'Points': 1})
+        VdsConf = MergeConf(VdsDefault, Sweep.get('VdsSweep'), 'VdsSweep')
+        self.VgsSw = CalcSweepVals(**VgsConf)
+        self.VdsSw = CalcSweepVals(**VdsConf)
+
+        self.Workers = int(Sweep.get('Workers', 0))
+        self.SweepOrder = Sweep.get('Order', 'Forward')
+        self.Refine = None
+        if Sweep.get('Refine') is not None:
+            self.Refine = MergeConf(DefaultRefine, Sweep['Refine'], 'Refine')
+        self.bGate = bool(Sweep.get('Gate', False))
+        if self.bGate and 'GateGain' not in Board.GetGains():
+            print('WARNING board without gate measurement')
+            self.bGate = False
+
+        self.AcqKwargs = MergeConf(DefaultDC, Sweep.get('DCConfig'), 'DCConfig')
+
+        nVgs = len(self.VgsSw)
+        self.VgsIndexes = ParseIndexes(str(Sweep.get('ACIndexes',
+                                                     '0:{}:4'.format(nVgs))),
+                                       nVgs)
+
+        self.PSDKwargs = None
+        if Sweep.get('PSD') is not None:
+            kw = MergeConf(DefaultPSD, Sweep['PSD'], 'PSD')
+            self.PSDKwargs = CalcPSDKwargs(**kw)
+
+        self.BodeKwargs = None
+        if Sweep.get('Bode') is not None:
+            if 'Vg' not in Board.GetAOuts():
+                print('WARNING board without Vg output, Bode disabled')
+            else:
+                kw = MergeConf(DefaultBode, Sweep['Bode'], 'Bode')
+                self.BodeKwargs = GetTestSignals(CalcBodeSignals(**kw))
+
+    def GetSweepConf(self):
+        return BuildSweepConf(VgsSw=self.VgsSw,
+                              VdsSw=self.VdsSw,
+                              Gate=self.bGate,
+                              VgsIndexes=self.VgsIndexes,
+                              BodeKwargs=self.BodeKwargs,
+                              PSDKwargs=self.PSDKwargs,
+                              Predict=self.AcqKwargs['Predict'],
+                              SweepOrder=self.SweepOrder,
+                              Refine=self.Refine)
+
+    def GetWorkers(self):
+        return self.Workers
+
+    def GetCharactSteps(self):
+        return BuildCharactSteps(VgsSw=self.VgsSw,
+                                 VdsSw=self.VdsSw,
+                                 VgsIndexes=self.VgsIndexes,
+                                 AcqKwargs=self.AcqKwargs,
+                                 BodeKwargs=self.BodeKwargs,
+                                 PSDKwargs=self.PSDKwargs,
+                                 bGate=self.bGate,
+                                 SweepOrder=self.SweepOrder,
+                                 Refine=self.Refine)
+
+
+def PrintStatus(Text):
+    # StatusLog listener, None is a Clear()
+    if Text is not None:
+        print(Text)
+
+
+class HeadlessRunner():
+    def __init__(self, Conf, App):
+        self.App = App
+        self.Board = HeadlessBoard(Board=Conf.get('Board',
+                                                  list(HwConfig.Boards.keys())[0]),
+                                   Channels=Conf.get('Channels'),
+                                   Gains=Conf.get('Gains'))
+        self.SweepsConf = HeadlessSweeps(Conf.get('Sweep', {}), self.Board)
+        self.FileName = Conf.get('FileName')
+        self.Cycles = int(Conf.get('Cycles', 1))
+        self.ExitCode = 0
+
+        self.InfoLog = StatusLog()
+        self.InfoLog.AddListener(PrintStatus)
+        self.Charact = CharacterizationMachine(SweepsConf=self.SweepsConf,
+                                               InfoOut=self.InfoLog,
+                                               Plot=False)
+        self.Charact.CharactFinished.connect(self.on_CharactFinished)
+
+    def Start(self):
+        FileName = self.FileName
+        if FileName is not None:
+            FileName = GetFreeFileName(FileName)
+            print('Data file {}'.format(FileName))
+        if not self.Charact.StartCharact(HardConf=self.Board,
+                                         FileName=FileName):
+            self.ExitCode = 1
+            self.App.quit()
+
+    def on_CharactFinished(self):
+        self.Cycles -= 1
+        if self.Cycles > 0:
+            QTimer.singleShot(0, self.Start)
+        else:
+            self.App.quit()
+
+
+def SetupBackend(Conf, Backend=None, TimeScale=None):
+    Backend = Backend or Conf.get('Backend')
+    if Backend is not None:
+        DaqBackend.SetBackend(Backend)
+    if DaqBackend.Backend == 'sim':
+        TimeScale = TimeScale or Conf.get('TimeScale')
+        if TimeScale is not None:
+            DaqBackend.GetBackend().SetTimeScale(float(TimeScale))
+
+
+def RunCharact(args):
+    Conf = LoadConf(args.Config)
+    SetupBackend(Conf, args.backend, args.timescale)
+    if args.output is not None:
+        Conf['FileName'] = args.output
+
+    App = QCoreApplication.instance() or QCoreApplication(sys.argv[:1])
+    Runner = HeadlessRunner(Conf, App)
+    QTimer.singleShot(0, Runner.Start)
+    App.exec_()
+    return Runner.ExitCode
+
+
+def ProfileRun(args):
+    FileName = args.Telemetry
+    if os.path.isdir(FileName):
+        FileName = os.path.join(FileName, TelemetryFile)
+    for l in SummarizeTelemetry(LoadTelemetry(FileName), nSlowest=args.slowest):
+        print(l)
+    return 0
+
+
+def GetParser():
+    parser = argparse.ArgumentParser(prog='gfetcharact',
+                                     description='GFET characterization')
+    sub = parser.add_subparsers(dest='command')
+    run = sub.add_parser('run', help='Run a characterization')
+    run.add_argument('Config', help='yaml or json configuration file')
+    run.add_argument('-o', '--output', default=None,
+                     help='Data file, overrides FileName')
+    run.add_argument('--backend', default=None,
+                     choices=DaqBackend.Backends)
+    run.add_argument('--timescale', default=None, type=float,
+                     help='Simulator time acceleration')
+    run.set_defaults(func=RunCharact)
+    prof = sub.add_parser('profile', help='Time breakdown of a run')
+    prof.add_argument('Telemetry',
+                      help='Data directory or its {} file'.format(TelemetryFile))
+    prof.add_argument('--slowest', default=5, type=int,
+                      help='Number of slowest steps listed')
+    prof.set_defaults(func=ProfileRun)
+    return parser
+
+
+def main(argv=None):
+    parser = GetParser()
+    args = parser.parse_args(argv)
+    if args.command is None:
+        parser.print_help()
+        return 2
+    return args.func(args)
+
+
+if __name__ == "__main__":
+    sys.exit(main())
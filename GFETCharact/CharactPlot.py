@@ -225,6 +225,8 @@ class PlotDC():
             c.sigClicked.connect(self.on_IdsClicked)
 
     def Refresh(self):
+        # Refined Vgs points are appended to the axis, plotted in Vgs order
+        Order = np.argsort(self.Vgs)
         for c in self.IdsCurves:
             chn = c.opts['name']
             vdi = c.opts['vdi']
@@ -234,8 +236,9 @@ class PlotDC():
             else:
                 Ids = self.DevDCVals[chn]['Ids']
                 dat = Ids[:, vdi]
-            c.setData(self.Vgs, dat,
-                      pen=self.ChViewConf['Pens'][chn])
+            c.setData(self.Vgs[Order], dat[Order],
+                      pen=self.ChViewConf['Pens'][chn],
+                      connect='finite')
         self.SetVisible()
 
     def SetVisible(self):
@@ -429,12 +432,13 @@ class PlotGM():
 
 
 class PlotLive():
+    PSDInterpolationPoints = 100
+
     def __init__(self, Plot, DevDCVals, ChViewConf):
         self.Plot = Plot
         self.ChViewConf = ChViewConf
-
-        self.Plot.setLabel('left', 'Ids', units='A')
-        self.Plot.setLabel('bottom', 'Samples')
+        self.bPSD = None
+        self.SetTimeMode()
         self.Plot.showGrid(x=True, y=True)
 
         self.Curves = []
@@ -447,7 +451,24 @@ class PlotLive():
             self.Curves.append(c)
             self.Plot.addItem(c)
 
+    def SetTimeMode(self):
+        if self.bPSD is False:
+            return
+        self.bPSD = False
+        self.Plot.setLogMode(False, False)
+        self.Plot.setLabel('left', 'Ids', units='A')
+        self.Plot.setLabel('bottom', 'Samples')
+
+    def SetPSDMode(self):
+        if self.bPSD:
+            return
+        self.bPSD = True
+        self.Plot.setLogMode(True, True)
+        self.Plot.setLabel('left', 'PSD [A**2/Hz]')
+        self.Plot.setLabel('bottom', 'Frequency [Hz]')
+
     def Refresh(self, Data):
+        self.SetTimeMode()
         x = np.arange(Data.shape[0])
         for ic, c in enumerate(self.Curves):
             if ic >= Data.shape[1]:
@@ -455,6 +476,18 @@ class PlotLive():
             else:
                 c.setData(x, Data[:, ic])
 
+    def RefreshPSD(self, ff, psd):
+        # Running Welch estimate while the PSD is acquired
+        self.SetPSDMode()
+        fLog = np.logspace(np.log10(ff[1]),
+                           np.log10(ff[-2]),
+                           self.PSDInterpolationPoints)
+        for ic, c in enumerate(self.Curves):
+            if ic >= psd.shape[1] or np.isnan(psd[1, ic]):
+                c.setData([], [])
+            else:
+                c.setData(fLog, np.interp(fLog, ff, psd[:, ic]))
+
 
 class PgPlotWindow(Qt.QWidget):
     def __init__(self):
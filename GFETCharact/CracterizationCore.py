@@ -6,12 +6,21 @@ Created on Tue Jan 25 19:52:05 2022
 @author: aguimera
 """
 
-from GFETCharact.DaqInterface import ReadAnalog, WriteAnalog, WriteDigital
+from GFETCharact.DaqBackend import ReadAnalog, WriteAnalog, WriteDigital
+from GFETCharact.DaqBackend import CheckSampling, SetBoard, AORange
 from GFETCharact.SaveData import CharactFile
-from GFETCharact.ParamConf.BodeModule import CalcFFTavg
-from GFETCharact.CharactPlot import CharactPlotter
+from GFETCharact.SpectralAnalysis import WelchAccumulator, DemodBode
+from GFETCharact.DCStability import LinearTracker, EvalStability
+from GFETCharact.DCStability import SettlingPredictor
+from GFETCharact.AnalysisPipeline import AnalysisPipeline
+from GFETCharact.Telemetry import StepTelemetry, CallbackMonitor
+from GFETCharact.Telemetry import TelemetryFile
+from GFETCharact.StatusLog import StatusLogFile
+from GFETCharact.ParamConf.SweepSteps import RefineVgs
+from functools import partial
+import os
+import time
 import numpy as np
-import scipy.signal as signal
 from PyQt5.QtCore import QTimer
 from PyQt5 import Qt
 from datetime import datetime
@@ -21,7 +30,9 @@ class HardwareInterface(Qt.QObject):
     SigReadDC = Qt.pyqtSignal(object)
     SigReadAC = Qt.pyqtSignal(object)
     SigReadGate = Qt.pyqtSignal(object)
+    SigReadPSD = Qt.pyqtSignal(object, object)
     SigDebug = Qt.pyqtSignal(object)
+    SigDebugPSD = Qt.pyqtSignal(object, object)
 
     def __init__(self, HardConf):
         super(HardwareInterface, self).__init__()
@@ -38,6 +49,11 @@ class HardwareInterface(Qt.QObject):
         self.aiAC = self.cACChannels.values()
         self.aiChNames = self.cDCChannels.keys()
 
+        self.Ains = None
+        self.AinTasks = {}
+        self.PSDAcc = None
+        self.CbMonitor = CallbackMonitor()
+        self.InitBoard()
         self.InitAouts()
         self.Init_ACDCSwitch()
 
@@ -45,6 +61,21 @@ class HardwareInterface(Qt.QObject):
         # print(self.cDCChannels)
         # print(self.cDCChannels)
 
+    def InitBoard(self):
+        # Describes the board to the backend (used by the simulator)
+        if self.HardConf.ACDCSwitch is not None:
+            GateAI = self.HardConf.ACDCSwitch.GateAI
+            States = self.HardConf.ACDCSwitch.States
+        else:
+            GateAI = None
+            States = None
+        SetBoard(Gains=self.cGains,
+                 DCChannels=self.cDCChannels,
+                 ACChannels=self.cACChannels,
+                 AOuts=self.cAouts,
+                 GateAI=GateAI,
+                 SwitchStates=States)
+
     def Init_ACDCSwitch(self):
         self.ACDCSwitch = self.HardConf.ACDCSwitch
         if self.ACDCSwitch is not None:
@@ -74,43 +105,98 @@ class HardwareInterface(Qt.QObject):
 
     def StopTestSignal(self):
         # print('End Bode Gen')
-        # self.Aouts['Vg'].StopTask()
         if 'Vg' in self.Aouts:
-            self.Aouts['Vg'].ClearTask()
-            self.Aouts['Vg'] = WriteAnalog((self.cAouts['Vg'],))
+            self.Aouts['Vg'].StopSignal()
             self.Aouts['Vg'].SetVal(0)
 
+    def GetAinTask(self, Channels, Mode):
+        # Input tasks are created once per characterization and re-timed
+        # on each ReadData/ReadContData call
+        key = (tuple(Channels), Mode)
+        if key not in self.AinTasks:
+            self.AinTasks[key] = ReadAnalog(key[0])
+        self.Ains = self.AinTasks[key]
+        return self.Ains
+
+    def ClearTasks(self):
+        for task in self.AinTasks.values():
+            task.StopRead()
+            task.ClearTask()
+        self.AinTasks = {}
+        self.Ains = None
+        for task in self.Aouts.values():
+            task.StopTask()
+            task.ClearTask()
+        self.Aouts = {}
+        if self.ACDCSwitch is not None:
+            self.ACDCSwDouts.ClearTask()
+
+    def CheckSteps(self, Steps):
+        # Validates the sampling of all steps against the device
+        # capabilities before starting
+        Checks = set()
+        for s in Steps.GetTemplates():
+            kw = s['Kwargs']
+            if s['Funct'] == 'GetIds':
+                Checks.add((kw['AcqKwargs']['Fs'], len(self.aiDC), False))
+            elif s['Funct'] == 'GetGate':
+                Checks.add((kw['AcqKwargs']['Fs'], 1, False))
+            elif s['Funct'] == 'GetPSD':
+                Checks.add((kw['Fs'], len(self.aiAC), False))
+            elif s['Funct'] == 'GetBode':
+                for sig in kw['TestSigs']:
+                    nch = 1 if sig['Sequential'] else len(self.aiAC)
+                    Checks.add((sig['Fs'], nch, False))
+                    Checks.add((sig['Fs'], 1, True))
+
+        Errors = []
+        for Fs, nChannels, Output in sorted(Checks):
+            err = CheckSampling(Fs, nChannels, Output)
+            if err is not None:
+                Errors.append(err)
+        # The bias is written to the Vs (-Vgs) and Vds outputs
+        for Name, Sweep in (('Vgs', Steps.VgsSw), ('Vds', Steps.VdsSw)):
+            VMax = np.max(np.abs(Sweep))
+            if VMax > AORange:
+                Errors.append('{} {} V exceeds the output range +-{} V'.format(Name, VMax, AORange))
+        return Errors
+
     def ReadGate(self, Fs, nSamps, **kwargs):
-        self.Ains = ReadAnalog((self.ACDCSwitch.GateAI, ))
+        self.GetAinTask((self.ACDCSwitch.GateAI, ), 'Gate')
         self.Select_ACDCSwitch('Gate')
         self.Ains.EveryNEvent = None
         self.Ains.DoneEvent = self.on_Gate_Data
+        self.CbMonitor.Start(Period=nSamps/Fs)
         self.Ains.ReadData(Fs=Fs,
                            nSamps=nSamps,
                            EverySamps=nSamps)
 
     def on_Gate_Data(self, Data):
+        self.CbMonitor.Tick()
         Ig = Data/self.cGains['GateGain']
         self.SigReadGate.emit(Ig)
         self.SigDebug.emit(Ig)
 
     def ReadDC(self, Fs, nSamps, **kwargs):
-        self.Ains = ReadAnalog(self.aiDC)
+        self.GetAinTask(self.aiDC, 'DC')
         self.Select_ACDCSwitch('DC')
-        self.Ains.EveryNEvent = self.on_DC_Data        
+        self.Ains.EveryNEvent = self.on_DC_Data
+        self.CbMonitor.Start(Period=nSamps/Fs)
         self.Ains.ReadContData(Fs=Fs,
                                EverySamps=nSamps)
 
     def on_DC_Data(self, Data):
+        self.CbMonitor.Tick()
         Ids = (Data-self.BiasVd)/self.cGains['DCGain']
         self.SigReadDC.emit(Ids)
         self.SigDebug.emit(Ids)
 
     def ReadAC(self, Fs, nSamps, EverySamps, **kwargs):
-        self.Ains = ReadAnalog(self.aiAC)
+        self.GetAinTask(self.aiAC, 'AC')
         self.Select_ACDCSwitch('AC')
         self.Ains.EveryNEvent = self.on_AC_Data_Debug
         self.Ains.DoneEvent = self.on_AC_Data
+        self.CbMonitor.Start(Period=EverySamps/Fs)
         self.Ains.ReadData(Fs=Fs,
                            nSamps=nSamps,
                            EverySamps=EverySamps)
@@ -121,7 +207,35 @@ class HardwareInterface(Qt.QObject):
         self.StopTestSignal()
         self.SigReadAC.emit(Ids)
 
+    def ReadPSD(self, Fs, nFFT, nAvg, **kwargs):
+        # Each EverySamps block is one Welch segment, it is accumulated as
+        # it arrives and the full record is not buffered
+        nSamps = 2**nFFT
+        self.GetAinTask(self.aiAC, 'AC')
+        self.Select_ACDCSwitch('AC')
+        self.PSDAcc = WelchAccumulator(nPerSeg=nSamps,
+                                       Fs=Fs,
+                                       nChannels=len(self.aiAC))
+        self.Ains.EveryNEvent = self.on_PSD_Block
+        self.Ains.DoneEvent = self.on_PSD_Done
+        self.CbMonitor.Start(Period=nSamps/Fs)
+        self.Ains.ReadData(Fs=Fs,
+                           nSamps=nSamps*nAvg,
+                           EverySamps=nSamps,
+                           Buffered=False)
+
+    def on_PSD_Block(self, Data):
+        self.CbMonitor.Tick()
+        self.PSDAcc.AddData(Data)
+        ff, psd = self.PSDAcc.GetPSD()
+        self.SigDebugPSD.emit(ff, psd/self.cGains['ACGain']**2)
+
+    def on_PSD_Done(self, Data):
+        ff, psd = self.PSDAcc.GetPSD()
+        self.SigReadPSD.emit(ff, psd/self.cGains['ACGain']**2)
+
     def on_AC_Data_Debug(self, Data):
+        self.CbMonitor.Tick()
         Ids = Data/self.cGains['ACGain']
         self.SigDebug.emit(Ids)
 
@@ -132,9 +246,9 @@ class HardwareInterface(Qt.QObject):
             self.BodeSignal = Signal
             self.bData = np.zeros((Signal.size, len(self.BodeChannels)))
             self.bCount = 0
+            self.CbMonitor.Start(Period=Signal.size/Fs)
             self.ReadBodeSeq()
         else:
-            self.Ains = ReadAnalog(self.aiAC)
             self.Select_ACDCSwitch('AC')
             self.SetTestSignal(Signal)
             self.ReadAC(Fs=Fs,
@@ -144,11 +258,13 @@ class HardwareInterface(Qt.QObject):
     def ReadBodeSeq(self):
         if len(self.BodeChannels):
             ch = self.BodeChannels.pop(0)
-            self.Ains = ReadAnalog((ch, ))
+            self.GetAinTask((ch, ), 'Bode')
             self.Select_ACDCSwitch('AC')
             self.SetTestSignal(self.BodeSignal)
             self.Ains.EveryNEvent = self.on_AC_Data_Debug
             self.Ains.DoneEvent = self.on_Bode_seq_data
+            if self.bCount:
+                self.CbMonitor.NewSegment()
             self.Ains.ReadData(Fs=self.BodeFs,
                                nSamps=self.BodeSignal.size,
                                EverySamps=self.BodeSignal.size)
@@ -165,38 +281,29 @@ class HardwareInterface(Qt.QObject):
         self.ReadBodeSeq()
 
     def StopRead(self):
-        self.Ains.ClearTask()
-
-
-def StabDetector(Data, Fs, MaxSlope, StabCriteria, **kwargs):
-    r = Data.shape[0]
-    t = np.arange(0, (1/Fs)*r, (1/Fs))
-    Slope, Ids = np.polyfit(t, Data, 1)
-    # print(Slope, StabCriteria)
-    # print(np.all(MaxSlope > np.abs(Slope)))
-    # print(MaxSlope > np.min(np.abs(Slope)))
-    # print(MaxSlope > np.mean(np.abs(Slope)))
-    if StabCriteria == 'All channels':
-        Stable = np.all(MaxSlope > np.abs(Slope))
-    elif StabCriteria == 'One Channel':
-        Stable = MaxSlope > np.min(np.abs(Slope))
-    elif StabCriteria == 'Mean':
-        Stable = MaxSlope > np.mean(np.abs(Slope))
-
-    return Stable, Slope, Ids
+        self.Ains.StopRead()
 
 
 class CharacterizationMachine(Qt.QObject):
     CharactFinished = Qt.pyqtSignal()
 
-    def __init__(self, SweepsConf, InfoOut=None):
+    def __init__(self, SweepsConf, InfoOut=None, Plot=True):
         super(CharacterizationMachine, self).__init__()
-        self.GMF = None
         self.StepKwargs = None
         self.DCTimeOut = None
+        self.DCTracker = None
+        self.DCPredictor = None
+        self.PredSaved = []
         self.BodeSteps = None
+        self.BodeParts = None
+        self.Pipeline = None
+        self.FailedSteps = set()
+        self.Telemetry = None
+        self.DCBlocks = 0
+        self.StepStart = None
         self.StartTime = None
         self.Steps = None
+        self.StepIndex = None
         self.CharactFile = None
         self.HardInt = None
         self.CharPlot = None
@@ -206,100 +313,282 @@ class CharacterizationMachine(Qt.QObject):
         self.Timer.timeout.connect(self.on_TimeOut)
         self.ChactRunning = False
         self.InfoOut = InfoOut
+        self.Plot = Plot
 
     def Report(self, Text, Append=True):
+        # InfoOut is a StatusLog, Append=False starts a new view
         if self.InfoOut is not None:
             TimeStamp = datetime.now() - self.StartTime
             Txt = '{} - {}'.format(int(TimeStamp.total_seconds()),
                                    Text)
-            if Append:
-                st = '{} \n {}'.format(Txt,
-                                       self.InfoOut.value())
-            else:
-                st = Txt
-            self.InfoOut.setValue(st)
+            if not Append:
+                self.InfoOut.Clear()
+            self.InfoOut.Add(Txt)
+
+    def InitLogFile(self):
+        # The full status history is kept with the data
+        if self.InfoOut is not None and self.CharactFile.DirName is not None:
+            self.InfoOut.SetFile(os.path.join(self.CharactFile.DirName,
+                                              StatusLogFile))
 
     def InitPlot(self):
+        if not self.Plot:
+            return
+        # pyqtgraph is only loaded when plotting, not by the headless runner
+        from GFETCharact.CharactPlot import CharactPlotter
         self.CharPlot = CharactPlotter(self.CharactFile.DictDC,
                                        self.CharactFile.DictAC)
         self.HardInt.SigDebug.connect(self.on_Debug)
+        self.HardInt.SigDebugPSD.connect(self.on_DebugPSD)
 
     def on_Debug(self, Data):
-        self.CharPlot.PltLive.Refresh(Data)
+        if self.CharPlot is not None:
+            self.CharPlot.PltLive.Refresh(Data)
+
+    def on_DebugPSD(self, ff, psd):
+        if self.CharPlot is not None:
+            self.CharPlot.PltLive.RefreshPSD(ff, psd)
 
     def RefreshPlot(self):
-        self.CharPlot.RefreshPlot()
+        if self.CharPlot is not None:
+            self.CharPlot.RefreshPlot()
 
     def InitDataFile(self, FileName, SweepConf):
         self.CharactFile = CharactFile(FileName,
                                        SweepConf,
                                        self.HardInt.aiChNames)
-        self.CharactFile.SavePickle()
 
-    def SaveGate(self, Ig):
-        ivd = self.StepKwargs['SweepInds']['iVd']
-        ivg = self.StepKwargs['SweepInds']['iVg']
-        self.CharactFile.DictDC['Gate']['Ig'][ivg, ivd] = Ig
+    def SaveGate(self, Ig, SweepInds, StepIndex):
+        ivd = SweepInds['iVd']
+        ivg = SweepInds['iVg']
+        # the backward sweep of the Hysteresis order goes to IgBack
+        Sfx = 'Back' if SweepInds.get('Dir') else ''
+        self.CharactFile.DictDC['Gate']['Ig' + Sfx][ivg, ivd] = Ig
         # self.CharactFile.DictDC['Gate']['Slope'][ivg, ivd] = slo
-        self.CharactFile.SavePickle()
-
-    def SaveDC(self, Ids, Slope):
-        ivd = self.StepKwargs['SweepInds']['iVd']
-        ivg = self.StepKwargs['SweepInds']['iVg']
-        for ch, ids, slo in zip(self.HardInt.aiChNames, Ids, Slope):
-            self.CharactFile.DictDC[ch]['Ids'][ivg, ivd] = ids
-            self.CharactFile.DictDC[ch]['Slope'][ivg, ivd] = slo
-        self.CharactFile.SavePickle()
-
-    def SavePSD(self, ff, PSD):
-        ivd = self.StepKwargs['iVd']
-        iVgac = self.StepKwargs['iVgac']
+        self.CharactFile.Flush(('DC', 'Gate', 'Ig' + Sfx),
+                               Step=StepIndex)
+
+    def SaveDC(self, Fit, SweepInds, StepIndex):
+        Ids, Slope, IdsPred = Fit
+        ivd = SweepInds['iVd']
+        ivg = SweepInds['iVg']
+        Sfx = 'Back' if SweepInds.get('Dir') else ''
+        Paths = []
+        for ich, (ch, ids, slo) in enumerate(zip(self.HardInt.aiChNames, Ids, Slope)):
+            self.CharactFile.DictDC[ch]['Ids' + Sfx][ivg, ivd] = ids
+            self.CharactFile.DictDC[ch]['Slope' + Sfx][ivg, ivd] = slo
+            Paths.extend((('DC', ch, 'Ids' + Sfx), ('DC', ch, 'Slope' + Sfx)))
+            if IdsPred is not None and 'IdsPred' + Sfx in self.CharactFile.DictDC[ch]:
+                self.CharactFile.DictDC[ch]['IdsPred' + Sfx][ivg, ivd] = IdsPred[ich]
+                Paths.append(('DC', ch, 'IdsPred' + Sfx))
+        self.CharactFile.Flush(*Paths,
+                               Step=StepIndex)
+
+    def SavePSD(self, Spectrum, iVd, iVgac, StepIndex):
+        ff, PSD = Spectrum
+        Paths = []
         for ch, p in zip(self.HardInt.aiChNames, PSD.transpose()):
-            self.CharactFile.DictAC[ch]['PSD']['Vd{}'.format(ivd)][iVgac, :] = p
+            self.CharactFile.DictAC[ch]['PSD']['Vd{}'.format(iVd)][iVgac, :] = p
             if not np.all(self.CharactFile.DictAC[ch]['Fpsd'] == ff):
                 print('WARNING BAD frequency vector')
-        self.CharactFile.SavePickle()
-
-    def SaveBode(self):
-        ivd = self.StepKwargs['iVd']
-        iVgac = self.StepKwargs['iVgac']
-        for ch, p in zip(self.HardInt.aiChNames, self.GMF.transpose()):
-            self.CharactFile.DictAC[ch]['gm']['Vd{}'.format(ivd)][iVgac, :] = p
+            Paths.append(('AC', ch, 'PSD', 'Vd{}'.format(iVd)))
+        self.CharactFile.Flush(*Paths,
+                               Step=StepIndex)
+
+    def SaveBode(self, Parts, iVd, iVgac, StepIndex):
+        GMF = np.vstack(Parts)
+        Paths = []
+        for ch, p in zip(self.HardInt.aiChNames, GMF.transpose()):
+            self.CharactFile.DictAC[ch]['gm']['Vd{}'.format(iVd)][iVgac, :] = p
             # if not np.all(self.CharactFile.DictAC[ch]['Fpsd'] == ff):
             #     print('WARNING BAD frequency vector')
-        self.CharactFile.SavePickle()
+            Paths.append(('AC', ch, 'gm', 'Vd{}'.format(iVd)))
+        self.CharactFile.Flush(*Paths,
+                               Step=StepIndex)
+
+    def MergeStep(self, Save, Result, **kwargs):
+        # Runs on the Qt thread in step order (AnalysisPipeline)
+        if kwargs['StepIndex'] in self.FailedSteps:
+            # A part of its analysis failed, the step is left pending and it
+            # is repeated on resume
+            self.Telemetry.EndStep(kwargs['StepIndex'], Complete=False)
+            return
+        t0 = time.perf_counter()
+        Save(Result, **kwargs)
+        self.Steps.SetDone(kwargs['StepIndex'])
+        t1 = time.perf_counter()
+        self.RefreshPlot()
+        self.Telemetry.EndStep(kwargs['StepIndex'],
+                               Save=t1 - t0,
+                               Plot=time.perf_counter() - t1)
+
+    def StartPipeline(self):
+        self.Pipeline = AnalysisPipeline(nWorkers=self.SweepsConf.GetWorkers())
+        self.Pipeline.JobCallback = self.on_Job
+        self.Pipeline.ErrorCallback = self.on_JobError
+        self.FailedSteps = set()
+        TelFile = None
+        if self.CharactFile.DirName is not None:
+            TelFile = os.path.join(self.CharactFile.DirName, TelemetryFile)
+        self.Telemetry = StepTelemetry(TelFile)
+
+    def on_Job(self, Job):
+        self.Telemetry.AddTime(Job['Tag'], 'Analysis', Job['Time'])
+        self.Telemetry.AddTime(Job['Tag'], 'Queue', Job['Wait'])
+
+    def on_JobError(self, Job):
+        self.FailedSteps.add(Job['Tag'])
+        print(Job['Error'])
+        self.Report('Step {} {} failed, not saved: {}'.format(Job['Tag'],
+                                                              Job['Failed'].lower(),
+                                                              Job['Error'].strip().splitlines()[-1]))
+
+    def EndAcq(self, **kwargs):
+        Acq = time.perf_counter() - self.StepStart
+        self.Pipeline.AddTiming('Acq', Acq)
+        self.Telemetry.Update(self.StepIndex,
+                              Acq=Acq,
+                              Callbacks=self.HardInt.CbMonitor.GetStats(),
+                              **kwargs)
+
+    def CheckHardware(self):
+        Errors = self.HardInt.CheckSteps(self.Steps)
+        if len(Errors):
+            self.Report('Invalid sampling configuration', Append=False)
+            for err in Errors:
+                self.Report(err)
+            self.HardInt.ClearTasks()
+            return False
+        return True
 
     def StartCharact(self, HardConf, FileName=None):
         self.HardInt = HardwareInterface(HardConf)
         self.Steps = self.SweepsConf.GetCharactSteps()
         self.StartTime = datetime.now()
+        self.PredSaved = []
+
+        if not self.CheckHardware():
+            return False
 
         self.InitDataFile(FileName,
                           SweepConf=self.SweepsConf.GetSweepConf())
+        self.CharactFile.SaveSteps(self.Steps)
+        self.InitLogFile()
 
         self.InitPlot()
-        
+        self.StartPipeline()
+
         self.ChactRunning = True
-        st = 'Characterization Start -- Steps {}'.format(len(self.Steps))
+        st = 'Characterization Start -- Steps {}, {} order, estimated {:.0f} s'.format(len(self.Steps),
+                                                                                       self.Steps.SweepOrder,
+                                                                                       self.Steps.EstimateTime(nChannels=len(self.HardInt.aiAC)))
         self.Report(st, Append=False)
         self.ExecuteStep()
+        return True
+
+    def ResumeCharact(self, HardConf, FileName):
+        '''
+        Reopens the data file of an interrupted characterization and
+        continues with the steps that were not completed
+        '''
+        self.HardInt = HardwareInterface(HardConf)
+        self.StartTime = datetime.now()
+        self.PredSaved = []
+        self.CharactFile = CharactFile.Open(FileName)
+        if list(self.HardInt.aiChNames) != self.CharactFile.ChNames:
+            self.Report('Resume: channels do not match the data file',
+                        Append=False)
+            self.HardInt.ClearTasks()
+            return False
+
+        self.Steps = self.CharactFile.GetPendingSteps()
+        self.InitLogFile()
+        if not self.CheckHardware():
+            return False
+
+        self.InitPlot()
+        self.RefreshPlot()
+        self.StartPipeline()
+
+        self.ChactRunning = True
+        st = 'Characterization Resume -- Steps {} of {}'.format(self.Steps.Remaining(),
+                                                                len(self.Steps))
+        self.Report(st, Append=False)
+        self.ExecuteStep()
+        return True
 
     def StopCharact(self):
         self.ChactRunning = False
         self.Report('Stopping')
 
     def ExecuteStep(self):
-        if self.ChactRunning and len(self.Steps):
-            s = self.Steps.pop(0)
-            self.Report(s['Info'])
+        s = self.Steps.Next() if self.ChactRunning else None
+        if s is not None:
+            self.StepIndex = s['Index']
+            Left = self.Steps.EstimateTime(Durations=self.Telemetry.GetMeanTimes(),
+                                           nChannels=len(self.HardInt.aiAC))
+            self.Report('{} -- {} steps left, ~{:.0f} s'.format(s['Info'],
+                                                               self.Steps.Remaining(),
+                                                               Left))
             Funct = getattr(self, s['Funct'])
             self.StepKwargs = s['Kwargs']
+            self.StepStart = time.perf_counter()
+            self.Telemetry.BeginStep(s)
             Funct(**s['Kwargs'])
         else:
-            self.Report('Finish')
-            self.ChactRunning = False
-            self.HardInt.SetBias(0, 0)
-            self.CharactFinished.emit()
+            self.Pipeline.Drain(self.on_StepsDone)
+
+    def on_StepsDone(self):
+        if self.ChactRunning and self.RefineSweep():
+            self.ExecuteStep()
+            return
+        self.HardInt.SetBias(0, 0)
+        self.Finish()
+
+    def RefineSweep(self):
+        '''
+        Adaptive sweep, once all the steps are saved adds the Vgs points
+        chosen by RefineVgs from the measured Ids, returns False when there
+        is nothing more to refine
+        '''
+        Refine = self.Steps.Payloads.get('Refine')
+        if not Refine or self.Steps.RefinePass >= Refine['Passes']:
+            return False
+        DictDC = self.CharactFile.DictDC
+        Ids = np.stack([DictDC[ch]['Ids'] for ch in self.HardInt.aiChNames],
+                       axis=-1)
+        NewVgs = RefineVgs(self.CharactFile.GetVgsAxis(), Ids,
+                           nPoints=Refine['Points'],
+                           MinStep=Refine['MinStep'])
+        Free = self.CharactFile.AddVgs(NewVgs)
+        if Free.size == 0:
+            return False
+        self.Steps.AddRefineSteps(NewVgs[:Free.size])
+        self.CharactFile.UpdateSteps(self.Steps)
+        self.Report('Refinement pass {}: {} Vgs points added'.format(self.Steps.RefinePass,
+                                                                     Free.size))
+        return True
+
+    def Finish(self):
+        self.Report('Finish')
+        if len(self.PredSaved):
+            self.Report('Predicted steps {} of {}, time saved {:.1f} s'.format(np.count_nonzero(self.PredSaved),
+                                                                              len(self.PredSaved),
+                                                                              sum(self.PredSaved)))
+        if len(self.FailedSteps):
+            self.Report('{} steps failed, they are repeated on resume'.format(len(self.FailedSteps)))
+        self.Report('\n'.join(self.Pipeline.GetReport()))
+        self.Pipeline.Shutdown()
+        self.Telemetry.Close()
+        if self.Telemetry.FileName is not None:
+            self.Report('Step telemetry in {}'.format(self.Telemetry.FileName))
+        if self.InfoOut is not None:
+            self.InfoOut.SetFile(None)
+        self.CharactFile.Close(Complete=not self.Steps.Remaining())
+        self.CharactFile.SavePickle()
+        self.ChactRunning = False
+        self.HardInt.ClearTasks()
+        self.CharactFinished.emit()
 
     def GetGate(self, **kwargs):
         self.HardInt.SigReadGate.connect(self.on_Gate_Data)
@@ -309,13 +598,30 @@ class CharacterizationMachine(Qt.QObject):
     def on_Gate_Data(self, Data):
         self.HardInt.StopRead()
         self.HardInt.SigReadGate.disconnect(self.on_Gate_Data)
-        self.SaveGate(np.mean(Data))
-        self.RefreshPlot()
+        self.EndAcq()
+        self.Pipeline.Submit(None, np.mean(Data),
+                             partial(self.MergeStep, self.SaveGate,
+                                     SweepInds=self.StepKwargs['SweepInds'],
+                                     StepIndex=self.StepIndex),
+                             Tag=self.StepIndex)
         self.ExecuteStep()
 
     def GetIds(self, **kwargs):
         print('Get Ids')
         self.HardInt.SetBias(**kwargs['Bias'])
+        AcqKwargs = kwargs['AcqKwargs']
+        self.DCTracker = LinearTracker(Fs=AcqKwargs['Fs'],
+                                       nChannels=len(self.HardInt.aiDC),
+                                       Mode=AcqKwargs.get('FitMode', 'Block'),
+                                       nBlocks=AcqKwargs.get('FitBlocks', 4),
+                                       Forgetting=AcqKwargs.get('Forgetting', 0.5))
+        if AcqKwargs.get('Predict', False):
+            self.DCPredictor = SettlingPredictor(nChannels=len(self.HardInt.aiDC),
+                                                 BlockTime=AcqKwargs['nSamps'] / AcqKwargs['Fs'],
+                                                 MinBlocks=AcqKwargs['PredMinBlocks'])
+        else:
+            self.DCPredictor = None
+        self.DCBlocks = 0
         self.HardInt.SigReadDC.connect(self.on_DC_data)
         self.HardInt.ReadDC(Fs=kwargs['AcqKwargs']['Fs'],
                             nSamps=kwargs['AcqKwargs']['nSamps'])
@@ -328,14 +634,35 @@ class CharacterizationMachine(Qt.QObject):
 
     def on_DC_data(self, Data):
         print('Ids Step')
-        Stable, Slope, Ids = StabDetector(Data, **self.StepKwargs['AcqKwargs'])
+        AcqKwargs = self.StepKwargs['AcqKwargs']
+        self.DCBlocks += 1
+        self.DCTracker.AddData(Data)
+        Slope, Ids = self.DCTracker.GetFit()
+        Stable = EvalStability(Slope,
+                               MaxSlope=AcqKwargs['MaxSlope'],
+                               StabCriteria=AcqKwargs['StabCriteria'])
         NextStep = False
+        EndBy = None
+        IdsPred = None
+        if self.DCPredictor is not None:
+            self.DCPredictor.AddData(Data)
+            Settled, IdsPred, tSaved = self.DCPredictor.Evaluate(PredTol=AcqKwargs['PredTol'],
+                                                                 MaxSlope=AcqKwargs['MaxSlope'],
+                                                                 TimeOut=AcqKwargs['TimeOut'],
+                                                                 StabCriteria=AcqKwargs['StabCriteria'])
+            if Settled and not Stable:
+                self.Timer.stop()
+                self.Report('Settled by prediction, saved {:.1f} s'.format(tSaved))
+                NextStep = True
+                EndBy = 'Predicted'
         if Stable:
             self.Timer.stop()
             self.Report('Stable')
             NextStep = True
-        if self.DCTimeOut:
+            EndBy = 'Stable'
+        if self.DCTimeOut and not NextStep:
             NextStep = True
+            EndBy = 'TimeOut'
             self.Report('End By TimeOut')
 
         if NextStep or not self.ChactRunning:
@@ -343,38 +670,43 @@ class CharacterizationMachine(Qt.QObject):
             self.HardInt.StopRead()
             self.HardInt.SigReadDC.disconnect(self.on_DC_data)
             if NextStep:
-                self.SaveDC(Ids, Slope)
-                self.RefreshPlot()
+                if self.DCPredictor is not None:
+                    self.PredSaved.append(tSaved if Settled and not Stable else 0.)
+                Settle = {}
+                if EndBy != 'TimeOut':
+                    Settle['Settle'] = time.perf_counter() - self.StepStart
+                self.EndAcq(nBlocks=self.DCBlocks, EndBy=EndBy, **Settle)
+                self.Pipeline.Submit(None, (Ids, Slope, IdsPred),
+                                     partial(self.MergeStep, self.SaveDC,
+                                             SweepInds=self.StepKwargs['SweepInds'],
+                                             StepIndex=self.StepIndex),
+                                     Tag=self.StepIndex)
             self.ExecuteStep()
 
     def GetPSD(self, Fs, nFFT, nAvg, **kwargs):
         print('Get PSD')
-        nSamps = 2**nFFT
-        self.HardInt.SigReadAC.connect(self.on_PSD_data)
-        self.HardInt.ReadAC(Fs=Fs,
-                            nSamps=nSamps*nAvg,
-                            EverySamps=nSamps)
+        self.HardInt.SigReadPSD.connect(self.on_PSD_data)
+        self.HardInt.ReadPSD(Fs=Fs,
+                             nFFT=nFFT,
+                             nAvg=nAvg)
 
-    def on_PSD_data(self, Data):
+    def on_PSD_data(self, ff, psd):
         print('PSD Done')
-        Fs = self.StepKwargs['Fs']
-        nFFT = self.StepKwargs['nFFT']
-        ff, psd = signal.welch(x=Data,
-                               fs=Fs,
-                               window='hanning',
-                               nperseg=2**nFFT,
-                               scaling='density',
-                               axis=0)
         self.HardInt.StopRead()
-        self.HardInt.SigReadAC.disconnect(self.on_PSD_data)
-        self.SavePSD(ff, psd)
-        self.RefreshPlot()
+        self.HardInt.SigReadPSD.disconnect(self.on_PSD_data)
+        self.EndAcq()
+        self.Pipeline.Submit(None, (ff, psd),
+                             partial(self.MergeStep, self.SavePSD,
+                                     iVd=self.StepKwargs['iVd'],
+                                     iVgac=self.StepKwargs['iVgac'],
+                                     StepIndex=self.StepIndex),
+                             Tag=self.StepIndex)
         self.ExecuteStep()
 
     def GetBode(self, **bkwargs):
         print('Get Bode')
         self.BodeSteps = bkwargs['TestSigs'].copy()
-        self.GMF = np.array([])
+        self.BodeParts = []
         self.ExecuteBodeStep()
 
     def ExecuteBodeStep(self):
@@ -387,8 +719,14 @@ class CharacterizationMachine(Qt.QObject):
         else:
             print('Bode Done')
             if self.ChactRunning:
-                self.SaveBode()
-                self.RefreshPlot()
+                # Merged after the demodulation of all its parts
+                self.EndAcq()
+                self.Pipeline.Submit(None, self.BodeParts,
+                                     partial(self.MergeStep, self.SaveBode,
+                                             iVd=self.StepKwargs['iVd'],
+                                             iVgac=self.StepKwargs['iVgac'],
+                                             StepIndex=self.StepIndex),
+                                     Tag=self.StepIndex)
             self.ExecuteStep()
 
     def on_bode_data(self, Data):
@@ -396,16 +734,9 @@ class CharacterizationMachine(Qt.QObject):
         self.HardInt.SigReadAC.disconnect(self.on_bode_data)
         print('On Bode Data')
 
-        shape = (len(self.currentBode['FFTAmps']), Data.shape[1])
-        gmF = np.ones(shape) * np.NaN * np.complex(1)
-        for ic, d in enumerate(Data.transpose()):
-            g = CalcFFTavg(Data=d,
-                           nFFT=self.currentBode['nFFT'],
-                           nAvg=-1)
-            out = g[self.currentBode['FFTInds']]
-            gmF[:, ic] = out / self.currentBode['FFTAmps']
-
-        self.GMF = np.vstack((self.GMF, gmF)) if self.GMF.size else gmF
+        self.Pipeline.Submit(partial(DemodBode, **self.currentBode), (Data, ),
+                             self.BodeParts.append, 'Bode',
+                             Tag=self.StepIndex)
         self.ExecuteBodeStep()
 
         # nSamps = 2**nFFT
@@ -0,0 +1,225 @@
+# -*- coding: utf-8 -*-
+"""
+DC stability detection by an incremental per channel linear regression
+and settling prediction of the DC steps.
+
+@author: aguimera
+"""
+
+from collections import deque
+import numpy as np
+
+StabCriterias = ('All channels', 'One Channel', 'Mean')
+FitModes = ('Block', 'Window', 'Forgetting')
+
+
+def EvalStability(Slope, MaxSlope, StabCriteria):
+    if StabCriteria == 'All channels':
+        return np.all(MaxSlope > np.abs(Slope))
+    elif StabCriteria == 'One Channel':
+        return MaxSlope > np.min(np.abs(Slope))
+    elif StabCriteria == 'Mean':
+        return MaxSlope > np.mean(np.abs(Slope))
+    raise ValueError('Unknown stability criteria {}'.format(StabCriteria))
+
+
+class LinearTracker():
+    '''
+    Least-squares line fit of each channel, Data = Ids + Slope * t, updated
+    with running sums so each AddData only costs the new samples.
+
+    Modes:
+        'Block'      -- fit of the last block only (former StabDetector)
+        'Window'     -- fit of the last nBlocks blocks
+        'Forgetting' -- sums weighted by Forgetting ** age in blocks
+
+    The time origin is moved to the start of the last block on each update,
+    so the intercept is the Ids at the start of the last block as in the
+    polyfit version and the sums do not grow with the acquisition time.
+    '''
+
+    def __init__(self, Fs, nChannels, Mode='Block', nBlocks=4,
+                 Forgetting=0.5):
+        if Mode not in FitModes:
+            raise ValueError('Unknown fit mode {}, use one of {}'.format(Mode, FitModes))
+        self.Fs = float(Fs)
+        self.nChannels = nChannels
+        self.Mode = Mode
+        self.nBlocks = max(1, int(nBlocks))
+        self.Forgetting = float(Forgetting)
+        self.Times = None
+        self.Reset()
+
+    def Reset(self):
+        # time sums (n, St, Stt) and channel sums (Sy, Sty)
+        self.S = np.zeros(3)
+        self.Sy = np.zeros(self.nChannels)
+        self.Sty = np.zeros(self.nChannels)
+        self.Blocks = deque()
+        self.Origin = 0.
+        self.nSamps = 0
+
+    def GetTimes(self, n):
+        if self.Times is None or self.Times.size != n:
+            self.Times = np.arange(n) / self.Fs
+        return self.Times
+
+    @staticmethod
+    def ShiftSums(S, Sy, Sty, dt):
+        # sums of t are moved to the origin t - dt
+        n, St, Stt = S
+        S = np.array((n, St - dt * n, Stt - 2 * dt * St + dt * dt * n))
+        return S, Sy, Sty - dt * Sy
+
+    def AddData(self, Data):
+        n = Data.shape[0]
+        t = self.GetTimes(n)
+        bS = np.array((n, t.sum(), t.dot(t)))
+        bSy = Data.sum(axis=0)
+        bSty = t.dot(Data)
+
+        tStart = self.nSamps / self.Fs
+        self.nSamps += n
+
+        if self.Mode == 'Block':
+            self.S, self.Sy, self.Sty = bS, bSy, bSty
+            self.Origin = tStart
+            return
+
+        self.S, self.Sy, self.Sty = self.ShiftSums(self.S, self.Sy, self.Sty,
+                                                   tStart - self.Origin)
+        self.Origin = tStart
+        if self.Mode == 'Forgetting':
+            self.S *= self.Forgetting
+            self.Sy = self.Sy * self.Forgetting
+            self.Sty = self.Sty * self.Forgetting
+        elif self.Mode == 'Window':
+            self.Blocks.append((tStart, bS, bSy, bSty))
+            if len(self.Blocks) > self.nBlocks:
+                tOld, oS, oSy, oSty = self.Blocks.popleft()
+                oS, oSy, oSty = self.ShiftSums(oS, oSy, oSty,
+                                               tStart - tOld)
+                self.S -= oS
+                self.Sy = self.Sy - oSy
+                self.Sty = self.Sty - oSty
+
+        self.S += bS
+        self.Sy = self.Sy + bSy
+        self.Sty = self.Sty + bSty
+
+    def GetFit(self):
+        '''
+        Returns (Slope, Ids), Ids at the start of the last block
+        '''
+        n, St, Stt = self.S
+        den = n * Stt - St * St
+        if den <= 0:
+            nan = np.full(self.nChannels, np.nan)
+            return nan, nan
+        Slope = (n * self.Sty - St * self.Sy) / den
+        Ids = (self.Sy - Slope * St) / n
+        return Slope, Ids
+
+
+def StabDetector(Data, Fs, MaxSlope, StabCriteria, **kwargs):
+    # Single block fit, same results as the former np.polyfit version
+    Tracker = LinearTracker(Fs=Fs, nChannels=Data.shape[1])
+    Tracker.AddData(Data)
+    Slope, Ids = Tracker.GetFit()
+    Stable = EvalStability(Slope, MaxSlope, StabCriteria)
+    return Stable, Slope, Ids
+
+
+class SettlingPredictor():
+    '''
+    Predicts the settled Ids of each channel from the block means of a DC
+    step, modelled as an exponential plus offset
+
+        m[k] = A + B * r ** k,  r = exp(-BlockTime / Tau)
+
+    which is fitted as the linear recursion m[k+1] = c + r * m[k], so
+    A = c / (1 - r). The standard error of A is the regression covariance
+    propagated to first order.
+    '''
+
+    def __init__(self, nChannels, BlockTime, MinBlocks=5):
+        self.nChannels = nChannels
+        self.BlockTime = float(BlockTime)
+        self.MinBlocks = max(4, int(MinBlocks))
+        self.Means = []
+
+    def AddData(self, Data):
+        self.Means.append(Data.mean(axis=0))
+
+    def GetPrediction(self):
+        '''
+        Returns (A, AStd, Tau) for each channel, NaN where the history is
+        too short or does not follow a decaying exponential
+        '''
+        nan = np.full(self.nChannels, np.nan)
+        if len(self.Means) < self.MinBlocks:
+            return nan, nan, nan
+
+        M = np.array(self.Means)
+        x = M[:-1, :]
+        y = M[1:, :]
+        n = x.shape[0]
+        xm = x.mean(axis=0)
+        ym = y.mean(axis=0)
+        dx = x - xm
+        Sxx = np.sum(dx * dx, axis=0)
+        with np.errstate(divide='ignore', invalid='ignore'):
+            r = np.sum(dx * (y - ym), axis=0) / Sxx
+            c = ym - r * xm
+            res = y - c - r * x
+            s2 = np.sum(res * res, axis=0) / (n - 2)
+            Varr = s2 / Sxx
+            Varc = s2 * (1 / n + xm * xm / Sxx)
+            Cov = -xm * s2 / Sxx
+
+            A = c / (1 - r)
+            gc = 1 / (1 - r)
+            gr = c / (1 - r) ** 2
+            AStd = np.sqrt(gc * gc * Varc + gr * gr * Varr + 2 * gc * gr * Cov)
+            Tau = -self.BlockTime / np.log(r)
+
+        Valid = (r > 0) & (r < 1) & (Sxx > 0)
+        A[~Valid] = np.nan
+        AStd[~Valid] = np.nan
+        Tau[~Valid] = np.nan
+        return A, AStd, Tau
+
+    def GetRemainingTime(self, A, Tau, MaxSlope):
+        '''
+        Time the model needs to fall below MaxSlope, |dIds/dt| =
+        |Ids - A| / Tau, from the last block
+        '''
+        Last = self.Means[-1]
+        with np.errstate(divide='ignore', invalid='ignore'):
+            t = Tau * np.log(np.abs(Last - A) / (MaxSlope * Tau))
+        return np.clip(t, 0, None)
+
+    def Evaluate(self, PredTol, MaxSlope, TimeOut, StabCriteria):
+        '''
+        Returns (Settled, A, TimeSaved). Settled when the standard error of
+        A is below PredTol following StabCriteria, TimeSaved is the model
+        time to reach MaxSlope limited by the TimeOut
+        '''
+        A, AStd, Tau = self.GetPrediction()
+        AStd = np.where(np.isnan(AStd), np.inf, AStd)
+        Settled = EvalStability(AStd, PredTol, StabCriteria)
+        if not Settled:
+            return False, A, 0.
+
+        tRem = self.GetRemainingTime(A, Tau, MaxSlope)
+        tRem = tRem[~np.isnan(tRem)]
+        if tRem.size == 0:
+            return Settled, A, 0.
+        if StabCriteria == 'All channels':
+            tRem = np.max(tRem)
+        elif StabCriteria == 'One Channel':
+            tRem = np.min(tRem)
+        else:
+            tRem = np.mean(tRem)
+        Elapsed = len(self.Means) * self.BlockTime
+        return Settled, A, float(min(tRem, max(TimeOut - Elapsed, 0)))
@@ -0,0 +1,117 @@
+# -*- coding: utf-8 -*-
+"""
+DAQ backend selection.
+
+The hardware interfaces create their tasks through ReadAnalog, WriteAnalog
+and WriteDigital of this module, which forward them to the selected
+backend:
+
+    'daqmx' -> GFETCharact.DaqInterface (PyDAQmx, NI cards)
+    'sim'   -> GFETCharact.DaqSimulator (pure numpy GFET simulator)
+
+The default backend can be set with the GFETCHARACT_BACKEND environment
+variable.
+
+@author: aguimera
+"""
+
+import os
+
+Backends = ('daqmx', 'sim')
+# Voltage range of the input and output tasks, -Range to Range
+AIRange = 5.0
+AORange = 5.0
+Backend = os.environ.get('GFETCHARACT_BACKEND', 'daqmx')
+BackendModule = None
+
+
+def SetBackend(Name):
+    global Backend, BackendModule
+    if Name not in Backends:
+        raise ValueError('Unknown DAQ backend {}, use one of {}'.format(Name, Backends))
+    Backend = Name
+    BackendModule = None
+
+
+def GetBackend():
+    # Imported on first use, the simulator does not need PyDAQmx
+    global BackendModule
+    if BackendModule is None:
+        if Backend == 'sim':
+            from GFETCharact import DaqSimulator as BackendModule
+        else:
+            from GFETCharact import DaqInterface as BackendModule
+    return BackendModule
+
+
+def ReadAnalog(*args, **kwargs):
+    return GetBackend().ReadAnalog(*args, **kwargs)
+
+
+def WriteAnalog(*args, **kwargs):
+    return GetBackend().WriteAnalog(*args, **kwargs)
+
+
+def WriteDigital(*args, **kwargs):
+    return GetBackend().WriteDigital(*args, **kwargs)
+
+
+def CheckSampling(Fs, nChannels, Output=False):
+    return GetBackend().CheckSampling(Fs, nChannels, Output)
+
+
+def SetBoard(**kwargs):
+    # Board description, only used by the simulator
+    return GetBackend().SetBoard(**kwargs)
+
+
+def CheckRange(Rngs, Range, Kind):
+    # The task range must fit in one of the device (min, max) ranges, an
+    # empty list is an unknown device and it is not checked
+    if len(Rngs) == 0:
+        return None
+    for vmin, vmax in Rngs:
+        if vmin <= -Range and vmax >= Range:
+            return None
+    return '{} range +-{} V not supported by the device, ranges {}'.format(Kind, Range,
+                                                                          [(float(a), float(b)) for a, b in Rngs])
+
+
+def CheckCapabilities(Caps, Fs, nChannels, Output=False, Range=None):
+    '''
+    Checks a sampling configuration against the device capabilities.
+    Range is the +- voltage range of the task, AIRange or AORange by
+    default. Returns None if it is valid or an error message.
+    '''
+    if Caps is None:
+        return 'DAQ device not found'
+
+    if Output:
+        err = CheckRange(Caps['AOVoltageRngs'],
+                         AORange if Range is None else Range,
+                         'Output')
+        if err is not None:
+            return err
+        MaxRate = Caps['AOMaxRate']
+        if MaxRate is not None and Fs > MaxRate:
+            return 'Output Fs {} Hz exceeds the device maximum {} Hz'.format(Fs, MaxRate)
+        return None
+
+    err = CheckRange(Caps['AIVoltageRngs'],
+                     AIRange if Range is None else Range,
+                     'Input')
+    if err is not None:
+        return err
+    if nChannels > Caps['nAIChans'] > 0:
+        return '{} input channels requested, device has {}'.format(nChannels,
+                                                                  Caps['nAIChans'])
+    if nChannels > 1:
+        # Multiplexed devices share the maximum rate between channels
+        MaxRate = Caps['AIMaxMultiChanRate']
+        if MaxRate is not None and Fs * nChannels > MaxRate:
+            return 'Fs {} Hz x {} channels exceeds the device maximum {} Hz'.format(Fs, nChannels, MaxRate)
+    else:
+        MaxRate = Caps['AIMaxSingleChanRate']
+        if MaxRate is not None and Fs > MaxRate:
+            return 'Fs {} Hz exceeds the device maximum {} Hz'.format(Fs, MaxRate)
+    return None
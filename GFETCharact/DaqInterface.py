@@ -12,69 +12,111 @@ import ctypes
 from ctypes import byref, c_int32
 import numpy as np
 
+from GFETCharact.DataBuffers import Buffer2D, ReadBlockPool
+from GFETCharact.DaqBackend import CheckCapabilities, AIRange, AORange
 
-class Buffer2D(np.ndarray):
-    def __new__(subtype, BufferSize, nChannels,
-                dtype=float, buffer=None, offset=0,
-                strides=None, order=None, info=None):
-        # Create the ndarray instance of our type, given the usual
-        # ndarray input arguments.  This will call the standard
-        # ndarray constructor, but return an object of our type.
-        # It also triggers a call to InfoArray.__array_finalize__
-        shape = (BufferSize, nChannels)
-        obj = super(Buffer2D, subtype).__new__(subtype, shape, dtype,
-                                               buffer, offset, strides,
-                                               order)
-        # set the new 'info' attribute to the value passed
-        obj.counter = 0
-        obj.totalind = 0
-        # Finally, we must return the newly created object:
-        return obj
-
-    def __array_finalize__(self, obj):
-        # see InfoArray.__array_finalize__ for comments
-        if obj is None:
-            return
-        self.bufferind = getattr(obj, 'bufferind', None)
-
-    def AddData(self, NewData):
-        newsize = NewData.shape[0]
-        if newsize > self.shape[0]:
-            self[:, :] = NewData[:self.shape[0], :]
-        else:
-            self[0:-newsize, :] = self[newsize:, :]
-            self[-newsize:, :] = NewData
-        self.counter += newsize
-        self.totalind += newsize
 
-    def IsFilled(self):
-        return self.counter >= self.shape[0]
+DevBufferSize = 4096
+DevCache = None
+
 
-    def Reset(self):
-        self.counter = 0
+def ReadDaqString(Funct, *args):
+    buff = ctypes.create_string_buffer(DevBufferSize)
+    Funct(*(args + (buff, DevBufferSize)))
+    if sys.version_info >= (3,):
+        return buff.value.decode()
+    return buff.value
+
+
+def SplitDaqList(value):
+    value = value.replace(' ', '')
+    if value == '':
+        return []
+    return value.split(',')
+
+
+def ReadDevFloat(Funct, Dev):
+    val = ctypes.c_double()
+    try:
+        Funct(Dev, byref(val))
+    except Daq.DAQError:
+        return None
+    return val.value
+
+
+def ReadDevRanges(Funct, Dev):
+    vals = np.zeros(64, dtype=np.float64)
+    try:
+        Funct(Dev, vals, vals.size)
+    except Daq.DAQError:
+        return []
+    # The ranges are returned as (min, max) pairs padded with zeros
+    Rngs = []
+    for vmin, vmax in vals.reshape((-1, 2)):
+        if vmin == 0 and vmax == 0:
+            break
+        Rngs.append((vmin, vmax))
+    return Rngs
+
+
+def ReadDevCapabilities(Dev):
+    Caps = {'AIMaxSingleChanRate': ReadDevFloat(Daq.DAQmxGetDevAIMaxSingleChanRate, Dev),
+            'AIMaxMultiChanRate': ReadDevFloat(Daq.DAQmxGetDevAIMaxMultiChanRate, Dev),
+            'AOMaxRate': ReadDevFloat(Daq.DAQmxGetDevAOMaxRate, Dev),
+            'AIVoltageRngs': ReadDevRanges(Daq.DAQmxGetDevAIVoltageRngs, Dev),
+            'AOVoltageRngs': ReadDevRanges(Daq.DAQmxGetDevAOVoltageRngs, Dev),
+            }
+    try:
+        Caps['AIChans'] = SplitDaqList(ReadDaqString(Daq.DAQmxGetDevAIPhysicalChans, Dev))
+        Caps['AOChans'] = SplitDaqList(ReadDaqString(Daq.DAQmxGetDevAOPhysicalChans, Dev))
+    except Daq.DAQError:
+        Caps['AIChans'] = []
+        Caps['AOChans'] = []
+    Caps['nAIChans'] = len(Caps['AIChans'])
+    Caps['nAOChans'] = len(Caps['AOChans'])
+    return Caps
+
+
+def GetDevices():
+    # Devices are enumerated once and cached until InvalidateDevCache
+    global DevCache
+    if DevCache is None:
+        Devices = {}
+        for dev in SplitDaqList(ReadDaqString(Daq.DAQmxGetSysDevNames)):
+            if dev.startswith('Sim'):
+                continue
+            Devices[dev] = ReadDevCapabilities(dev)
+        DevCache = Devices
+    return DevCache
+
+
+def InvalidateDevCache():
+    global DevCache
+    DevCache = None
+
+
+def GetDevCapabilities():
+    Devices = GetDevices()
+    if len(Devices) == 0:
+        return None
+    return Devices[list(Devices.keys())[-1]]
 
 
 def GetDevName():
     # Get Device Name of Daq Card
-    n = 1024
-    buff = ctypes.create_string_buffer(n)
-    Daq.DAQmxGetSysDevNames(buff, n)
-    if sys.version_info >= (3,):
-        value = buff.value.decode()
-    else:
-        value = buff.value
+    Devices = GetDevices()
+    if len(Devices) == 0:
+        print('ERRROORR dev not found ')
+        return None
+    return list(Devices.keys())[-1] + '/{}'
 
-    Dev = None
-    value = value.replace(' ', '')
-    for dev in value.split(','):
-        if dev.startswith('Sim'):
-            continue
-        Dev = dev + '/{}'
 
-    if Dev is None:
-        print('ERRROORR dev not found ', value)
+def CheckSampling(Fs, nChannels, Output=False):
+    return CheckCapabilities(GetDevCapabilities(), Fs, nChannels, Output)
+
 
-    return Dev
+def SetBoard(**kwargs):
+    pass
 
 ##############################################################################
 
@@ -92,8 +134,11 @@ class DaqTaskBase(Daq.Task):
 class ReadAnalog(DaqTaskBase):
     EveryNEvent = None
     DoneEvent = None
+    BlockPool = None
+    PoolBlocks = 8
+    EveryNRegistered = False
 
-    def __init__(self, InChans, Range=5.0, Diff=False):
+    def __init__(self, InChans, Range=AIRange, Diff=False):
         Daq.Task.__init__(self)
         self.Channels = InChans
 
@@ -113,40 +158,73 @@ class ReadAnalog(DaqTaskBase):
         # print('INIT Analog Inputs : ', self.taskHandle)
         # print(self.Channels)
 
-    def ReadData(self, Fs=1000, nSamps=10000, EverySamps=1000):
+    def ReadData(self, Fs=1000, nSamps=10000, EverySamps=1000,
+                 Buffered=True):
+        # Buffered=False only delivers the EveryN blocks, DoneEvent gets None
+        self.StopRead()
         self.Fs = Fs
         self.EverySamps = EverySamps
-        self.Data = Buffer2D(BufferSize=nSamps, nChannels=len(self.Channels))
+        if Buffered:
+            self.Data = Buffer2D(BufferSize=nSamps,
+                                 nChannels=len(self.Channels),
+                                 Fs=Fs)
+        else:
+            self.Data = None
+        self.InitBlockPool()
 
         self.CfgSampClkTiming("", Fs, Daq.DAQmx_Val_Rising,
                               Daq.DAQmx_Val_FiniteSamps, nSamps)
 
-        self.AutoRegisterEveryNSamplesEvent(Daq.DAQmx_Val_Acquired_Into_Buffer,
-                                            self.EverySamps, 0)
+        self.RegisterEveryN()
         self.StartTask()
 
     def ReadContData(self, Fs, EverySamps, **kwargs):
+        self.StopRead()
         self.Fs = Fs
         self.EverySamps = np.int32(EverySamps)
         self.Data = None
+        self.InitBlockPool()
 
         self.CfgSampClkTiming("", Fs, Daq.DAQmx_Val_Rising,
                               Daq.DAQmx_Val_ContSamps,
                               self.EverySamps)
 
         self.CfgInputBuffer(self.EverySamps*10)
-        self.AutoRegisterEveryNSamplesEvent(Daq.DAQmx_Val_Acquired_Into_Buffer,
-                                            self.EverySamps, 0)
+        self.RegisterEveryN()
 
         self.StartTask()
 
     def StopContData(self):
         self.StopTask()
 
+    def RegisterEveryN(self):
+        self.AutoRegisterEveryNSamplesEvent(Daq.DAQmx_Val_Acquired_Into_Buffer,
+                                            self.EverySamps, 0)
+        self.EveryNRegistered = True
+
+    def UnregisterEveryN(self):
+        if self.EveryNRegistered:
+            self.UnregisterEveryNSamplesEvent()
+            self.EveryNRegistered = False
+
+    def StopRead(self):
+        # Leaves the task ready to be re-timed and started again
+        self.StopTask()
+        self.UnregisterEveryN()
+
+    def InitBlockPool(self):
+        nChannels = len(self.Channels)
+        if self.BlockPool is not None:
+            if self.BlockPool.IsCompatible(self.EverySamps, nChannels):
+                return
+        self.BlockPool = ReadBlockPool(nSamps=self.EverySamps,
+                                       nChannels=nChannels,
+                                       nBlocks=self.PoolBlocks)
+
     def EveryNCallback(self):
         # print('EveryN')
         read = c_int32()
-        data = np.zeros((self.EverySamps, len(self.Channels)))
+        data = self.BlockPool.Acquire()
         self.ReadAnalogF64(self.EverySamps, 10.0,
                            Daq.DAQmx_Val_GroupByScanNumber,
                            data, data.size, byref(read), None)
@@ -154,15 +232,19 @@ class ReadAnalog(DaqTaskBase):
         if self.Data is not None:
             self.Data.AddData(data)
 
+        # EveryNEvent consumers must Retain() the block to hold it
         if self.EveryNEvent:
             self.EveryNEvent(data)
+        data.Release()
 
     def DoneCallback(self, status):
         # print('Done')
-        self.StopTask()
-        self.UnregisterEveryNSamplesEvent()
+        self.StopRead()
         if self.DoneEvent:
-            self.DoneEvent(self.Data)
+            if self.Data is None:
+                self.DoneEvent(None)
+            else:
+                self.DoneEvent(self.Data.GetOrdered())
         return 0  # The function should return an integer
 
 ##############################################################################
@@ -174,12 +256,12 @@ class WriteAnalog(DaqTaskBase):
     Class to write data to Daq card
     '''
 
-    def __init__(self, Channels):
+    def __init__(self, Channels, Range=AORange):
         Daq.Task.__init__(self)
         Dev = GetDevName()
         for Ch in Channels:
             self.CreateAOVoltageChan(Dev.format(Ch), "",
-                                     -5.0, 5.0, Daq.DAQmx_Val_Volts, None)
+                                     -Range, Range, Daq.DAQmx_Val_Volts, None)
         self.DisableStartTrig()
         self.StopTask()
         # print('INIT Analog OutPuts : ', self.taskHandle)
@@ -212,6 +294,12 @@ class WriteAnalog(DaqTaskBase):
                             Signal, byref(read), None)
         self.StartTask()
 
+    def StopSignal(self):
+        # Back to on demand timing so SetVal can be used again
+        self.StopTask()
+        self.SetSampTimingType(Daq.DAQmx_Val_OnDemand)
+        self.DisableStartTrig()
+
 
 ##############################################################################
 
@@ -0,0 +1,412 @@
+# -*- coding: utf-8 -*-
+"""
+Simulated DAQ backend.
+
+Same task API as DaqInterface (ReadAnalog, WriteAnalog, WriteDigital) on
+top of a numpy model of a GFET board:
+
+    - Ids = Vds * (Gmin + Gk * sqrt((Vgs - VDirac)**2 + dV0**2))
+    - exponential settling of Ids after each bias change
+    - 1/f + white current noise
+    - gm(f) = gm0 / (1 + j f / fc) for the Bode test signals
+
+EveryN and Done callbacks are fired from a timer thread at the configured
+Fs, scaled by Board.TimeScale to run faster than real time.
+
+@author: aguimera
+"""
+
+import threading
+import time
+import zlib
+import numpy as np
+
+from GFETCharact.DataBuffers import Buffer2D, ReadBlockPool
+from GFETCharact.DaqBackend import CheckCapabilities, AIRange, AORange
+
+SimCapabilities = {'AIMaxSingleChanRate': 2e6,
+                   'AIMaxMultiChanRate': 1e6,
+                   'AOMaxRate': 2.86e6,
+                   'AIVoltageRngs': [(-10., 10.), (-5., 5.), (-2., 2.),
+                                     (-1., 1.), (-0.5, 0.5), (-0.2, 0.2),
+                                     (-0.1, 0.1)],
+                   'AOVoltageRngs': [(-10., 10.), (-5., 5.)],
+                   'AIChans': ['ai{}'.format(i) for i in range(32)],
+                   'AOChans': ['ao{}'.format(i) for i in range(4)],
+                   'nAIChans': 32,
+                   'nAOChans': 4,
+                   }
+
+DefaultBoard = {'Gains': {'DCGain': 10e3,
+                          'ACGain': 1e6,
+                          'GateGain': 2e6},
+                'AOuts': {'Vs': 'ao1',
+                          'Vds': 'ao0',
+                          'Vg': 'ao2'},
+                }
+
+
+class GFETModel():
+    '''
+    Per channel transistor parameters, derived from the channel name so
+    that every run simulates the same devices
+    '''
+
+    def __init__(self, Name):
+        rnd = np.random.RandomState(zlib.crc32(Name.encode()))
+        self.Name = Name
+        self.VDirac = rnd.uniform(0.15, 0.35)
+        self.Gmin = rnd.uniform(1e-4, 3e-4)
+        self.Gk = rnd.uniform(1e-3, 3e-3)
+        self.dV0 = rnd.uniform(0.03, 0.08)
+        self.Tau = rnd.uniform(1., 4.)
+        self.NoiseA = rnd.uniform(1e-11, 1e-10)
+        self.NoiseWhite = 1e-24
+        self.Fc = rnd.uniform(2e3, 20e3)
+
+    def Ids(self, Vgs, Vds):
+        dV = Vgs - self.VDirac
+        return Vds * (self.Gmin + self.Gk * np.sqrt(dV**2 + self.dV0**2))
+
+    def Gm(self, Vgs, Vds):
+        dV = Vgs - self.VDirac
+        return Vds * self.Gk * dV / np.sqrt(dV**2 + self.dV0**2)
+
+    def Noise(self, nSamps, Fs, Ids):
+        # White noise shaped to Sid = NoiseA * Ids**2 / f + NoiseWhite
+        x = np.fft.rfft(np.random.randn(nSamps))
+        f = np.fft.rfftfreq(nSamps, 1 / Fs)
+        f[0] = f[1] if f.size > 1 else 1
+        Sid = self.NoiseA * Ids**2 / f + self.NoiseWhite
+        return np.fft.irfft(x * np.sqrt(Sid * Fs / 2), nSamps)
+
+
+class SimBoard():
+    TimeScale = 1.0
+
+    def __init__(self):
+        self.t0 = time.perf_counter()
+        self.Lock = threading.Lock()
+        self.AOVals = {}
+        self.AOSignals = {}
+        self.SwitchState = 'DC'
+        self.Models = {}
+        self.Transient = {}
+        self.Configure()
+
+    def Configure(self, Gains=None, DCChannels=None, ACChannels=None,
+                  AOuts=None, GateAI=None, SwitchStates=None):
+        self.Gains = dict(DefaultBoard['Gains'])
+        if Gains is not None:
+            self.Gains.update(Gains)
+        self.AOuts = dict(DefaultBoard['AOuts'])
+        if AOuts is not None:
+            self.AOuts.update(AOuts)
+        self.GateAI = GateAI
+        self.SwitchStates = SwitchStates or {}
+        # ai -> (transistor name, kind)
+        self.AiMap = {}
+        for ch, ai in (DCChannels or {}).items():
+            self.AiMap[ai] = (ch, 'DC')
+        for ch, ai in (ACChannels or {}).items():
+            if ai in self.AiMap:
+                self.AiMap[ai] = (ch, 'Switch')
+            else:
+                self.AiMap[ai] = (ch, 'AC')
+        for Name, Kind in self.AiMap.values():
+            self.GetModel(Name)
+
+    def Now(self):
+        return (time.perf_counter() - self.t0) * self.TimeScale
+
+    def GetModel(self, Name):
+        if Name not in self.Models:
+            self.Models[Name] = GFETModel(Name)
+            self.Transient[Name] = (None, 0.)
+        return self.Models[Name]
+
+    def GetBias(self):
+        Vs = self.AOVals.get(self.AOuts['Vs'], 0.)
+        Vds = self.AOVals.get(self.AOuts['Vds'], 0.)
+        return -Vs, Vds
+
+    def GetBiasVd(self):
+        Vgs, Vds = self.GetBias()
+        return Vds - Vgs
+
+    def Current(self, Name, t):
+        Model = self.GetModel(Name)
+        Iss = Model.Ids(*self.GetBias())
+        I0, tChange = self.Transient[Name]
+        if I0 is None:
+            return Iss + 0 * t
+        return Iss + (I0 - Iss) * np.exp(-(t - tChange) / Model.Tau)
+
+    def SetAO(self, Channel, Value):
+        with self.Lock:
+            if Channel in (self.AOuts['Vs'], self.AOuts['Vds']):
+                # Freeze the present currents as start of the transient
+                Now = self.Now()
+                for Name in self.Models.keys():
+                    self.Transient[Name] = (self.Current(Name, Now), Now)
+            self.AOVals[Channel] = Value
+
+    def SetAOSignal(self, Channel, Signal, Continuous=False):
+        with self.Lock:
+            if Signal is None:
+                self.AOSignals.pop(Channel, None)
+            else:
+                self.AOSignals[Channel] = (np.array(Signal).flatten(),
+                                           Continuous)
+
+    def SetSwitch(self, Signal):
+        for n, v in self.SwitchStates.items():
+            if np.array_equal(np.array(v).flatten(), np.array(Signal).flatten()):
+                self.SwitchState = n
+                return
+
+    def ChannelKind(self, ai):
+        if self.GateAI is not None and ai == self.GateAI:
+            return ai, 'Gate'
+        Name, Kind = self.AiMap.get(ai, (ai, 'DC'))
+        if Kind == 'Switch':
+            Kind = self.SwitchState if self.SwitchState in ('DC', 'AC') else 'DC'
+        return Name, Kind
+
+    def PrepareRead(self, Task):
+        # Current response of each AC channel to the Vg test signal
+        Task.Responses = {}
+        Sig = self.AOSignals.get(self.AOuts.get('Vg'), None)
+        if Sig is None:
+            return
+        Signal, Continuous = Sig
+        Vgs, Vds = self.GetBias()
+        f = np.fft.rfftfreq(Signal.size, 1 / Task.Fs)
+        Vf = np.fft.rfft(Signal)
+        for ic, ai in enumerate(Task.Channels):
+            Name, Kind = self.ChannelKind(ai)
+            if Kind != 'AC':
+                continue
+            Model = self.GetModel(Name)
+            Gm = Model.Gm(Vgs, Vds) / (1 + 1j * f / Model.Fc)
+            Task.Responses[ic] = np.fft.irfft(Vf * Gm, Signal.size)
+
+    def ReadBlock(self, Task, Data, Start):
+        nSamps = Data.shape[0]
+        t = Task.tStart + (Start + np.arange(nSamps)) / Task.Fs
+        BiasVd = self.GetBiasVd()
+        Vgs, Vds = self.GetBias()
+        with self.Lock:
+            for ic, ai in enumerate(Task.Channels):
+                Name, Kind = self.ChannelKind(ai)
+                if Kind == 'Gate':
+                    Ig = Vgs / 1e9 + 1e-12 * np.random.randn(nSamps)
+                    Data[:, ic] = Ig * self.Gains.get('GateGain', 1)
+                    continue
+                Model = self.GetModel(Name)
+                Ids = self.Current(Name, t)
+                Noise = Model.Noise(nSamps, Task.Fs, np.mean(Ids))
+                if Kind == 'DC':
+                    Data[:, ic] = BiasVd + (Ids + Noise) * self.Gains['DCGain']
+                else:
+                    Iac = Noise
+                    if ic in Task.Responses:
+                        Resp = Task.Responses[ic]
+                        inds = (Start + np.arange(nSamps)) % Resp.size
+                        Iac = Iac + Resp[inds]
+                    Data[:, ic] = Iac * self.Gains['ACGain']
+
+
+Board = SimBoard()
+
+
+def SetBoard(Gains=None, DCChannels=None, ACChannels=None, AOuts=None,
+             GateAI=None, SwitchStates=None, **kwargs):
+    Board.Configure(Gains=Gains,
+                    DCChannels=DCChannels,
+                    ACChannels=ACChannels,
+                    AOuts=AOuts,
+                    GateAI=GateAI,
+                    SwitchStates=SwitchStates)
+
+
+def SetTimeScale(TimeScale):
+    Board.TimeScale = float(TimeScale)
+
+
+def CheckSampling(Fs, nChannels, Output=False):
+    return CheckCapabilities(SimCapabilities, Fs, nChannels, Output)
+
+##############################################################################
+
+
+class SimTask():
+    Running = False
+
+    def StartTask(self):
+        self.Running = True
+
+    def StopTask(self):
+        self.Running = False
+
+    def ClearTask(self):
+        self.StopTask()
+
+
+class ReadAnalog(SimTask):
+    EveryNEvent = None
+    DoneEvent = None
+    BlockPool = None
+    PoolBlocks = 8
+
+    def __init__(self, InChans, Range=AIRange, Diff=False):
+        self.Channels = list(InChans)
+        self.Thread = None
+        self.StopEvent = threading.Event()
+        self.Data = None
+        self.Finite = False
+        self.nSamps = None
+        self.Acquired = 0
+        self.tStart = 0.
+        self.Responses = {}
+
+    def ReadData(self, Fs=1000, nSamps=10000, EverySamps=1000,
+                 Buffered=True):
+        # Buffered=False only delivers the EveryN blocks, DoneEvent gets None
+        self.StopRead()
+        self.Fs = Fs
+        self.EverySamps = EverySamps
+        if Buffered:
+            self.Data = Buffer2D(BufferSize=nSamps,
+                                 nChannels=len(self.Channels),
+                                 Fs=Fs)
+        else:
+            self.Data = None
+        self.InitBlockPool()
+        self.Finite = True
+        self.nSamps = nSamps
+        self.StartTask()
+
+    def ReadContData(self, Fs, EverySamps, **kwargs):
+        self.StopRead()
+        self.Fs = Fs
+        self.EverySamps = np.int32(EverySamps)
+        self.Data = None
+        self.InitBlockPool()
+        self.Finite = False
+        self.StartTask()
+
+    def StopContData(self):
+        self.StopTask()
+
+    def StopRead(self):
+        self.StopTask()
+
+    def InitBlockPool(self):
+        nChannels = len(self.Channels)
+        if self.BlockPool is not None:
+            if self.BlockPool.IsCompatible(self.EverySamps, nChannels):
+                return
+        self.BlockPool = ReadBlockPool(nSamps=self.EverySamps,
+                                       nChannels=nChannels,
+                                       nBlocks=self.PoolBlocks)
+
+    def StartTask(self):
+        self.StopTask()
+        self.Acquired = 0
+        self.tStart = Board.Now()
+        Board.PrepareRead(self)
+        self.Running = True
+        self.StopEvent = threading.Event()
+        self.Thread = threading.Thread(target=self.Run,
+                                       args=(self.StopEvent, ),
+                                       daemon=True)
+        self.Thread.start()
+
+    def StopTask(self):
+        self.Running = False
+        self.StopEvent.set()
+        if self.Thread is not None:
+            if self.Thread is not threading.current_thread():
+                self.Thread.join()
+            self.Thread = None
+
+    def Run(self, StopEvent):
+        Period = self.EverySamps / self.Fs
+        tNext = time.perf_counter()
+        while not StopEvent.is_set():
+            tNext += Period / Board.TimeScale
+            if StopEvent.wait(max(0, tNext - time.perf_counter())):
+                break
+            self.EveryNCallback()
+            if self.Finite and self.Acquired >= self.nSamps:
+                self.DoneCallback(0)
+                break
+
+    def EveryNCallback(self):
+        data = self.BlockPool.Acquire()
+        Board.ReadBlock(self, data, self.Acquired)
+        self.Acquired += data.shape[0]
+
+        if self.Data is not None:
+            self.Data.AddData(data)
+
+        # EveryNEvent consumers must Retain() the block to hold it
+        if self.EveryNEvent:
+            self.EveryNEvent(data)
+        data.Release()
+
+    def DoneCallback(self, status):
+        self.StopRead()
+        if self.DoneEvent:
+            if self.Data is None:
+                self.DoneEvent(None)
+            else:
+                self.DoneEvent(self.Data.GetOrdered())
+        return 0
+
+##############################################################################
+
+
+class WriteAnalog(SimTask):
+
+    '''
+    Simulated analog outputs
+    '''
+
+    def __init__(self, Channels, Range=AORange):
+        self.Channels = list(Channels)
+
+    def SetVal(self, value):
+        for ch in self.Channels:
+            Board.SetAO(ch, value)
+
+    def SetSignal(self, Signal, nSamps, FsBase='ai/SampleClock', FsDiv=1):
+        Board.SetAOSignal(self.Channels[0], Signal, Continuous=False)
+        self.StartTask()
+
+    def SetContSignal(self, Signal, nSamps, FsBase='ai/SampleClock', FsDiv=1):
+        Board.SetAOSignal(self.Channels[0], Signal, Continuous=True)
+        self.StartTask()
+
+    def StopSignal(self):
+        self.StopTask()
+        Board.SetAOSignal(self.Channels[0], None)
+
+##############################################################################
+
+
+class WriteDigital(SimTask):
+
+    '''
+    Simulated digital outputs
+    '''
+
+    def __init__(self, Channels):
+        self.Channels = list(Channels)
+
+    def SetDigitalSignal(self, Signal):
+        Board.SetSwitch(Signal)
+
+    def SetContSignal(self, Signal):
+        self.StartTask()
@@ -0,0 +1,282 @@
+# -*- coding: utf-8 -*-
+"""
+
+@author: aguimera
+"""
+
+import threading
+import time
+from collections import deque
+import numpy as np
+
+
+class Buffer2D():
+    '''
+    Circular (samples x channels) buffer shared by the DAQ tasks and the
+    time plotters.
+
+    AddData writes the new block at the write index and wraps around, so
+    the cost of each callback only depends on the block size. There is a
+    single writer (the EveryN callback); readers take a snapshot of
+    totalind and get one or two views of the internal array, oldest first,
+    without copying.
+
+    Readers in other threads use GetSnapshot(), a seqlock on the written
+    range: AddData sets WriteEnd before touching the array and the copy of
+    the last Size samples is only retried if the writer went far enough to
+    wrap over them.
+    '''
+
+    def __init__(self, BufferSize, nChannels, Fs=1.0, dtype=float):
+        self.BufferSize = int(BufferSize)
+        self.nChannels = nChannels
+        self.Buffer = np.zeros((self.BufferSize, nChannels), dtype=dtype)
+        self.Fs = float(Fs)
+        self.Ts = 1 / self.Fs
+        self.WriteInd = 0
+        self.counter = 0
+        self.totalind = 0
+        self.WriteEnd = 0
+
+    @property
+    def shape(self):
+        return self.Buffer.shape
+
+    def AddData(self, NewData):
+        newsize = NewData.shape[0]
+        self.WriteEnd = self.totalind + newsize
+        if newsize >= self.BufferSize:
+            self.Buffer[:, :] = NewData[-self.BufferSize:, :]
+            self.WriteInd = 0
+        else:
+            stop = self.WriteInd + newsize
+            if stop <= self.BufferSize:
+                self.Buffer[self.WriteInd:stop, :] = NewData
+            else:
+                first = self.BufferSize - self.WriteInd
+                self.Buffer[self.WriteInd:, :] = NewData[:first, :]
+                self.Buffer[:newsize - first, :] = NewData[first:, :]
+            self.WriteInd = stop % self.BufferSize
+        # indexes are updated once the data is in place
+        self.counter += newsize
+        self.totalind += newsize
+
+    def IsFilled(self):
+        return self.counter >= self.BufferSize
+
+    def Reset(self):
+        self.counter = 0
+
+    def GetSize(self, Size=None):
+        Filled = min(self.totalind, self.BufferSize)
+        if Size is None:
+            return Filled
+        return min(int(Size), Filled)
+
+    def GetViews(self, Size=None, TotalInd=None):
+        '''
+        Returns a tuple with one or two views of the last Size samples,
+        oldest first
+        '''
+        if TotalInd is None:
+            TotalInd = self.totalind
+        Size = self.GetSize(Size)
+        if Size == 0:
+            return (self.Buffer[0:0, :], )
+        stop = TotalInd % self.BufferSize
+        if stop == 0:
+            stop = self.BufferSize
+        start = stop - Size
+        if start >= 0:
+            return (self.Buffer[start:stop, :], )
+        return (self.Buffer[start:, :], self.Buffer[:stop, :])
+
+    def GetTimes(self, Size, TotalInd=None):
+        if TotalInd is None:
+            TotalInd = self.totalind
+        return (np.arange(Size) + (TotalInd - Size)) * self.Ts
+
+    def GetData(self, ViewTime):
+        TotalInd = self.totalind
+        Size = self.GetSize(ViewTime * self.Fs)
+        self.counter = 0
+        return (self.GetViews(Size, TotalInd),
+                self.GetTimes(Size, TotalInd))
+
+    def GetSnapshot(self, Size=None, MaxTries=5):
+        '''
+        Consistent copy of the last Size samples while the writer may be
+        running, returns (Data, TotalInd) or None if every try overlapped
+        a write
+        '''
+        for i in range(MaxTries):
+            TotalInd = self.totalind
+            Data = np.concatenate(self.GetViews(Size, TotalInd), axis=0)
+            if self.WriteEnd - TotalInd <= self.BufferSize - Data.shape[0]:
+                return Data, TotalInd
+            time.sleep(0)
+        return None
+
+    def GetOrdered(self, Size=None):
+        '''
+        Returns the last Size samples as a single array. It is a view when
+        the data does not wrap around the end of the buffer.
+        '''
+        Views = self.GetViews(Size)
+        if len(Views) == 1:
+            return Views[0]
+        return np.concatenate(Views, axis=0)
+
+
+class MinMaxPyramid():
+    '''
+    Min/max decimation levels of a (samples x channels) stream, for the
+    time plots of long views.
+
+    Level k keeps the min and max of each Base**(k+1) samples in a
+    Buffer2D of 2*nChannels columns (mins, maxs) covering BufferSize
+    samples. AddData reduces each block into the first level and the
+    complete bins up the following ones, the samples of unfinished bins
+    are kept pending. Levels stop when they would hold less than MinBins.
+    '''
+
+    def __init__(self, BufferSize, nChannels, Fs=1.0, Base=4, MinBins=512):
+        self.Base = Base
+        self.nChannels = nChannels
+        self.Fs = float(Fs)
+        self.Factors = []
+        self.Levels = []
+        self.Pending = []
+        Factor = Base
+        while BufferSize // Factor >= MinBins:
+            self.Factors.append(Factor)
+            self.Levels.append(Buffer2D(BufferSize=BufferSize // Factor + 1,
+                                        nChannels=2 * nChannels,
+                                        Fs=self.Fs / Factor))
+            self.Pending.append(None)
+            Factor *= Base
+
+    def AddData(self, NewData):
+        Min = Max = NewData
+        for il, Level in enumerate(self.Levels):
+            if self.Pending[il] is not None:
+                pMin, pMax = self.Pending[il]
+                Min = np.concatenate((pMin, Min))
+                Max = np.concatenate((pMax, Max))
+            nBins = Min.shape[0] // self.Base
+            nFull = nBins * self.Base
+            self.Pending[il] = (Min[nFull:].copy(), Max[nFull:].copy()) if nFull < Min.shape[0] else None
+            if nBins == 0:
+                break
+            Min = Min[:nFull].reshape((nBins, self.Base, -1)).min(axis=1)
+            Max = Max[:nFull].reshape((nBins, self.Base, -1)).max(axis=1)
+            Level.AddData(np.hstack((Min, Max)))
+
+    def GetLevel(self, Size, nPixels):
+        '''
+        Index of the coarsest level with at least one bin per pixel for a
+        view of Size samples, None if the raw samples are needed
+        '''
+        Sel = None
+        for il, Factor in enumerate(self.Factors):
+            if Size / Factor < nPixels:
+                break
+            Sel = il
+        return Sel
+
+    def GetSnapshot(self, Level, Size):
+        '''
+        Returns (t, Min, Max) of the bins of the last Size samples, each
+        time the start of its bin, or None as Buffer2D.GetSnapshot
+        '''
+        Buf = self.Levels[Level]
+        Snap = Buf.GetSnapshot(int(np.ceil(Size / self.Factors[Level])))
+        if Snap is None:
+            return None
+        Data, TotalInd = Snap
+        return (Buf.GetTimes(Data.shape[0], TotalInd),
+                Data[:, :self.nChannels],
+                Data[:, self.nChannels:])
+
+
+def Envelope(t, Min, Max):
+    # Curve through the min and max of each bin
+    x = np.repeat(t, 2)
+    y = np.empty((2 * Min.shape[0], ) + Min.shape[1:], dtype=Min.dtype)
+    y[0::2] = Min
+    y[1::2] = Max
+    return x, y
+
+
+class ReadBlock(np.ndarray):
+    '''
+    Pre-allocated read block handed out by ReadBlockPool.
+
+    The block is returned to the pool when its reference count reaches zero.
+    Consumers that keep the block after the EveryN callback returns must call
+    Retain() and then Release() when they are done with it. Views and results
+    computed from a block are plain arrays that are not tracked by the pool.
+    '''
+
+    def __new__(subtype, shape, Pool=None, dtype=float):
+        obj = super(ReadBlock, subtype).__new__(subtype, shape, dtype)
+        obj.Pool = Pool
+        obj.RefCount = 0
+        return obj
+
+    def __array_finalize__(self, obj):
+        if obj is None:
+            return
+        self.Pool = None
+        self.RefCount = 0
+
+    def Retain(self):
+        if self.Pool is not None:
+            self.Pool.Retain(self)
+
+    def Release(self):
+        if self.Pool is not None:
+            self.Pool.Release(self)
+
+
+class ReadBlockPool():
+    def __init__(self, nSamps, nChannels, nBlocks=8, dtype=float):
+        self.shape = (int(nSamps), nChannels)
+        self.dtype = dtype
+        self.Lock = threading.Lock()
+        self.Free = deque()
+        self.Allocated = 0
+        self.Misses = 0
+        for i in range(nBlocks):
+            self.Free.append(self.NewBlock())
+
+    def NewBlock(self):
+        self.Allocated += 1
+        return ReadBlock(self.shape, Pool=self, dtype=self.dtype)
+
+    def Acquire(self):
+        with self.Lock:
+            if len(self.Free):
+                block = self.Free.pop()
+            else:
+                # All blocks are leased, grow the pool
+                block = self.NewBlock()
+                self.Misses += 1
+            block.RefCount = 1
+        return block
+
+    def Retain(self, Block):
+        with self.Lock:
+            Block.RefCount += 1
+
+    def Release(self, Block):
+        with self.Lock:
+            Block.RefCount -= 1
+            if Block.RefCount == 0:
+                self.Free.append(Block)
+            elif Block.RefCount < 0:
+                Block.RefCount = 0
+                print('WARNING read block released twice')
+
+    def IsCompatible(self, nSamps, nChannels):
+        return self.shape == (int(nSamps), nChannels)
@@ -16,6 +16,8 @@ from GFETCharact.ParamConf.FileModule import SaveSateParams
 from GFETCharact.ParamConf.SweepsConf import SweepsConfig
 from GFETCharact.ParamConf.HardwareConf import HardwareConfig
 from GFETCharact.CracterizationCore import CharacterizationMachine
+from GFETCharact.StatusLog import StatusLog
+from GFETCharact.StatusLogView import StatusLogView
 
 import sys
 
@@ -36,12 +38,10 @@ class MainWindow(Qt.QWidget):
         # start Button
         self.btnAcq = Qt.QPushButton("Start Measure")
         layout.addWidget(self.btnAcq)
+        self.btnResume = Qt.QPushButton("Resume Measure")
+        layout.addWidget(self.btnResume)
 
-        self.InfoStr = Parameter.create(**{'name': 'InfoStr',
-                                           'title': 'Status Info',
-                                           'type': 'text',
-                                           'expanded': True,
-                                           'readonly': True})
+        self.InfoLog = StatusLog()
 
         self.SaveStateConf = SaveSateParams(QTparent=self,
                                             name='SaveStateConf',
@@ -63,7 +63,6 @@ class MainWindow(Qt.QWidget):
         self.Parameters = Parameter.create(name='App Parameters',
                                            type='group',
                                            children=(
-                                               self.InfoStr,
                                                self.HardConf,
                                                self.SweepsConf,
                                                self.SaveFileConf,
@@ -75,11 +74,16 @@ class MainWindow(Qt.QWidget):
 
         layout.addWidget(self.treepar)
 
+        self.InfoView = StatusLogView(self.InfoLog)
+        self.InfoView.setMaximumHeight(200)
+        layout.addWidget(self.InfoView)
+
         self.Charact = CharacterizationMachine(SweepsConf=self.SweepsConf,
-                                               InfoOut=self.InfoStr)
+                                               InfoOut=self.InfoLog)
 
         self.Charact.CharactFinished.connect(self.on_CharactFinished)
         self.btnAcq.clicked.connect(self.on_btnStart)
+        self.btnResume.clicked.connect(self.on_btnResume)
 
     def on_btnStart(self):
         if self.Charact.ChactRunning:
@@ -91,9 +95,19 @@ class MainWindow(Qt.QWidget):
 
             self.SaveFileConf.CheckFile()
             FileName = self.SaveFileConf.FileName
-            self.Charact.StartCharact(HardConf=self.HardConf,
-                                      FileName=FileName)
-            self.btnAcq.setText('Stop Measure')
+            if self.Charact.StartCharact(HardConf=self.HardConf,
+                                         FileName=FileName):
+                self.btnAcq.setText('Stop Measure')
+
+    def on_btnResume(self):
+        if self.Charact.ChactRunning:
+            return
+        DirName = Qt.QFileDialog.getExistingDirectory(self,
+                                                      "Data directory to resume")
+        if DirName:
+            if self.Charact.ResumeCharact(HardConf=self.HardConf,
+                                          FileName=DirName):
+                self.btnAcq.setText('Stop Measure')
 
     def on_CharactFinished(self):
         self.btnAcq.setText('Start Measure')
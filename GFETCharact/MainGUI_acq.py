@@ -45,6 +45,7 @@ class MainWindow(Qt.QWidget):
         self.SaveFileConf = SaveDataParams(QTparent=self,
                                            name='SaveFileConf',
                                            title='Save Data',
+                                           Extension='.raw',
                                            expanded=True)
 
         self.HardConf = HardwareConfig(name='HardConf',
@@ -73,20 +74,22 @@ class MainWindow(Qt.QWidget):
 
         layout.addWidget(self.treepar)
 
-        self.AcqTime = AdquisitionCore(SamplingConf=self.SamplingConf)
+        self.AcqTime = AdquisitionCore(SamplingConf=self.SamplingConf,
+                                       InfoOut=self.InfoStr)
 
         self.btnAcq.clicked.connect(self.on_btnStart)
 
     def on_btnStart(self):
         if self.AcqTime.AdcRunning:
-            self.AcqTime.StopCharact()
+            self.AcqTime.StopAcquisition()
+            self.btnAcq.setText('Start Acquisition')
         else:
-            # if not self.SaveFileConf.param('bSave').value():
-            #     self.SaveFileConf.on_Save()
-            #
-            # self.SaveFileConf.CheckFile()
-            # FileName = self.SaveFileConf.FileName
-            self.AcqTime.StartAcquisition(HardConf=self.HardConf.param('BoardConf'))
+            FileName = None
+            if self.SaveFileConf.param('bSave').value():
+                self.SaveFileConf.CheckFile()
+                FileName = self.SaveFileConf.FileName
+            self.AcqTime.StartAcquisition(HardConf=self.HardConf.param('BoardConf'),
+                                          FileName=FileName)
             self.btnAcq.setText('Stop Measure')
 
 
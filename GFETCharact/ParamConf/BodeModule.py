@@ -10,6 +10,12 @@ import pyqtgraph.parametertree.parameterTypes as pTypes
 import numpy as np
 import matplotlib.pyplot as plt
 
+from GFETCharact.ParamConf.BodeSignals import CalcCoherentSweepFreqs
+from GFETCharact.ParamConf.BodeSignals import CalcFFTavg, GenSignal
+from GFETCharact.ParamConf.BodeSignals import CalcBodePlans, GenBodeSignals
+from GFETCharact.ParamConf.BodeSignals import GetTestSignals, CalcBodeAcqTime
+from GFETCharact.ParamConf.BodeSignals import PhaseStrategies
+
 
 BodeParams = ({'name': 'FreqMin',
                'title': 'Start Freq.',
@@ -72,10 +78,16 @@ BodeParams = ({'name': 'FreqMin',
                'siPrefix': True,
                'suffix': 'Hz'},
               {'name': 'PhOptim',
-               'title': 'Optimize Phase',
-               'type': 'bool',
-               'value': False,
-               'default': False},
+               'title': 'Phase Strategy',
+               'type': 'list',
+               'limits': PhaseStrategies,
+               'value': 'None',
+               'default': 'None'},
+              {'name': 'Seed',
+               'title': 'Phase Seed',
+               'type': 'int',
+               'value': 0,
+               'default': 0},
               {'name': 'Plot',
                'title': 'Plot Test Signals',
                'type': 'action'},
@@ -92,90 +104,10 @@ BodeParams = ({'name': 'FreqMin',
               )
 
 
-def CalcCoherentSweepFreqs(Freqs, Fs, **kwargs):
-    FreqMin = np.min(Freqs)
-    FreqMax = np.max(Freqs)
-    nFreqs = len(Freqs)
-
-    nFFT = int(2**((np.around(np.log2(Fs/FreqMin))+1)+2))
-
-    nmin = (FreqMin*(nFFT))/Fs
-    nmax = (FreqMax*(nFFT))/Fs
-
-    ns = np.round(np.logspace(np.log10(nmin),
-                              np.log10(nmax),
-                              nFreqs),
-                  0)
-
-    wsFreqs = (float(Fs)/(nFFT))*np.unique(ns)
-    fftfreqs = np.fft.rfftfreq(nFFT, 1/float(Fs))
-    FFTInds = np.where(np.in1d(fftfreqs, wsFreqs))[0]
-
-    BodeSignalConf = {'Freqs': wsFreqs,
-                      'nFFT': nFFT,
-                      'Fs': Fs,
-                      'FFTInds': FFTInds}
-
-    return BodeSignalConf
-
-
-def CalcFFTavg(Data, nFFT=-1, nAvg=-1):
-    a = Data.reshape((nAvg, nFFT))
-    acc = np.zeros(((nFFT//2)+1))
-    for w in a:
-        acc = acc + (2 * np.fft.rfft(w, nFFT) / nFFT)
-    return acc/nAvg
-
-
-def GenSignal(Freqs, nFFT, Fs, Amp, FFTInds, PhOptim, nAvg=1, **kwargs):
-    Ts = 1/float(Fs)
-    Ps = nFFT * nAvg * Ts
-
-    # Amp = Arms*np.sqrt(2)
-    t = np.arange(0, Ps, Ts)
-
-    if PhOptim:
-        phs = []
-        amps = []
-        for i in range(10):
-            Phs = np.random.rand(len(Freqs))*2*np.pi - np.pi
-            phs.append(Phs)
-            Signal = np.zeros(t.size)
-            for f, p in zip(Freqs, Phs):
-                s = Amp * np.cos(f * 2 * np.pi * t + p)
-                Signal = Signal + s
-            amps.append(np.max(Signal) + np.abs(np.min(Signal)))
-        print(amps)
-        Phs = phs[np.argmin(amps)]
-    else:
-        Phs = np.zeros((len(Freqs)))
-
-    Signal = np.zeros(t.size)
-    for f, p in zip(Freqs, Phs):
-        s = Amp * np.cos(f * 2 * np.pi * t + p)
-        Signal = Signal + s
-
-    Signal[-1] = 0
-    FFTAmps = CalcFFTavg(Signal, nFFT, nAvg)[FFTInds]
-    Vpp = np.max(Signal) + np.abs(np.min(Signal))
-
-    BodeSignalConf = {'Freqs': Freqs,
-                      'Phs': Phs,
-                      'nFFT': nFFT,
-                      'Fs': Fs,
-                      'FFTInds': FFTInds,
-                      'Signal': Signal,
-                      'FFTAmps': FFTAmps,
-                      'Vpp': Vpp,
-                      'acqTime': t[-1],
-                      'times': t}
-
-    return BodeSignalConf
-
-
 SignalInfoParamsFloat = ('nFFT',
                          'Fs',
                          'Vpp',
+                         'CrestFactor',
                          'acqTime',
                          'Sequential')
 
@@ -189,6 +121,7 @@ class BodeConfig(pTypes.GroupParameter):
     def __init__(self, **kwargs):
         pTypes.GroupParameter.__init__(self, **kwargs)
         self.BodeSignalConfs = None
+        self.BodePlans = None
         self.BodeKwargs = None
         self.Axs = None
         self.SigFig = None
@@ -203,6 +136,7 @@ class BodeConfig(pTypes.GroupParameter):
         self.param('nAvg').sigValueChanged.connect(self.on_change)
         self.param('Amp').sigValueChanged.connect(self.on_change)
         self.param('PhOptim').sigValueChanged.connect(self.on_change)
+        self.param('Seed').sigValueChanged.connect(self.on_change)
 
         self.param('Plot').sigActivated.connect(self.on_plot)
 
@@ -216,61 +150,23 @@ class BodeConfig(pTypes.GroupParameter):
             BodeKwargs[p.name()] = p.value()
         return BodeKwargs
 
+    def GetSignals(self):
+        # Signals are generated (or taken from the cache) on first use
+        if self.BodeSignalConfs is None:
+            self.BodeSignalConfs = GenBodeSignals(self.BodePlans)
+            self.UpdateSignalsInfo(self.BodeSignalConfs)
+        return self.BodeSignalConfs
+
     def GetTestSignals(self):
-        Freqs = np.hstack([s['Freqs'] for s in self.BodeSignalConfs])
-        return {'Freqs': Freqs,
-                'TestSigs': self.BodeSignalConfs}
+        return GetTestSignals(self.GetSignals())
 
     def UpdateAcqTime(self, nChannels=16):
-        acqTime = 0
-        for s in self.BodeSignalConfs:
-            if s['Sequential']:
-                acqTime += s['acqTime'] * nChannels
-            else:
-                acqTime += s['acqTime']
+        acqTime = CalcBodeAcqTime(self.BodePlans, nChannels)
         self.param('acqTime').setValue(acqTime)
 
-    def on_change(self):
-        swFreqMin = self.param('FreqMin').value()
-        swFreqMax = self.param('FreqMax').value()
-        swnFreqs = self.param('nFreqs').value()
-        FsHigh = self.param('FsHigh').value()
-        FsLow = self.param('FsLow').value()
-        FreqSplit = self.param('FreqSplit').value()
-        nAvg = self.param('nAvg').value()
-        Amp = self.param('Amp').value()
-        PhOptim = self.param('PhOptim').value()
-
-        self.BodeKwargs = self.GetParams()
-
-        fsweep = np.logspace(np.log10(swFreqMin),
-                             np.log10(swFreqMax),
-                             swnFreqs)
-
-        sw1 = fsweep[np.where(fsweep < FreqSplit)]
-        sw2 = fsweep[np.where(fsweep > FreqSplit)]
-
-        self.BodeSignalConfs = []
-        if len(sw1) > 0:
-            BConf = GenSignal(Amp=Amp,
-                              nAvg=nAvg,
-                              PhOptim=PhOptim,
-                              **CalcCoherentSweepFreqs(sw1,
-                                                       FsLow))
-            BConf['Sequential'] = 0
-            self.BodeSignalConfs.append(BConf)
-
-        if len(sw2) > 0:
-            BConf = GenSignal(Amp=Amp,
-                              nAvg=nAvg,
-                              PhOptim=PhOptim,
-                              **CalcCoherentSweepFreqs(sw2,
-                                                       FsHigh))
-            BConf['Sequential'] = 1
-            self.BodeSignalConfs.append(BConf)
-
+    def UpdateSignalsInfo(self, Confs):
         self.param('TestSigs').clearChildren()
-        for isc, s in enumerate(self.BodeSignalConfs):
+        for isc, s in enumerate(Confs):
             sstr = 'Sig{}'.format(isc)
             pars = []
             self.param('TestSigs').addChild({'name': sstr,
@@ -278,28 +174,39 @@ class BodeConfig(pTypes.GroupParameter):
                                              'expanded': False,
                                              'children': ()})
             for p in SignalInfoParamsFloat:
+                if p not in s:
+                    continue
                 pars.append({'name': p,
                              'type': 'float',
                              'value': s[p],
                              'readonly': True,
                              'siPrefix': True})
             for p in SignalInfoParamsText:
+                if p not in s:
+                    continue
                 pars.append({'name': p,
                              'type': 'text',
                              'value': str(s[p]),
                              'readonly': True,
                              'expanded': False})
             self.param('TestSigs').param(sstr).addChildren(pars)
+
+    def on_change(self):
+        self.BodeKwargs = self.GetParams()
+        self.BodePlans = CalcBodePlans(**self.BodeKwargs)
+        self.BodeSignalConfs = None
+        self.UpdateSignalsInfo(self.BodePlans)
         self.UpdateAcqTime()
 
     def on_plot(self):
-        self.SigFig, axs = plt.subplots(len(self.BodeSignalConfs), 3)
+        BodeSignalConfs = self.GetSignals()
+        self.SigFig, axs = plt.subplots(len(BodeSignalConfs), 3)
         self.Axs = axs.flatten()
         Amp = self.param('Amp').value()
 
-        for ix, s in enumerate(self.BodeSignalConfs):
+        for ix, s in enumerate(BodeSignalConfs):
             ax = self.Axs[(ix*3)]
-            ax.plot(s['times'], s['Signal'])
+            ax.plot(np.arange(s['Signal'].size) / s['Fs'], s['Signal'])
             ax.set_xlabel('Time [s]')
             ax.set_ylabel('Amp [V]')
 
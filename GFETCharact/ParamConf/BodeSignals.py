@@ -0,0 +1,275 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Bode test signal generation, without GUI dependencies.
+
+@author: aguimera
+"""
+
+import hashlib
+import os
+from collections import OrderedDict
+import numpy as np
+
+
+def CalcCoherentSweepFreqs(Freqs, Fs, **kwargs):
+    FreqMin = np.min(Freqs)
+    FreqMax = np.max(Freqs)
+    nFreqs = len(Freqs)
+
+    nFFT = int(2**((np.around(np.log2(Fs/FreqMin))+1)+2))
+
+    nmin = (FreqMin*(nFFT))/Fs
+    nmax = (FreqMax*(nFFT))/Fs
+
+    ns = np.round(np.logspace(np.log10(nmin),
+                              np.log10(nmax),
+                              nFreqs),
+                  0)
+
+    wsFreqs = (float(Fs)/(nFFT))*np.unique(ns)
+    fftfreqs = np.fft.rfftfreq(nFFT, 1/float(Fs))
+    FFTInds = np.where(np.isin(fftfreqs, wsFreqs))[0]
+
+    BodeSignalConf = {'Freqs': wsFreqs,
+                      'nFFT': nFFT,
+                      'Fs': Fs,
+                      'FFTInds': FFTInds}
+
+    return BodeSignalConf
+
+
+def CalcFFTavg(Data, nFFT=-1, nAvg=-1):
+    a = Data.reshape((nAvg, nFFT))
+    acc = np.zeros(((nFFT//2)+1))
+    for w in a:
+        acc = acc + (2 * np.fft.rfft(w, nFFT) / nFFT)
+    return acc/nAvg
+
+
+PhaseStrategies = ('None', 'Random', 'Schroeder', 'CrestOptim')
+
+
+def GetPhaseStrategy(PhOptim):
+    # Former boolean PhOptim, True was the random search
+    if PhOptim is True:
+        return 'Random'
+    if PhOptim is False or PhOptim is None:
+        return 'None'
+    if PhOptim not in PhaseStrategies:
+        raise ValueError('Unknown phase strategy {}, use one of {}'.format(PhOptim, PhaseStrategies))
+    return PhOptim
+
+
+def SynthMultisine(nFFT, FFTInds, Amp, Phs):
+    '''
+    One period of sum(Amp * cos(2 pi k n / nFFT + Phs)) for the k in
+    FFTInds, all the tones with a single inverse rfft
+    '''
+    X = np.zeros(nFFT // 2 + 1, dtype=complex)
+    X[FFTInds] = (Amp * nFFT / 2) * np.exp(1j * np.asarray(Phs))
+    return np.fft.irfft(X, nFFT)
+
+
+def CalcVpp(Signal):
+    return np.max(Signal) - np.min(Signal)
+
+
+def SchroederPhases(nTones):
+    k = np.arange(1, nTones + 1)
+    return -np.pi * k * (k - 1) / nTones
+
+
+def RandomPhases(nFFT, FFTInds, Seed=None, nTries=10):
+    # Best of nTries random phase sets, as the former PhOptim
+    Rnd = np.random.RandomState(Seed)
+    Best = None
+    for i in range(nTries):
+        Phs = Rnd.rand(len(FFTInds))*2*np.pi - np.pi
+        Vpp = CalcVpp(SynthMultisine(nFFT, FFTInds, 1, Phs))
+        if Best is None or Vpp < Best[0]:
+            Best = (Vpp, Phs)
+    return Best[1]
+
+
+def CrestOptimPhases(nFFT, FFTInds, nIters=200, ClipRatio=0.7,
+                     OverSample=8):
+    '''
+    Iterative clipping: starting from the Schroeder phases the signal is
+    clipped to ClipRatio of its peak-to-peak and the phases at the tones
+    are taken from the clipped signal spectrum, the lowest Vpp set is kept.
+    The iterations run on a grid of OverSample times the highest tone.
+    '''
+    nGrid = int(min(nFFT, 2 ** np.ceil(np.log2(OverSample * (np.max(FFTInds) + 1)))))
+    Phs = SchroederPhases(len(FFTInds))
+    Best = (np.inf, Phs)
+    for i in range(nIters):
+        x = SynthMultisine(nGrid, FFTInds, 1, Phs)
+        xMax = np.max(x)
+        xMin = np.min(x)
+        if xMax - xMin < Best[0]:
+            Best = (xMax - xMin, Phs)
+        Center = (xMax + xMin) / 2
+        Lim = ClipRatio * (xMax - xMin) / 2
+        X = np.fft.rfft(np.clip(x, Center - Lim, Center + Lim))
+        Phs = np.angle(X[FFTInds])
+    return Best[1]
+
+
+def CalcPhases(PhOptim, nFFT, FFTInds, Seed=None):
+    Strategy = GetPhaseStrategy(PhOptim)
+    if Strategy == 'Random':
+        return RandomPhases(nFFT, FFTInds, Seed)
+    if Strategy == 'Schroeder':
+        return SchroederPhases(len(FFTInds))
+    if Strategy == 'CrestOptim':
+        return CrestOptimPhases(nFFT, FFTInds)
+    return np.zeros(len(FFTInds))
+
+
+def GenSignal(Freqs, nFFT, Fs, Amp, FFTInds, PhOptim, nAvg=1, Seed=None,
+              **kwargs):
+    '''
+    Multisine with the tones at the coherent FFTInds bins (Freqs), nAvg
+    periods of nFFT samples
+    '''
+    Phs = CalcPhases(PhOptim, nFFT, FFTInds, Seed)
+    Period = SynthMultisine(nFFT, FFTInds, Amp, Phs)
+    Signal = np.tile(Period, nAvg)
+
+    Signal[-1] = 0
+    FFTAmps = CalcFFTavg(Signal, nFFT, nAvg)[FFTInds]
+    Vpp = CalcVpp(Signal)
+
+    BodeSignalConf = {'Freqs': Freqs,
+                      'Phs': Phs,
+                      'nFFT': nFFT,
+                      'Fs': Fs,
+                      'FFTInds': FFTInds,
+                      'Signal': Signal,
+                      'FFTAmps': FFTAmps,
+                      'Vpp': Vpp,
+                      'CrestFactor': np.max(np.abs(Period)) / np.std(Period),
+                      'acqTime': (Signal.size - 1) / float(Fs)}
+
+    return BodeSignalConf
+
+
+def CalcBodePlans(FreqMin, FreqMax, nFreqs, FsHigh, FsLow, FreqSplit,
+                  nAvg, Amp, PhOptim, Seed=0, **kwargs):
+    '''
+    Test signal descriptions without the signals, the low band signal is
+    acquired in parallel and the high band sequentially
+    '''
+    fsweep = np.logspace(np.log10(FreqMin),
+                         np.log10(FreqMax),
+                         nFreqs)
+
+    sw1 = fsweep[np.where(fsweep < FreqSplit)]
+    sw2 = fsweep[np.where(fsweep > FreqSplit)]
+
+    Plans = []
+    for sw, Fs, Sequential in ((sw1, FsLow, 0), (sw2, FsHigh, 1)):
+        if len(sw) == 0:
+            continue
+        Plan = CalcCoherentSweepFreqs(sw, Fs)
+        Plan.update({'Amp': Amp,
+                     'nAvg': nAvg,
+                     'PhOptim': GetPhaseStrategy(PhOptim),
+                     'Seed': Seed,
+                     'Sequential': Sequential,
+                     'acqTime': (Plan['nFFT'] * nAvg - 1) / float(Fs)})
+        Plans.append(Plan)
+    return Plans
+
+
+class SignalCache():
+    '''
+    Generated test signals by content, key of (Freqs, Fs, nFFT, Amp, nAvg,
+    PhOptim, Seed). The last MaxItems signals are kept in memory and, if
+    CacheDir is given, all of them are also stored as .npz files.
+    '''
+
+    def __init__(self, MaxItems=8, CacheDir=None):
+        self.MaxItems = MaxItems
+        self.CacheDir = CacheDir
+        self.Signals = OrderedDict()
+        self.Hits = 0
+        self.Misses = 0
+
+    @staticmethod
+    def GetKey(Freqs, Fs, nFFT, Amp, nAvg, PhOptim, Seed=None, **kwargs):
+        if GetPhaseStrategy(PhOptim) != 'Random':
+            Seed = None
+        h = hashlib.sha1(np.asarray(Freqs, dtype=float).tobytes())
+        h.update(repr((float(Fs), int(nFFT), float(Amp), int(nAvg),
+                       PhOptim, Seed)).encode())
+        return h.hexdigest()
+
+    def FileName(self, Key):
+        return os.path.join(self.CacheDir, 'BodeSig-{}.npz'.format(Key))
+
+    def Load(self, Key):
+        if self.CacheDir is None or not os.path.isfile(self.FileName(Key)):
+            return None
+        with np.load(self.FileName(Key)) as f:
+            return {k: v[()] if v.ndim == 0 else v for k, v in f.items()}
+
+    def Save(self, Key, Conf):
+        if self.CacheDir is None:
+            return
+        os.makedirs(self.CacheDir, exist_ok=True)
+        np.savez(self.FileName(Key), **Conf)
+
+    def Get(self, Plan):
+        Key = self.GetKey(**Plan)
+        if Key in self.Signals:
+            self.Signals.move_to_end(Key)
+            self.Hits += 1
+            return self.Signals[Key].copy()
+
+        Conf = self.Load(Key)
+        if Conf is None:
+            self.Misses += 1
+            Conf = GenSignal(**Plan)
+            Conf['Sequential'] = Plan['Sequential']
+            self.Save(Key, Conf)
+        else:
+            self.Hits += 1
+
+        self.Signals[Key] = Conf
+        while len(self.Signals) > self.MaxItems:
+            self.Signals.popitem(last=False)
+        return Conf.copy()
+
+    def Clear(self):
+        self.Signals.clear()
+
+
+BodeCache = SignalCache(CacheDir=os.environ.get('GFETCHARACT_SIGNAL_CACHE'))
+
+
+def GenBodeSignals(Plans, Cache=None):
+    if Cache is None:
+        Cache = BodeCache
+    return [Cache.Get(p) for p in Plans]
+
+
+def CalcBodeSignals(**kwargs):
+    return GenBodeSignals(CalcBodePlans(**kwargs))
+
+
+def GetTestSignals(BodeSignalConfs):
+    Freqs = np.hstack([s['Freqs'] for s in BodeSignalConfs])
+    return {'Freqs': Freqs,
+            'TestSigs': BodeSignalConfs}
+
+
+def CalcBodeAcqTime(BodeSignalConfs, nChannels=16):
+    acqTime = 0
+    for s in BodeSignalConfs:
+        if s['Sequential']:
+            acqTime += s['acqTime'] * nChannels
+        else:
+            acqTime += s['acqTime']
+    return acqTime
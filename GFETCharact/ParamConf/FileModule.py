@@ -12,12 +12,15 @@ import os
 import pyqtgraph.parametertree.parameterTypes as pTypes
 from PyQt5.QtWidgets import QFileDialog
 
+from GFETCharact.SaveData import GetFreeFileName
+
 
 class SaveDataParams(pTypes.GroupParameter):
-    def __init__(self, QTparent, **kwargs):
+    def __init__(self, QTparent, Extension='.pkl', **kwargs):
         pTypes.GroupParameter.__init__(self, **kwargs)
 
         self.QTparent = QTparent
+        self.Extension = Extension
         self.addChildren(({'name': 'SelFile',
                            'title': '...',
                            'type': 'action'},
@@ -38,22 +41,15 @@ class SaveDataParams(pTypes.GroupParameter):
         if self.FileName is None:
             return
 
-        pathfile, file = os.path.split(self.FileName)
-        filename, extension = os.path.splitext(file)
-        counter = 1
-        filename = filename.split('-Cy_')[0]
-        while os.path.exists(self.FileName):
-            fn = '{0}-Cy_{1:02}{2}'.format(filename, counter, extension)
-            self.FileName = os.path.join(pathfile, fn)
-            counter += 1
+        self.FileName = GetFreeFileName(self.FileName)
         self.param('FileName').setValue(self.FileName)
 
     def on_Save(self):
         RecordFile, _ = QFileDialog.getSaveFileName(self.QTparent,
                                                     "Data File")
         if RecordFile:
-            if not RecordFile.endswith('.pkl'):
-                RecordFile = RecordFile + '.pkl'
+            if not RecordFile.endswith(self.Extension):
+                RecordFile = RecordFile + self.Extension
             self.param('FileName').setValue(RecordFile)
             self.FileName = RecordFile
             self.param('bSave').setValue(True)
@@ -28,6 +28,12 @@ SamplingSettingsPars = ({'title': 'Sampling Freq.',
                          'suffix': 's',
                          'readonly': True,
                          },
+                        {'title': 'Acquire AC channels',
+                         'name': 'AcqAC',
+                         'type': 'bool',
+                         'value': True,
+                         'default': True,
+                         },
                         {'title': 'View Buffer time',
                          'name': 'tBufferView',
                          'type': 'float',
@@ -0,0 +1,423 @@
+# -*- coding: utf-8 -*-
+"""
+Sweep and characterization step generation, without GUI dependencies.
+Used by SweepsConfig and by the command line runner.
+
+@author: aguimera
+"""
+
+import numpy as np
+
+from GFETCharact.ParamConf.BodeSignals import CalcBodeAcqTime
+
+
+def CalcSweepVals(Start, Stop, Points=None, Step=None, bPoints=True,
+                  **kwargs):
+    if bPoints:
+        return np.linspace(Start, Stop, Points)
+    return np.arange(Start, Stop, Step)
+
+
+def ParseIndexes(strind, nPoints):
+    # strind = '0, 9, 2:8, 9:16:2'
+    inds = []
+    for parts in strind.split(','):
+        raargs = []
+        ra = parts.split(':')
+        if len(ra) == 1:
+            inds.append(int(ra[0]))
+        else:
+            for r in ra:
+                raargs.append(int(r))
+            for i in range(*raargs):
+                inds.append(i)
+    inds = list(set(sorted(inds)))
+    inds = [x for x in inds if x < nPoints]
+    inds = [x for x in inds if x >= 0]
+    return inds
+
+
+def CalcPSDFreqs(Fs, nFFT, **kwargs):
+    return np.fft.rfftfreq(2 ** nFFT, 1 / float(Fs))
+
+
+def CalcPSDKwargs(Fs, nFFT, nAvg, **kwargs):
+    # Same keys as PSDConfig.GetParams
+    return {'Fs': Fs,
+            'nFFT': nFFT,
+            'Fmin': 1 / (2 ** nFFT / Fs),
+            'nAvg': nAvg,
+            'acqTime': ((2 ** nFFT) / Fs) * nAvg,
+            'Freqs': CalcPSDFreqs(Fs, nFFT)}
+
+
+def GetVgsMax(VgsSw, Refine=None):
+    # Size of the Vgs axis with the points added by the refinement passes
+    if not Refine:
+        return len(VgsSw)
+    return len(VgsSw) + Refine['Points'] * Refine['Passes']
+
+
+def BuildSweepConf(VgsSw, VdsSw, Gate, VgsIndexes,
+                   BodeKwargs=None, PSDKwargs=None, Predict=False,
+                   SweepOrder='Forward', Refine=None):
+    swC = {'VgsSw': VgsSw,
+           'VdsSw': VdsSw,
+           'Gate': Gate,
+           'Predict': Predict,
+           'SweepOrder': SweepOrder,
+           'VgsMax': GetVgsMax(VgsSw, Refine)
+           }
+
+    if BodeKwargs is not None or PSDKwargs is not None:
+        swC['VgsSwAC'] = VgsSw[VgsIndexes]
+    if BodeKwargs is not None:
+        swC['BodeKwarg'] = BodeKwargs
+    if PSDKwargs is not None:
+        swC['PSDKwarg'] = PSDKwargs
+    return swC
+
+
+SweepOrders = ('Forward', 'Serpentine', 'Hysteresis', 'MinJump')
+
+
+# Last MinJump order, {(VgsSw, VdsSw) bytes: Points}
+MinJumpCache = {}
+
+
+def CalcMinJumpOrder(VgsSw, VdsSw):
+    '''
+    Greedy nearest bias walk, O(n^2) in the bias points, the last sweep is
+    cached as the settling estimate is updated on every parameter change
+    '''
+    VdsSw = np.asarray(VdsSw, dtype=float)
+    VgsSw = np.asarray(VgsSw, dtype=float)
+    Key = (VgsSw.tobytes(), VdsSw.tobytes())
+    if Key in MinJumpCache:
+        return MinJumpCache[Key]
+    iVd, iVg = np.meshgrid(np.arange(VdsSw.size), np.arange(VgsSw.size),
+                           indexing='ij')
+    iVd = iVd.ravel()
+    iVg = iVg.ravel()
+    Vd = VdsSw[iVd]
+    Vg = VgsSw[iVg]
+    Left = np.ones(iVd.size, dtype=bool)
+    Last = (0., 0.)
+    Points = []
+    for i in range(iVd.size):
+        Dist = np.abs(Vd - Last[0]) + np.abs(Vg - Last[1])
+        Dist[~Left] = np.inf
+        Next = np.argmin(Dist)
+        Left[Next] = False
+        Last = (Vd[Next], Vg[Next])
+        Points.append((int(iVd[Next]), int(iVg[Next]), 0))
+    MinJumpCache.clear()
+    MinJumpCache[Key] = tuple(Points)
+    return MinJumpCache[Key]
+
+
+def CalcBiasOrder(VgsSw, VdsSw, SweepOrder='Forward'):
+    '''
+    Returns the (iVd, iVg, Dir) bias points in the measuring order,
+    Dir 1 for the backward Vgs sweep of the Hysteresis order.
+
+        Forward    -- Vgs from start to stop for every Vds
+        Serpentine -- Vgs direction alternated for each Vds
+        Hysteresis -- Vgs forward and backward for every Vds
+        MinJump    -- each point followed by the closest pending one,
+                      |dVgs| + |dVds|, starting from the 0 V bias
+    '''
+    nVd = len(VdsSw)
+    nVg = len(VgsSw)
+    Points = []
+    if SweepOrder in ('Forward', 'Serpentine', 'Hysteresis'):
+        for iVd in range(nVd):
+            Fwd = list(range(nVg))
+            if SweepOrder == 'Serpentine' and iVd % 2:
+                Fwd = Fwd[::-1]
+            Points.extend((iVd, iVg, 0) for iVg in Fwd)
+            if SweepOrder == 'Hysteresis':
+                Points.extend((iVd, iVg, 1) for iVg in Fwd[::-1])
+    elif SweepOrder == 'MinJump':
+        Points = list(CalcMinJumpOrder(VgsSw, VdsSw))
+    else:
+        raise ValueError('Unknown sweep order {}, use one of {}'.format(SweepOrder, SweepOrders))
+    return Points
+
+
+def CalcSettleTime(VgsSw, VdsSw, Points, SettleRate, BlockTime, TimeOut,
+                   **kwargs):
+    '''
+    DC settling time of the Points order, each step takes BlockTime plus
+    SettleRate seconds per volt of bias jump, |dVgs| + |dVds|, up to the
+    TimeOut. The sweep starts from the 0 V bias.
+    '''
+    Points = np.array(Points, dtype=int).reshape((-1, 3))
+    Vd = np.concatenate(([0.], np.asarray(VdsSw, dtype=float)[Points[:, 0]]))
+    Vg = np.concatenate(([0.], np.asarray(VgsSw, dtype=float)[Points[:, 1]]))
+    Jumps = np.abs(np.diff(Vd)) + np.abs(np.diff(Vg))
+    return float(np.sum(np.clip(BlockTime + SettleRate * Jumps,
+                                BlockTime, max(TimeOut, BlockTime))))
+
+
+def CalcOrdersSettleTime(VgsSw, VdsSw, AcqKwargs):
+    # {SweepOrder: DC settling time} to compare the orders
+    Times = {}
+    for Order in SweepOrders:
+        Times[Order] = CalcSettleTime(VgsSw, VdsSw,
+                                      CalcBiasOrder(VgsSw, VdsSw, Order),
+                                      BlockTime=AcqKwargs['nSamps'] / AcqKwargs['Fs'],
+                                      **AcqKwargs)
+    return Times
+
+
+def RefineVgs(Vgs, Ids, nPoints, MinStep=1e-3):
+    '''
+    New Vgs points for an adaptive sweep. Vgs is the (nVgs, ) measured axis
+    in any order, NaN for the unused slots, Ids (nVgs, ...) the currents of
+    all the Vds and channels.
+
+    Each Vgs interval of each curve is scored by its normalized Ids change
+    (transconductance times width) plus its change of slope (curvature
+    times width), the two intervals around the Ids minimum (Dirac point)
+    are boosted by their relative width. The intervals with the highest
+    score of any curve are split at their midpoint, up to nPoints and not
+    below MinStep.
+    '''
+    Valid = ~np.isnan(Vgs)
+    Order = np.argsort(Vgs[Valid])
+    v = Vgs[Valid][Order]
+    I = np.abs(Ids[Valid][Order].reshape((v.size, -1)))
+    I = I[:, ~np.any(np.isnan(I), axis=0)]
+    if v.size < 3 or I.shape[1] == 0:
+        return np.array([])
+
+    IMin = I.min(axis=0)
+    Range = I.max(axis=0) - IMin
+    In = (I - IMin) / np.where(Range > 0, Range, 1)
+    dv = np.diff(v)
+    vn = dv / (v[-1] - v[0])
+
+    dI = np.diff(In, axis=0)
+    dSlope = np.abs(np.diff(dI / vn[:, None], axis=0))
+    Curv = np.zeros(dI.shape)
+    Curv[:-1] += dSlope
+    Curv[1:] += dSlope
+    Score = np.abs(dI) + 0.5 * vn[:, None] * Curv
+
+    iMin = np.argmin(I, axis=0)
+    Boost = dv / np.mean(dv)
+    for ic, im in enumerate(iMin):
+        if 0 < im < v.size - 1:
+            Score[im - 1, ic] += Boost[im - 1]
+            Score[im, ic] += Boost[im]
+
+    Score = Score.max(axis=1)
+    Score[dv < 2 * MinStep] = 0
+    Sel = np.argsort(Score)[::-1][:nPoints]
+    Sel = Sel[Score[Sel] > 0]
+    return np.sort((v[Sel] + v[Sel + 1]) / 2)
+
+
+StepFuncts = ('GetIds', 'GetGate', 'GetBode', 'GetPSD')
+StepDType = np.dtype([('Funct', 'u1'),
+                      ('iVd', 'i4'),
+                      ('iVg', 'i4'),
+                      ('iVgac', 'i4'),
+                      ('Dir', 'u1'),
+                      ('Flags', 'u1')])
+# Info text of each kind of step, DC ones by Dir
+StepInfo = {'GetIds': ('DCIds', 'DCIds Back'),
+            'GetGate': ('Gate', 'Gate Back'),
+            'GetBode': 'Bode',
+            'GetPSD': 'PSD'}
+FlagDone = 1
+FlagSkip = 2
+
+
+class StepTable():
+    '''
+    Characterization steps as a structured array of (Funct, iVd, iVg, iVgac,
+    Dir, Flags), Funct the index in StepFuncts and Dir 1 for the backward
+    sweep. The kwargs shared by all the steps
+    of a kind (AcqKwargs, Bode test signals, PSD settings) are kept once in
+    Payloads and the step dicts are built when they are executed.
+
+    The rows are in execution order, Next() advances a cursor over them
+    skipping the done and skipped steps. nQueued counts the pending steps
+    after the cursor of each Funct, for EstimateTime.
+    '''
+
+    def __init__(self, Table, VgsSw, VdsSw, Payloads, SweepOrder='Forward'):
+        self.Table = Table
+        self.SweepOrder = SweepOrder
+        self.VgsSw = VgsSw
+        self.VdsSw = VdsSw
+        self.Payloads = Payloads
+        self.RefinePass = 0
+        self.Rewind()
+
+    def Rewind(self):
+        # Execution from the first pending step
+        Pending = self.Table['Flags'] == 0
+        self.Cursor = 0
+        self.nPending = int(np.count_nonzero(Pending))
+        self.nQueued = np.bincount(self.Table['Funct'][Pending],
+                                   minlength=len(StepFuncts))
+
+    def __len__(self):
+        return self.Table.size
+
+    def IsPending(self, Index):
+        return self.Table['Flags'][Index] == 0
+
+    def Remaining(self):
+        return self.nPending
+
+    def GetPending(self):
+        # Pending step indexes after the cursor
+        return np.flatnonzero(self.Table['Flags'][self.Cursor:] == 0) + self.Cursor
+
+    def GetStep(self, Index):
+        Index = int(Index)
+        Funct, iVd, iVg, iVgac, Dir, Flags = self.Table[Index].tolist()
+        Funct = StepFuncts[Funct]
+        if Funct in ('GetIds', 'GetGate'):
+            Kwargs = {'AcqKwargs': self.Payloads['AcqKwargs'],
+                      'Bias': {'Vds': self.VdsSw[iVd],
+                               'Vgs': self.VgsSw[iVg]},
+                      'SweepInds': {'iVd': iVd,
+                                    'iVg': iVg,
+                                    'Dir': Dir}}
+            Info = StepInfo[Funct][Dir]
+        else:
+            Info = StepInfo[Funct]
+            Kwargs = dict(self.Payloads[Info + 'Kwargs'],
+                          iVd=iVd,
+                          iVgac=iVgac)
+        return {'Index': Index,
+                'Funct': Funct,
+                'Kwargs': Kwargs,
+                'Info': '{} Vds {} of {} Vgs {} of {}'.format(Info,
+                                                              iVd + 1, len(self.VdsSw),
+                                                              iVg + 1, len(self.VgsSw))}
+
+    def GetTemplates(self):
+        # First step of each kind, to check the acquisition settings
+        Functs, Inds = np.unique(self.Table['Funct'], return_index=True)
+        return [self.GetStep(i) for i in Inds]
+
+    def Next(self):
+        '''
+        Returns the next pending step dict, None at the end
+        '''
+        Flags = self.Table['Flags']
+        while self.Cursor < Flags.size:
+            Index = self.Cursor
+            self.Cursor += 1
+            if not Flags[Index]:
+                self.nQueued[self.Table['Funct'][Index]] -= 1
+                return self.GetStep(Index)
+        return None
+
+    def SetFlag(self, Indexes, Flag):
+        Indexes = np.unique(Indexes)
+        Pending = Indexes[self.Table['Flags'][Indexes] == 0]
+        self.nPending -= Pending.size
+        # Steps not yet returned by Next()
+        Queued = Pending[Pending >= self.Cursor]
+        np.subtract.at(self.nQueued, self.Table['Funct'][Queued], 1)
+        self.Table['Flags'][Indexes] |= Flag
+
+    def SetDone(self, Indexes):
+        self.SetFlag(Indexes, FlagDone)
+
+    def Skip(self, Indexes):
+        self.SetFlag(Indexes, FlagSkip)
+
+    def AddSteps(self, Rows):
+        # New steps executed after the current ones
+        Rows = np.array(Rows, dtype=StepDType)
+        Inds = np.arange(self.Table.size, self.Table.size + Rows.size)
+        self.Table = np.concatenate((self.Table, Rows))
+        Pending = Rows['Flags'] == 0
+        self.nPending += int(np.count_nonzero(Pending))
+        self.nQueued += np.bincount(Rows['Funct'][Pending],
+                                    minlength=len(StepFuncts))
+        return Inds
+
+    def AddRefineSteps(self, NewVgs):
+        '''
+        Appends NewVgs to the Vgs axis and adds their DC steps (and gate)
+        for every Vds, returns the new Vgs indexes
+        '''
+        iVgs = np.arange(len(self.VgsSw), len(self.VgsSw) + len(NewVgs))
+        self.VgsSw = np.concatenate((self.VgsSw, NewVgs))
+        bGate = np.any(self.Table['Funct'] == StepFuncts.index('GetGate'))
+        Rows = []
+        for iVd in range(len(self.VdsSw)):
+            for iVg in iVgs:
+                Rows.append((0, iVd, iVg, -1, 0, 0))
+                if bGate:
+                    Rows.append((1, iVd, iVg, -1, 0, 0))
+        self.AddSteps(Rows)
+        self.RefinePass += 1
+        return iVgs
+
+    def GetDurations(self, nChannels=16):
+        # Acquisition time of each kind of step, the DC TimeOut is the
+        # worst case
+        Durations = {}
+        AcqKwargs = self.Payloads['AcqKwargs']
+        Durations['GetIds'] = AcqKwargs['TimeOut']
+        Durations['GetGate'] = AcqKwargs['nSamps'] / AcqKwargs['Fs']
+        if self.Payloads.get('BodeKwargs') is not None:
+            Durations['GetBode'] = CalcBodeAcqTime(self.Payloads['BodeKwargs']['TestSigs'],
+                                                   nChannels)
+        if self.Payloads.get('PSDKwargs') is not None:
+            Durations['GetPSD'] = self.Payloads['PSDKwargs']['acqTime']
+        return Durations
+
+    def EstimateTime(self, Durations=None, nChannels=16):
+        '''
+        Time of the pending steps, Durations {Funct: seconds} overrides the
+        configured acquisition times (e.g. with measured ones)
+        '''
+        Times = self.GetDurations(nChannels)
+        if Durations is not None:
+            Times.update(Durations)
+        return float(sum(n * Times.get(f, 0) for f, n in zip(StepFuncts, self.nQueued.tolist())))
+
+
+def BuildCharactSteps(VgsSw, VdsSw, VgsIndexes, AcqKwargs,
+                      BodeKwargs=None, PSDKwargs=None, bGate=False,
+                      SweepOrder='Forward', Refine=None):
+    # The table rows are in the measuring order of the SweepOrder, the AC
+    # steps are only done in the forward sweep
+    Rows = []
+    # iVg to its index in the AC sweep
+    VgsAC = {}
+    for i, iVg in enumerate(VgsIndexes):
+        VgsAC.setdefault(iVg, i)
+    for iVd, iVg, Dir in CalcBiasOrder(VgsSw, VdsSw, SweepOrder):
+        Rows.append((0, iVd, iVg, -1, Dir, 0))
+        if bGate:
+            Rows.append((1, iVd, iVg, -1, Dir, 0))
+
+        if Dir or iVg not in VgsAC:
+            continue
+
+        iVgac = VgsAC[iVg]
+        if BodeKwargs is not None:
+            Rows.append((2, iVd, iVg, iVgac, Dir, 0))
+        if PSDKwargs is not None:
+            Rows.append((3, iVd, iVg, iVgac, Dir, 0))
+
+    return StepTable(Table=np.array(Rows, dtype=StepDType),
+                     VgsSw=VgsSw,
+                     VdsSw=VdsSw,
+                     Payloads={'AcqKwargs': AcqKwargs,
+                               'BodeKwargs': BodeKwargs,
+                               'PSDKwargs': PSDKwargs,
+                               'Refine': Refine},
+                     SweepOrder=SweepOrder)
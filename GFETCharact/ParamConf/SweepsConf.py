@@ -9,6 +9,10 @@ import pyqtgraph.parametertree.parameterTypes as pTypes
 import numpy as np
 
 from GFETCharact.ParamConf.BodeModule import BodeConfig
+from GFETCharact.ParamConf.SweepSteps import (CalcSweepVals, ParseIndexes,
+                                              CalcPSDFreqs, BuildSweepConf,
+                                              BuildCharactSteps, SweepOrders,
+                                              CalcOrdersSettleTime)
 
 ###############################################################################
 # Generic voltage sweep
@@ -90,21 +94,19 @@ class VoltageSweepConfig(pTypes.GroupParameter):
         self.CalcSweep()
 
     def CalcSweep(self):
+        sweep = CalcSweepVals(Start=self.param('Start').value(),
+                              Stop=self.param('Stop').value(),
+                              Points=self.param('Points').value(),
+                              Step=self.param('Step').value(),
+                              bPoints=self.param('bPoints').value())
         if self.param('bPoints').value():
-            sweep = np.linspace(self.param('Start').value(),
-                                self.param('Stop').value(),
-                                self.param('Points').value())
             if len(sweep) > 1:
                 step = np.mean(np.diff(sweep))
             else:
                 step = 0
             self.param('Step').setValue(step,
                                         blockSignal=self.CalcSweep)
-
         else:
-            sweep = np.arange(self.param('Start').value(),
-                              self.param('Stop').value(),
-                              self.param('Step').value())
             self.param('Points').setValue(len(sweep),
                                           blockSignal=self.CalcSweep)
 
@@ -155,6 +157,53 @@ DCMeasureParams = ({'name': 'MaxSlope',
                                'Mean'],
                     'value': 'All channels',
                     'default': 'All channels'},
+                   {'name': 'FitMode',
+                    'title': 'Slope fit',
+                    'type': 'list',
+                    'limits': ['Block',
+                               'Window',
+                               'Forgetting'],
+                    'value': 'Block',
+                    'default': 'Block'},
+                   {'name': 'FitBlocks',
+                    'title': 'Window blocks',
+                    'type': 'int',
+                    'value': 4,
+                    'default': 4,
+                    'limits': (1, 100)},
+                   {'name': 'Forgetting',
+                    'title': 'Forgetting factor',
+                    'type': 'float',
+                    'value': 0.5,
+                    'default': 0.5,
+                    'step': 0.05,
+                    'limits': (0.01, 1)},
+                   {'name': 'Predict',
+                    'title': 'Predict settling',
+                    'type': 'bool',
+                    'value': False,
+                    'default': False},
+                   {'name': 'PredTol',
+                    'title': 'Prediction tolerance',
+                    'type': 'float',
+                    'value': 1e-9,
+                    'step': 1e-10,
+                    'default': 1e-9,
+                    'siPrefix': True,
+                    'suffix': 'A'},
+                   {'name': 'PredMinBlocks',
+                    'title': 'Prediction min. blocks',
+                    'type': 'int',
+                    'value': 5,
+                    'default': 5,
+                    'limits': (4, 1000)},
+                   {'name': 'SettleRate',
+                    'title': 'Settling per volt',
+                    'type': 'float',
+                    'value': 50,
+                    'default': 50,
+                    'limits': (0, 1e4),
+                    'suffix': 's/V'},
                    {'name': 'TimeOut',
                     'title': 'Maximum Time',
                     'type': 'float',
@@ -254,7 +303,7 @@ class PSDConfig(pTypes.GroupParameter):
         FMin = 1 / (2 ** nFFT / Fs)
         self.param('Fmin').setValue(FMin)
         self.on_nAvgChange()
-        self.Freqs = np.fft.rfftfreq(2 ** nFFT, 1 / float(Fs))
+        self.Freqs = CalcPSDFreqs(Fs, nFFT)
 
     def on_nAvgChange(self):
         Fs = self.param('Fs').value()
@@ -309,6 +358,42 @@ class SweepsConfig(pTypes.GroupParameter):
                            'type': 'int',
                            'default': 1,
                            'value': 1},
+                          {'title': 'Sweep Order',
+                           'name': 'SweepOrder',
+                           'type': 'list',
+                           'limits': SweepOrders,
+                           'default': 'Forward',
+                           'value': 'Forward'},
+                          {'title': 'DC Settling by order',
+                           'name': 'OrderSettle',
+                           'type': 'str',
+                           'readonly': True,
+                           'value': ''},
+                          {'title': 'Refine Vgs Points (0 off)',
+                           'name': 'RefinePoints',
+                           'type': 'int',
+                           'default': 0,
+                           'value': 0,
+                           'limits': (0, 100)},
+                          {'title': 'Refine Passes',
+                           'name': 'RefinePasses',
+                           'type': 'int',
+                           'default': 2,
+                           'value': 2,
+                           'limits': (1, 10)},
+                          {'title': 'Refine Min Step',
+                           'name': 'RefineMinStep',
+                           'type': 'float',
+                           'default': 1e-3,
+                           'value': 1e-3,
+                           'siPrefix': True,
+                           'suffix': 'V'},
+                          {'title': 'Analysis Workers',
+                           'name': 'Workers',
+                           'type': 'int',
+                           'default': 0,
+                           'value': 0,
+                           'limits': (0, 8)},
                           {'title': 'Measure PSD',
                            'name': 'CheckPSD',
                            'type': 'bool',
@@ -365,6 +450,10 @@ class SweepsConfig(pTypes.GroupParameter):
         self.cBode.param('acqTime').sigValueChanged.connect(self.on_acqTime)
         self.cPSD.param('acqTime').sigValueChanged.connect(self.on_acqTime)
         self.param('DCConfig').param('TimeOut').sigValueChanged.connect(self.on_acqTime)
+        self.param('DCConfig').param('SettleRate').sigValueChanged.connect(self.on_acqTime)
+        self.param('SweepOrder').sigValueChanged.connect(self.on_acqTime)
+        self.param('RefinePoints').sigValueChanged.connect(self.on_acqTime)
+        self.param('RefinePasses').sigValueChanged.connect(self.on_acqTime)
 
         self.param('CheckPSD').sigValueChanged.connect(self.on_ACCheck)
         self.param('CheckBode').sigValueChanged.connect(self.on_ACCheck)
@@ -403,10 +492,16 @@ class SweepsConfig(pTypes.GroupParameter):
         vdPoints = len(self.VdsVals.SweepVals)
         vgPoints = len(self.VgsVals.SweepVals)
         DCpoints = vdPoints * vgPoints
+        if self.param('SweepOrder').value() == 'Hysteresis':
+            DCpoints *= 2
+        Refine = self.GetRefine()
+        if Refine is not None:
+            DCpoints += vdPoints * Refine['Points'] * Refine['Passes']
         DCt = self.param('DCConfig').param('TimeOut').value()
         dcTime = DCpoints * DCt
 
         self.param('DCTime').setValue(dcTime)
+        self.UpdateOrderSettle()
 
         bodeT = self.cBode.param('acqTime').value()
         psdT = self.cPSD.param('acqTime').value()
@@ -421,6 +516,14 @@ class SweepsConfig(pTypes.GroupParameter):
         self.param('ACTime').setValue(acTime)
         self.param('TTime').setValue(acTime + dcTime)
 
+    def UpdateOrderSettle(self):
+        # Settling estimate of each order, saving relative to Forward
+        Times = CalcOrdersSettleTime(self.VgsVals.SweepVals,
+                                     self.VdsVals.SweepVals,
+                                     self.param('DCConfig').GetParams())
+        self.param('OrderSettle').setValue(', '.join('{} {:.0f} s ({:+.0f} s)'.format(o, t, t - Times['Forward'])
+                                                     for o, t in Times.items()))
+
     def on_VdsSweep(self):
         self.on_acqTime()
 
@@ -436,21 +539,7 @@ class SweepsConfig(pTypes.GroupParameter):
         nVgs = self.VgsVals.param('Points').value()
 
         try:
-            # strind = '0, 9, 2:8, 9:16:2'
-            inds = []
-            for parts in strind.split(','):
-                raargs = []
-                ra = parts.split(':')
-                if len(ra) == 1:
-                    inds.append(int(ra[0]))
-                else:
-                    for r in ra:
-                        raargs.append(int(r))
-                    for i in range(*raargs):
-                        inds.append(i)
-            inds = list(set(sorted(inds)))
-            inds = [x for x in inds if x < nVgs]
-            inds = [x for x in inds if x >= 0]
+            inds = ParseIndexes(strind, nVgs)
         except:
             print('Invalid parsing')
             return
@@ -462,65 +551,36 @@ class SweepsConfig(pTypes.GroupParameter):
         self.on_acqTime()
 
     def GetSweepConf(self):
-        swC = {'VgsSw': self.VgsVals.SweepVals,
-               'VdsSw': self.VdsVals.SweepVals,
-               'Gate': self.bGate
-               }
-
-        if self.bBode or self.bPSD:
-            swC['VgsSwAC'] = self.VgsVals.SweepVals[self.VgsIndexes]
-        if self.bBode:
-            swC['BodeKwarg'] = self.cBode.GetTestSignals()
-        if self.bPSD:
-            swC['PSDKwarg'] = self.cPSD.GetParams()
-        return swC
+        return BuildSweepConf(VgsSw=self.VgsVals.SweepVals,
+                              VdsSw=self.VdsVals.SweepVals,
+                              Gate=self.bGate,
+                              VgsIndexes=self.VgsIndexes,
+                              BodeKwargs=self.cBode.GetTestSignals() if self.bBode else None,
+                              PSDKwargs=self.cPSD.GetParams() if self.bPSD else None,
+                              Predict=self.param('DCConfig').GetParams()['Predict'],
+                              SweepOrder=self.param('SweepOrder').value(),
+                              Refine=self.GetRefine())
+
+    def GetRefine(self):
+        # None, the Vgs sweep is not refined
+        if self.param('RefinePoints').value() == 0:
+            return None
+        return {'Points': self.param('RefinePoints').value(),
+                'Passes': self.param('RefinePasses').value(),
+                'MinStep': self.param('RefineMinStep').value()}
+
+    def GetWorkers(self):
+        # 0, the analysis of each step is done before the next one
+        return self.param('Workers').value()
 
     def GetCharactSteps(self):
-        Steps = []
-
-        AcqKwargs = self.param('DCConfig').GetParams()
-        BodeKwargs = self.cBode.GetTestSignals()
-        PSDKwargs = self.cPSD.GetParams()
-
-        LVd = len(self.VdsVals.SweepVals)
-        LVg = len(self.VgsVals.SweepVals)
-        for iVd, Vd in enumerate(self.VdsVals.SweepVals):
-            for iVg, Vg in enumerate(self.VgsVals.SweepVals):
-                ist = 'Vds {} of {} Vgs {} of {}'.format(iVd + 1, LVd,
-                                                         iVg + 1, LVg)
-                Kwargs = {'AcqKwargs': AcqKwargs,
-                          'Bias': {'Vds': Vd,
-                                   'Vgs': Vg},
-                          'SweepInds': {'iVd': iVd,
-                                        'iVg': iVg}}
-                Steps.append({'Funct': 'GetIds',
-                              'Kwargs': Kwargs,
-                              'Info': 'DCIds {}'.format(ist)})
-
-                if self.bGate:
-                    Steps.append({'Funct': 'GetGate',
-                                  'Kwargs': Kwargs,
-                                  'Info': 'Gate {}'.format(ist)})
-
-                if iVg not in self.VgsIndexes:
-                    continue
-
-                iVgac = self.VgsIndexes.index(iVg)
-                if self.bBode:
-                    bkwargs = BodeKwargs.copy()
-                    bkwargs.update({'iVd': iVd,
-                                    'iVgac': iVgac})
-                    Steps.append({'Funct': 'GetBode',
-                                  'Kwargs': bkwargs,
-                                  'Info': 'Bode {}'.format(ist)})
-
-                if self.bPSD:
-                    pkwargs = PSDKwargs.copy()
-                    pkwargs.update({'iVd': iVd,
-                                    'iVgac': iVgac})
-                    Steps.append({'Funct': 'GetPSD',
-                                  'Kwargs': pkwargs,
-                                  'Info': 'PSD {}'.format(ist)})
-
-        # for s in Steps: print(s)
-        return Steps
+        # Same step generation as the command line runner
+        return BuildCharactSteps(VgsSw=self.VgsVals.SweepVals,
+                                 VdsSw=self.VdsVals.SweepVals,
+                                 VgsIndexes=self.VgsIndexes,
+                                 AcqKwargs=self.param('DCConfig').GetParams(),
+                                 BodeKwargs=self.cBode.GetTestSignals() if self.bBode else None,
+                                 PSDKwargs=self.cPSD.GetParams() if self.bPSD else None,
+                                 bGate=self.bGate,
+                                 SweepOrder=self.param('SweepOrder').value(),
+                                 Refine=self.GetRefine())
@@ -0,0 +1,377 @@
+# -*- coding: utf-8 -*-
+"""
+Continuous raw recording of the time acquisition.
+
+File layout: a RawHeaderSize bytes header, the RawMagic followed by the
+header json (Fs, channels, gains, dtype, nSamples ...) padded with spaces,
+and then the samples as a C order (samples x channels) array, so the data
+can be memory mapped at offset RawHeaderSize.
+
+@author: aguimera
+"""
+
+import json
+import queue
+import threading
+import time
+import numpy as np
+
+RawMagic = b'GFETRAW1'
+RawHeaderSize = 65536
+RawVersion = 1
+MaxGaps = 1000
+# Column names of the AC channels, Ch01 + ACSuffix
+ACSuffix = '-AC'
+
+
+def ReadRawHeader(FileName):
+    with open(FileName, 'rb') as f:
+        Head = f.read(RawHeaderSize)
+    if not Head.startswith(RawMagic):
+        raise ValueError('{} is not a raw recording'.format(FileName))
+    return json.loads(Head[len(RawMagic):].decode())
+
+
+def GetKinds(Header):
+    # DC or AC of each column, Kind for all the columns in former files
+    if 'Kinds' in Header:
+        return Header['Kinds']
+    return [Header.get('Kind', 'DC')] * len(Header['ChNames'])
+
+
+class RawFile():
+    '''
+    Writer of the raw file format. Space is preallocated in chunks of
+    ChunkSamps samples and the header nSamples is updated at each new
+    chunk, so the file of an interrupted recording can be read up to the
+    last chunk. Close() writes the final header and trims the unused
+    space.
+    '''
+
+    def __init__(self, FileName, Fs, ChNames, ChannelMap=None, Gains=None,
+                 dtype='float32', ChunkSamps=2**18, **kwargs):
+        self.FileName = FileName
+        self.dtype = np.dtype(dtype)
+        self.nChannels = len(ChNames)
+        self.ChunkSamps = int(ChunkSamps)
+        self.Header = {'Version': RawVersion,
+                       'Fs': float(Fs),
+                       'ChNames': list(ChNames),
+                       'ChannelMap': ChannelMap,
+                       'Gains': Gains,
+                       'dtype': self.dtype.str,
+                       'nChannels': self.nChannels,
+                       'nSamples': 0,
+                       'Start': time.strftime('%Y-%m-%d %H:%M:%S'),
+                       'Complete': False,
+                       'Gaps': []}
+        # acquisition info, Kinds (DC or AC of each column) and BiasVd for
+        # the scaling
+        self.Header.update(kwargs)
+        self.nSamples = 0
+        self.Capacity = 0
+        self.File = open(FileName, 'w+b')
+        self.WriteHeader()
+
+    @property
+    def SampleBytes(self):
+        return self.dtype.itemsize * self.nChannels
+
+    def WriteHeader(self):
+        self.Header['nSamples'] = self.nSamples
+        Head = RawMagic + json.dumps(self.Header).encode()
+        if len(Head) > RawHeaderSize:
+            raise ValueError('Raw header larger than {} bytes'.format(RawHeaderSize))
+        self.File.seek(0)
+        self.File.write(Head.ljust(RawHeaderSize, b' '))
+        self.File.flush()
+
+    def Allocate(self, nSamples):
+        nChunks = -(-nSamples // self.ChunkSamps)
+        self.Capacity = nChunks * self.ChunkSamps
+        self.File.truncate(RawHeaderSize + self.Capacity * self.SampleBytes)
+        self.WriteHeader()
+
+    def Write(self, Data):
+        n = Data.shape[0]
+        if self.nSamples + n > self.Capacity:
+            self.Allocate(self.nSamples + n)
+        self.File.seek(RawHeaderSize + self.nSamples * self.SampleBytes)
+        self.File.write(np.ascontiguousarray(Data, dtype=self.dtype).tobytes())
+        self.nSamples += n
+
+    def Close(self, **kwargs):
+        if self.File is None:
+            return
+        self.Header.update(kwargs)
+        self.Header['Complete'] = True
+        self.Header['Stop'] = time.strftime('%Y-%m-%d %H:%M:%S')
+        self.File.truncate(RawHeaderSize + self.nSamples * self.SampleBytes)
+        self.WriteHeader()
+        self.File.close()
+        self.File = None
+
+
+class RawRecorder():
+    '''
+    Records the acquired blocks to a RawFile from a writer thread.
+
+    AddData is called by the acquisition with each block, it copies the
+    block to the queue and never waits: when MaxQueue blocks are pending
+    the block is dropped and counted, and the gap is recorded in the file
+    header as [file sample index, lost samples]. Overruns counts the writes
+    slower than the block period, the writer falling behind the
+    acquisition.
+    '''
+
+    def __init__(self, FileName, Fs, ChNames, ChannelMap=None, Gains=None,
+                 dtype='float32', MaxQueue=64, ChunkTime=10, **kwargs):
+        self.Fs = float(Fs)
+        self.RawFile = RawFile(FileName, Fs, ChNames,
+                               ChannelMap=ChannelMap,
+                               Gains=Gains,
+                               dtype=dtype,
+                               ChunkSamps=int(ChunkTime * Fs),
+                               **kwargs)
+        self.Queue = queue.Queue(maxsize=MaxQueue)
+        self.Thread = None
+        self.nOffered = 0
+        self.Gaps = []
+        self.nBlocks = 0
+        self.nDropped = 0
+        self.DroppedSamples = 0
+        self.QueueMax = 0
+        self.Overruns = 0
+        self.WriteTime = 0
+        self.WriteMax = 0
+        self.Error = None
+
+    def Start(self):
+        self.Thread = threading.Thread(target=self.Run,
+                                       name='RawRecorder',
+                                       daemon=True)
+        self.Thread.start()
+
+    def AddData(self, Data):
+        if self.Thread is None:
+            return
+        n = Data.shape[0]
+        try:
+            self.Queue.put_nowait(np.array(Data, dtype=self.RawFile.dtype))
+        except queue.Full:
+            self.AddGap(self.nOffered - self.DroppedSamples, n)
+            self.nDropped += 1
+            self.DroppedSamples += n
+        else:
+            self.QueueMax = max(self.QueueMax, self.Queue.qsize())
+        self.nOffered += n
+
+    def AddGap(self, Index, nSamples):
+        if len(self.Gaps) and self.Gaps[-1][0] == Index:
+            self.Gaps[-1][1] += nSamples
+        elif len(self.Gaps) < MaxGaps:
+            self.Gaps.append([Index, nSamples])
+
+    def Run(self):
+        while True:
+            Data = self.Queue.get()
+            if Data is None:
+                break
+            if self.Error is not None:
+                continue
+            t0 = time.perf_counter()
+            try:
+                self.RawFile.Write(Data)
+            except Exception as e:
+                # disk full or removed, the acquisition keeps running
+                self.Error = str(e)
+                print('WARNING raw recording stopped: {}'.format(e))
+                continue
+            Time = time.perf_counter() - t0
+            self.nBlocks += 1
+            self.WriteTime += Time
+            self.WriteMax = max(self.WriteMax, Time)
+            if Time > Data.shape[0] / self.Fs:
+                self.Overruns += 1
+
+    def Stop(self):
+        '''
+        Writes the queued blocks and closes the file, returns GetStats()
+        '''
+        if self.Thread is not None:
+            self.Queue.put(None)
+            self.Thread.join()
+            self.Thread = None
+        Stats = self.GetStats()
+        self.RawFile.Close(Stats=Stats, Gaps=self.Gaps)
+        return Stats
+
+    def GetStats(self):
+        return {'Blocks': self.nBlocks,
+                'Samples': self.RawFile.nSamples,
+                'Dropped': self.nDropped,
+                'DroppedSamples': self.DroppedSamples,
+                'QueueMax': self.QueueMax,
+                'Overruns': self.Overruns,
+                'WriteMean': self.WriteTime / self.nBlocks if self.nBlocks else 0,
+                'WriteMax': self.WriteMax,
+                'Error': self.Error}
+
+    def GetReport(self):
+        Stats = self.GetStats()
+        return ('Recorded {} s to {}, dropped {} blocks ({} samples), queue max {}, '
+                'overruns {}, write mean {:.2f} ms, max {:.2f} ms').format(Stats['Samples'] / self.Fs,
+                                                                           self.RawFile.FileName,
+                                                                           Stats['Dropped'],
+                                                                           Stats['DroppedSamples'],
+                                                                           Stats['QueueMax'],
+                                                                           Stats['Overruns'],
+                                                                           1e3 * Stats['WriteMean'],
+                                                                           1e3 * Stats['WriteMax'])
+
+
+class RawReader():
+    '''
+    Memory mapped access to a raw recording. Times are in seconds from the
+    first sample of the file, channels given by name.
+
+    GetRaw returns views of the file, without copying, for a single
+    channel or contiguous ones (other selections are copied). GetData
+    returns the currents, (V - BiasVd) / DCGain for the DC columns and
+    V / ACGain for the AC ones, with the gains of the header or Gains.
+    IterChunks walks the file by blocks for the out of core processing.
+    '''
+
+    def __init__(self, FileName, Gains=None):
+        self.FileName = FileName
+        self.Header = ReadRawHeader(FileName)
+        self.Fs = self.Header['Fs']
+        self.ChNames = self.Header['ChNames']
+        self.nSamples = self.Header['nSamples']
+        self.Kinds = GetKinds(self.Header)
+        self.Gains = dict(self.Header['Gains'] or {})
+        if Gains is not None:
+            self.Gains.update(Gains)
+        self.Data = np.memmap(FileName,
+                              dtype=np.dtype(self.Header['dtype']),
+                              mode='r',
+                              offset=RawHeaderSize,
+                              shape=(self.nSamples, len(self.ChNames)))
+        if not self.Header['Complete']:
+            print('WARNING {} was not closed, read up to its last chunk'.format(FileName))
+
+    @property
+    def Duration(self):
+        return self.nSamples / self.Fs
+
+    def GetIndexes(self, tStart=0, tStop=None):
+        Start = min(max(int(round(tStart * self.Fs)), 0), self.nSamples)
+        if tStop is None:
+            return Start, self.nSamples
+        Stop = min(max(int(round(tStop * self.Fs)), Start), self.nSamples)
+        return Start, Stop
+
+    def GetChannels(self, Channels=None):
+        '''
+        Column index or slice of Channels, a name or a list of names
+        '''
+        if Channels is None:
+            return slice(None)
+        if isinstance(Channels, str):
+            return self.ChNames.index(Channels)
+        Inds = [self.ChNames.index(ch) for ch in Channels]
+        if len(Inds) and Inds == list(range(Inds[0], Inds[-1] + 1)):
+            return slice(Inds[0], Inds[-1] + 1)
+        return Inds
+
+    def GetRaw(self, tStart=0, tStop=None, Channels=None):
+        Start, Stop = self.GetIndexes(tStart, tStop)
+        return self.Data[Start:Stop, self.GetChannels(Channels)]
+
+    def GetGain(self, Name):
+        if Name not in self.Gains:
+            raise ValueError('No {} in {}, give it in Gains'.format(Name, self.FileName))
+        return self.Gains[Name]
+
+    def GetKindColumns(self, Kind):
+        return [i for i, k in enumerate(self.Kinds) if k == Kind]
+
+    def Scale(self, Raw, Cols=slice(None)):
+        # Raw of the Cols columns, as given by GetChannels
+        Kinds = np.atleast_1d(np.array(self.Kinds)[Cols])
+        Gain = np.array([self.GetGain(k + 'Gain') for k in Kinds])
+        Offset = np.array([self.Header.get('BiasVd', 0) if k == 'DC' else 0
+                           for k in Kinds])
+        if not isinstance(Cols, (slice, list)):
+            Gain = Gain[0]
+            Offset = Offset[0]
+        return (Raw - Offset) / Gain
+
+    def GetData(self, tStart=0, tStop=None, Channels=None):
+        Cols = self.GetChannels(Channels)
+        Start, Stop = self.GetIndexes(tStart, tStop)
+        return self.Scale(self.Data[Start:Stop, Cols].astype(float), Cols)
+
+    def GetTimes(self, tStart=0, tStop=None):
+        '''
+        Acquisition time of the samples, the dropped blocks (Gaps) are
+        counted
+        '''
+        Start, Stop = self.GetIndexes(tStart, tStop)
+        Inds = np.arange(Start, Stop)
+        Gaps = np.array(self.Header['Gaps'], dtype=int).reshape((-1, 2))
+        Lost = np.concatenate(([0], np.cumsum(Gaps[:, 1])))
+        return (Inds + Lost[np.searchsorted(Gaps[:, 0], Inds, side='right')]) / self.Fs
+
+    def IterChunks(self, ChunkTime=10, tStart=0, tStop=None, Channels=None,
+                   Scaled=True):
+        '''
+        Yields (t0, Data) of consecutive blocks of ChunkTime seconds
+        '''
+        Start, Stop = self.GetIndexes(tStart, tStop)
+        ChunkSamps = max(int(ChunkTime * self.Fs), 1)
+        Cols = self.GetChannels(Channels)
+        for i in range(Start, Stop, ChunkSamps):
+            Raw = self.Data[i:min(i + ChunkSamps, Stop), Cols]
+            yield i / self.Fs, self.Scale(Raw.astype(float), Cols) if Scaled else Raw
+
+    def GetBoard(self):
+        return RawBoard(self.Header)
+
+    def Close(self):
+        # the memmap is closed once the views taken from it are released
+        self.Data = None
+
+
+class RawBoard():
+    '''
+    Stands for the HardwareConfig of the recording, the channels and
+    gains used by AcqPlotter for playback
+    '''
+
+    def __init__(self, Header):
+        self.Header = Header
+        self.Gains = self
+        self.AInputs = self
+
+    def GetGains(self):
+        return dict(self.Header['Gains'] or {})
+
+    def GetChannels(self, Kind):
+        # {channel: ai}, the AC columns without the ACSuffix
+        Map = self.Header['ChannelMap'] or {}
+        Chs = {}
+        for ch, k in zip(self.Header['ChNames'], GetKinds(self.Header)):
+            if k != Kind:
+                continue
+            Name = ch
+            if k == 'AC' and ch.endswith(ACSuffix):
+                Name = ch[:-len(ACSuffix)]
+            Chs[Name] = Map.get(ch)
+        return Chs
+
+    def GetDCChannels(self):
+        return self.GetChannels('DC')
+
+    def GetACChannels(self):
+        return self.GetChannels('AC')
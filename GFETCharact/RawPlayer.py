@@ -0,0 +1,92 @@
+# -*- coding: utf-8 -*-
+"""
+Playback of raw recordings in the acquisition time view.
+
+    python -m GFETCharact.RawPlayer Data/Rec01.raw --speed 2 --start 60
+
+@author: aguimera
+"""
+
+import argparse
+import sys
+import time
+from PyQt5 import Qt
+from qtpy import QtWidgets
+
+from GFETCharact.AcqTimePlot import AcqPlotter
+from GFETCharact.RawFile import RawReader
+
+
+class RawPlayer(Qt.QObject):
+    '''
+    Feeds a RawReader to an AcqPlotter as the acquisition does, the
+    position follows the wall clock times Speed so slow frames do not
+    delay the playback. The currents are plotted, as in the live view, or
+    the voltages as read with Scaled False.
+    '''
+    PlayFinished = Qt.pyqtSignal()
+
+    def __init__(self, FileName, Speed=1.0, tStart=0, tBufferView=60,
+                 Period=0.05, Scaled=True):
+        super(RawPlayer, self).__init__()
+        self.Reader = RawReader(FileName)
+        self.Speed = Speed
+        self.Scaled = Scaled
+        self.iPos = self.Reader.GetIndexes(tStart)[0]
+        self.iStart = self.iPos
+        self.Plotter = AcqPlotter(SampSettings={'Fs': self.Reader.Fs,
+                                                'tBufferView': tBufferView},
+                                  HardConf=self.Reader.GetBoard())
+        self.Plotter.DCView.Wind.setWindowTitle('Playback {}'.format(FileName))
+        self.DCCols = self.Reader.GetKindColumns('DC')
+        self.ACCols = self.Reader.GetKindColumns('AC')
+        self.Timer = Qt.QTimer(self)
+        self.Timer.timeout.connect(self.on_Timer)
+        self.Period = Period
+        self.WallStart = None
+
+    def Start(self):
+        self.WallStart = time.perf_counter()
+        self.iStart = self.iPos
+        self.Timer.start(int(self.Period * 1000))
+        self.Plotter.Start()
+
+    def Stop(self):
+        self.Timer.stop()
+
+    def on_Timer(self):
+        iNext = self.iStart + int((time.perf_counter() - self.WallStart) * self.Speed * self.Reader.Fs)
+        iNext = min(iNext, self.Reader.nSamples)
+        if iNext > self.iPos:
+            Data = self.Reader.Data[self.iPos:iNext]
+            if self.Scaled:
+                Data = self.Reader.Scale(Data.astype(float))
+            ACData = Data[:, self.ACCols] if len(self.ACCols) else None
+            self.Plotter.AddData(Data[:, self.DCCols], ACData)
+            self.iPos = iNext
+        if self.iPos >= self.Reader.nSamples:
+            self.Stop()
+            self.PlayFinished.emit()
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Raw recording playback')
+    parser.add_argument('FileName')
+    parser.add_argument('--speed', default=1.0, type=float)
+    parser.add_argument('--start', default=0, type=float,
+                        help='Start time [s]')
+    parser.add_argument('--raw', action='store_true',
+                        help='Plot the voltages as read')
+    args = parser.parse_args()
+
+    app = QtWidgets.QApplication(sys.argv)
+    Player = RawPlayer(args.FileName,
+                       Speed=args.speed,
+                       tStart=args.start,
+                       Scaled=not args.raw)
+    Player.Start()
+    sys.exit(app.exec_())
+
+
+if __name__ == "__main__":
+    main()
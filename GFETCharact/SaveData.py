@@ -8,40 +8,118 @@ Created on Tue Feb  1 10:20:05 2022
 import numpy as np
 import datetime
 import pickle
+import json
+import os
+
+ManifestFile = 'manifest.json'
+StepsFile = 'steps.pkl'
+ProgressFile = 'progress.npy'
+ManifestVersion = 1
+
+
+def DataDirName(FileName):
+    # Directory holding the incremental data of a characterization file
+    return os.path.splitext(FileName)[0] + '_data'
+
+
+def GetFreeFileName(FileName):
+    # Appends -Cy_xx until neither the file nor its data directory exist
+    pathfile, file = os.path.split(FileName)
+    filename, extension = os.path.splitext(file)
+    counter = 1
+    filename = filename.split('-Cy_')[0]
+    while (os.path.exists(FileName) or
+           os.path.exists(DataDirName(FileName))):
+        fn = '{0}-Cy_{1:02}{2}'.format(filename, counter, extension)
+        FileName = os.path.join(pathfile, fn)
+        counter += 1
+    return FileName
+
+
+def WriteJson(FileName, Data):
+    # Atomic replace, the previous file is kept if the write fails
+    tmp = FileName + '.tmp'
+    with open(tmp, 'w') as f:
+        json.dump(Data, f, indent=1)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp, FileName)
 
 
 class CharactFile():
+    '''
+    Characterization data stored as a directory of .npy arrays plus a json
+    manifest that describes the DictDC/DictAC layout.
+
+    The Ids, Slope, PSD and gm arrays are memory mapped, so each step only
+    writes the slice it changed and Flush() syncs the touched pages to disk.
+    The done steps are flagged in the Progress memmap, one byte per step of
+    steps.pkl, the manifest is only written for the layout and completion.
+    SavePickle exports the former {'DevDC', 'DevAC'} pickle layout.
+    '''
+
     def __init__(self, FileName, SweepConf, ChNames):
         self.FileName = FileName
+        if FileName is not None:
+            self.DirName = DataDirName(FileName)
+            os.makedirs(self.DirName, exist_ok=True)
+        else:
+            self.DirName = None
+        self.Arrays = {}
+        self.DataArrays = []
+        self.Manifest = {}
+        self.Progress = None
+        self.Saves = 0
+
         Time = datetime.datetime.now()
 
-        self.ChNames = ChNames
+        self.ChNames = list(ChNames)
         VgsSw = SweepConf['VgsSw']
         VdsSw = SweepConf['VdsSw']
         self.DictDC = {}
-        IdsShape = (len(VgsSw), len(VdsSw))
-        for ch in ChNames:
-            self.DictDC[ch] = {'Ids': np.ones(IdsShape)*np.nan,
-                               'Slope': np.ones(IdsShape)*np.nan,
+        nVgs = SweepConf.get('VgsMax', len(VgsSw))
+        if nVgs > len(VgsSw):
+            # Adaptive sweep, the Vgs axis grows in the NaN slots
+            VgsAxis = self.NewArray(('DC', 'Vgs'), (nVgs, ))
+            VgsAxis[:len(VgsSw)] = VgsSw
+            VgsSw = VgsAxis
+        IdsShape = (nVgs, len(VdsSw))
+        Hysteresis = SweepConf.get('SweepOrder') == 'Hysteresis'
+        for ch in self.ChNames:
+            self.DictDC[ch] = {'Ids': self.NewArray(('DC', ch, 'Ids'), IdsShape),
+                               'Slope': self.NewArray(('DC', ch, 'Slope'), IdsShape),
                                'Vds': VdsSw,
                                'Vgs': VgsSw,
                                'ChName': ch,
                                'Name': ch,
                                'DateTime': Time}
+            if SweepConf.get('Predict', False):
+                # Settled Ids predicted by the exponential model
+                self.DictDC[ch]['IdsPred'] = self.NewArray(('DC', ch, 'IdsPred'),
+                                                           IdsShape)
+            if Hysteresis:
+                # Backward Vgs sweep
+                for k in list(self.DictDC[ch].keys()):
+                    if k in ('Ids', 'Slope', 'IdsPred'):
+                        self.DictDC[ch][k + 'Back'] = self.NewArray(('DC', ch, k + 'Back'),
+                                                                    IdsShape)
 
         if SweepConf['Gate']:
-            self.DictDC['Gate'] = {'Ig': np.ones(IdsShape)*np.nan,
+            self.DictDC['Gate'] = {'Ig': self.NewArray(('DC', 'Gate', 'Ig'), IdsShape),
                                    'Vds': VdsSw,
                                    'Vgs': VgsSw,
                                    'ChName': 'Gate',
                                    'Name': 'Gate',
                                    'DateTime': Time}
+            if Hysteresis:
+                self.DictDC['Gate']['IgBack'] = self.NewArray(('DC', 'Gate', 'IgBack'),
+                                                              IdsShape)
 
         if 'VgsSwAC' in SweepConf:
             self.DictAC = {}
             VgsSwAC = SweepConf['VgsSwAC']
 
-            for ch in ChNames:
+            for ch in self.ChNames:
                 Vals = {'VgsAC': VgsSwAC,
                         'VdsAC': VdsSw,
                         'ChName': ch,
@@ -53,7 +131,8 @@ class CharactFile():
                     PSDshape = (len(VgsSwAC), nFpsd.size)
                     noise = {}
                     for i in range(VdsSw.size):
-                        noise['Vd{}'.format(i)] = np.ones(PSDshape) * np.nan
+                        vd = 'Vd{}'.format(i)
+                        noise[vd] = self.NewArray(('AC', ch, 'PSD', vd), PSDshape)
                     Vals['Fpsd'] = nFpsd
                     Vals['PSD'] = noise
 
@@ -62,7 +141,9 @@ class CharactFile():
                     gm = {}
                     BodeShape = (len(VgsSwAC), nFgm.size)
                     for i in range(VdsSw.size):
-                        gm['Vd{}'.format(i)] = np.ones(BodeShape) * np.nan * complex(1)
+                        vd = 'Vd{}'.format(i)
+                        gm[vd] = self.NewArray(('AC', ch, 'gm', vd), BodeShape,
+                                               dtype=complex)
                     Vals['Fgm'] = nFgm
                     Vals['gm'] = gm
 
@@ -70,8 +151,262 @@ class CharactFile():
         else:
             self.DictAC = None
 
-    def SavePickle(self):
-        if self.FileName is not None:
-            Data = {'DevDC': self.DictDC,
-                    'DevAC': self.DictAC}
-            pickle.dump(Data, open(self.FileName, 'wb'))
+        if self.DirName is not None:
+            self.Manifest = {'Version': ManifestVersion,
+                             'DateTime': Time.isoformat(),
+                             'ChNames': self.ChNames,
+                             'DevDC': self.EncodeLayout(self.DictDC),
+                             'DevAC': self.EncodeLayout(self.DictAC),
+                             'SweepOrder': SweepConf.get('SweepOrder', 'Forward'),
+                             'Saves': 0,
+                             'Complete': False}
+            self.WriteManifest()
+
+    @staticmethod
+    def ArrayName(Path):
+        return '-'.join(Path)
+
+    def NewArray(self, Path, shape, dtype=float):
+        Name = self.ArrayName(Path)
+        Fill = np.nan * complex(1) if dtype is complex else np.nan
+        if self.DirName is None:
+            arr = np.ones(shape, dtype=dtype) * Fill
+        else:
+            fname = os.path.join(self.DirName, Name + '.npy')
+            arr = np.lib.format.open_memmap(fname, mode='w+',
+                                            dtype=dtype, shape=shape)
+            arr[...] = Fill
+            arr.flush()
+        self.Arrays[Name] = arr
+        self.DataArrays.append(Name)
+        return arr
+
+    def EncodeLayout(self, Dict):
+        if Dict is None:
+            return None
+        Ids = {id(a): n for n, a in self.Arrays.items()}
+        Layout = {}
+        for k, v in Dict.items():
+            if isinstance(v, dict):
+                Layout[k] = {'Dict': self.EncodeLayout(v)}
+            elif isinstance(v, np.ndarray):
+                Name = Ids.get(id(v))
+                if Name is None:
+                    # Shared array (sweep or frequency vectors), saved once
+                    Name = 'Shared{}'.format(len(self.Arrays))
+                    np.save(os.path.join(self.DirName, Name + '.npy'), v)
+                    self.Arrays[Name] = v
+                    Ids[id(v)] = Name
+                Layout[k] = {'Array': Name}
+            elif isinstance(v, datetime.datetime):
+                Layout[k] = {'DateTime': v.isoformat()}
+            else:
+                Layout[k] = {'Value': v}
+        return Layout
+
+    def DecodeLayout(self, Layout, Mode):
+        if Layout is None:
+            return None
+        Dict = {}
+        for k, v in Layout.items():
+            if 'Dict' in v:
+                Dict[k] = self.DecodeLayout(v['Dict'], Mode)
+            elif 'Array' in v:
+                Name = v['Array']
+                if Name not in self.Arrays:
+                    fname = os.path.join(self.DirName, Name + '.npy')
+                    if Name.startswith('Shared'):
+                        self.Arrays[Name] = np.load(fname)
+                    else:
+                        self.Arrays[Name] = np.load(fname, mmap_mode=Mode)
+                        self.DataArrays.append(Name)
+                Dict[k] = self.Arrays[Name]
+            elif 'DateTime' in v:
+                Dict[k] = datetime.datetime.fromisoformat(v['DateTime'])
+            else:
+                Dict[k] = v['Value']
+        return Dict
+
+    @classmethod
+    def Open(cls, FileName, Mode='r+'):
+        '''
+        Opens an existing data directory, FileName can be the pickle file
+        name or the data directory
+        '''
+        self = cls.__new__(cls)
+        if os.path.isdir(FileName):
+            self.DirName = FileName
+            self.FileName = FileName.rsplit('_data', 1)[0] + '.pkl'
+        else:
+            self.FileName = FileName
+            self.DirName = DataDirName(FileName)
+        self.Arrays = {}
+        self.DataArrays = []
+        with open(os.path.join(self.DirName, ManifestFile), 'r') as f:
+            self.Manifest = json.load(f)
+        self.ChNames = self.Manifest['ChNames']
+        self.DictDC = self.DecodeLayout(self.Manifest['DevDC'], Mode)
+        self.DictAC = self.DecodeLayout(self.Manifest['DevAC'], Mode)
+        self.Saves = self.Manifest['Saves']
+        self.Progress = None
+        if 'Checkpoint' in self.Manifest:
+            self.Progress = np.load(os.path.join(self.DirName, ProgressFile),
+                                    mmap_mode=Mode)
+        return self
+
+    def WriteManifest(self):
+        if self.DirName is None:
+            return
+        WriteJson(os.path.join(self.DirName, ManifestFile), self.Manifest)
+
+    def Flush(self, *Paths, Step=None):
+        '''
+        Syncs the arrays given by their paths, ('DC', 'Ch01', 'Ids'), and
+        then flags Step, the index of the completed characterization step,
+        in the Progress checkpoint.
+        '''
+        if self.DirName is None:
+            return
+        for p in Paths:
+            self.Arrays[self.ArrayName(p)].flush()
+        self.Saves += 1
+        if Step is not None and self.Progress is not None:
+            self.Progress[int(Step)] = 1
+            self.Progress.flush()
+
+    def WriteProgress(self, Done):
+        # Atomic replace of the progress flags, reopened as a memmap
+        fname = os.path.join(self.DirName, ProgressFile)
+        self.Progress = None
+        with open(fname + '.tmp', 'wb') as f:
+            np.save(f, Done)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(fname + '.tmp', fname)
+        self.Progress = np.load(fname, mmap_mode='r+')
+
+    def AddVgs(self, NewVgs):
+        '''
+        Writes NewVgs in the free slots of the adaptive Vgs axis, returns
+        their indexes
+        '''
+        Vgs = self.GetVgsAxis()
+        Free = np.where(np.isnan(Vgs))[0][:len(NewVgs)]
+        Vgs[Free] = NewVgs[:Free.size]
+        if isinstance(Vgs, np.memmap):
+            Vgs.flush()
+        return Free
+
+    def IsAdaptive(self):
+        # The Vgs axis of an adaptive sweep is a data array with NaN slots
+        return self.ArrayName(('DC', 'Vgs')) in self.Arrays
+
+    def GetVgsAxis(self):
+        return self.DictDC[self.ChNames[0]]['Vgs']
+
+    def SaveSteps(self, Steps):
+        # The step list is saved once, Progress flags its done steps
+        if self.DirName is None:
+            return
+        with open(os.path.join(self.DirName, StepsFile), 'wb') as f:
+            pickle.dump(Steps, f)
+        self.WriteProgress(np.zeros(len(Steps), dtype=np.uint8))
+        self.Manifest['Checkpoint'] = {'nSteps': len(Steps)}
+        self.WriteManifest()
+
+    def UpdateSteps(self, Steps):
+        # Steps added during the run (adaptive sweep), the progress is kept
+        if self.DirName is None:
+            return
+        with open(os.path.join(self.DirName, StepsFile), 'wb') as f:
+            pickle.dump(Steps, f)
+        Done = np.zeros(len(Steps), dtype=np.uint8)
+        Done[:self.Progress.size] = self.Progress
+        self.WriteProgress(Done)
+        self.Manifest['Checkpoint']['nSteps'] = len(Steps)
+        self.WriteManifest()
+
+    def LoadSteps(self):
+        with open(os.path.join(self.DirName, StepsFile), 'rb') as f:
+            return pickle.load(f)
+
+    def GetPendingSteps(self):
+        # StepTable with the checkpointed steps marked as done, the table
+        # saved by UpdateSteps has the cursor of the run
+        Steps = self.LoadSteps()
+        Steps.SetDone(np.flatnonzero(self.Progress))
+        Steps.Rewind()
+        return Steps
+
+    def Close(self, Complete=True):
+        if self.DirName is None:
+            return
+        for n in self.DataArrays:
+            arr = self.Arrays[n]
+            if isinstance(arr, np.memmap):
+                arr.flush()
+        if self.Progress is not None:
+            self.Progress.flush()
+        self.Manifest['Saves'] = self.Saves
+        self.Manifest['Complete'] = Complete
+        self.WriteManifest()
+
+    def SavePickle(self, FileName=None):
+        # Export to the former pickle layout
+        if FileName is None:
+            FileName = self.FileName
+        if FileName is not None:
+            DevDC = CopyDict(self.DictDC)
+            if self.IsAdaptive():
+                DevDC = SortVgsAxis(DevDC)
+            Data = {'DevDC': DevDC,
+                    'DevAC': CopyDict(self.DictAC)}
+            with open(FileName, 'wb') as f:
+                pickle.dump(Data, f)
+
+
+def CopyDict(Dict):
+    # Plain in memory copy, memmaps are not pickled as arrays
+    if Dict is None:
+        return None
+    Out = {}
+    for k, v in Dict.items():
+        if isinstance(v, dict):
+            Out[k] = CopyDict(v)
+        elif isinstance(v, np.ndarray):
+            Out[k] = np.array(v)
+        else:
+            Out[k] = v
+    return Out
+
+
+# DC data indexed by Vgs in its first axis, with their Back arrays
+VgsDataKeys = ('Ids', 'Slope', 'IdsPred', 'Ig')
+
+
+def SortVgsAxis(DictDC):
+    '''
+    Sorts the DC data of an adaptive sweep by Vgs, dropping the unused
+    slots, as a uniform sweep for the analysis scripts. Only for adaptive
+    sweeps, the order of a uniform sweep is kept.
+    '''
+    Vgs = DictDC[list(DictDC.keys())[0]]['Vgs']
+    Order = np.argsort(Vgs)[:np.count_nonzero(~np.isnan(Vgs))]
+    if Order.size == Vgs.size and np.all(Order == np.arange(Vgs.size)):
+        return DictDC
+    for Ch in DictDC.values():
+        for k, v in Ch.items():
+            # Vds has the same size when len(VdsSw) == VgsMax
+            if k == 'Vgs' or k.startswith(VgsDataKeys):
+                Ch[k] = v[Order]
+    return DictDC
+
+
+def ExportPickle(DirName, FileName=None):
+    '''
+    Exports an incremental data directory to the {'DevDC', 'DevAC'}
+    pickle layout used by the analysis scripts
+    '''
+    Data = CharactFile.Open(DirName, Mode='r')
+    Data.SavePickle(FileName)
+    return Data.FileName if FileName is None else FileName
@@ -0,0 +1,136 @@
+# -*- coding: utf-8 -*-
+"""
+Spectral estimators used by the characterization steps.
+
+@author: aguimera
+"""
+
+import math
+import numpy as np
+
+
+class WelchAccumulator():
+    '''
+    Streaming Welch PSD estimate of (samples x channels) blocks.
+
+    Data can be added in blocks of any size, each complete segment is
+    windowed, FFT'd and added to a running sum, so only one segment is kept
+    in memory. The result is the same as
+
+        scipy.signal.welch(x, fs=Fs, window='hann', nperseg=nPerSeg,
+                           noverlap=nPerSeg//2, detrend='constant',
+                           scaling='density', axis=0)
+
+    over all the data added since the last Reset().
+    '''
+
+    def __init__(self, nPerSeg, Fs, nChannels, nOverlap=None):
+        self.nPerSeg = int(nPerSeg)
+        if nOverlap is None:
+            nOverlap = self.nPerSeg // 2
+        self.nOverlap = int(nOverlap)
+        self.Step = self.nPerSeg - self.nOverlap
+        self.Fs = float(Fs)
+        self.nChannels = nChannels
+
+        # Periodic hann window, as scipy.signal.get_window('hann', n)
+        n = np.arange(self.nPerSeg)
+        self.Window = 0.5 - 0.5 * np.cos(2 * np.pi * n / self.nPerSeg)
+        self.Scale = 1 / (self.Fs * np.sum(self.Window ** 2))
+        self.Freqs = np.fft.rfftfreq(self.nPerSeg, 1 / self.Fs)
+
+        self.Seg = np.zeros((self.nPerSeg, nChannels))
+        self.Acc = np.zeros((self.Freqs.size, nChannels))
+        self.Reset()
+
+    def Reset(self):
+        self.Acc[:] = 0
+        self.nPending = 0
+        self.nSegs = 0
+
+    def AddData(self, Data):
+        ind = 0
+        nData = Data.shape[0]
+        while ind < nData:
+            n = min(self.nPerSeg - self.nPending, nData - ind)
+            self.Seg[self.nPending:self.nPending + n, :] = Data[ind:ind + n, :]
+            self.nPending += n
+            ind += n
+            if self.nPending == self.nPerSeg:
+                self.AddSegment()
+                # the overlap is the start of the next segment
+                self.Seg[:self.nOverlap, :] = self.Seg[self.Step:, :]
+                self.nPending = self.nOverlap
+
+    def AddSegment(self):
+        x = self.Seg - self.Seg.mean(axis=0)
+        x *= self.Window[:, None]
+        X = np.fft.rfft(x, axis=0)
+        self.Acc += X.real ** 2 + X.imag ** 2
+        self.nSegs += 1
+
+    def GetPSD(self):
+        '''
+        Returns (Freqs, PSD) with the mean of the accumulated segments,
+        NaN if none is complete yet
+        '''
+        if self.nSegs == 0:
+            return self.Freqs, np.full(self.Acc.shape, np.nan)
+        psd = self.Acc * (self.Scale / self.nSegs)
+        # one sided
+        if self.nPerSeg % 2:
+            psd[1:] *= 2
+        else:
+            psd[1:-1] *= 2
+        return self.Freqs, psd
+
+
+def AvgSegments(Data, nFFT):
+    # Mean of the nFFT segments (samples x channels), the FFT is linear so
+    # the spectrum of the mean is the mean of the spectra
+    nAvg = Data.shape[0] // nFFT
+    return Data[:nAvg * nFFT, :].reshape((nAvg, nFFT, -1)).mean(axis=0)
+
+
+def BinsDFT(Seg, FFTInds, nFFT):
+    '''
+    DFT of the (nFFT x channels) segment only at the FFTInds bins.
+
+    The segment is split in nb blocks of B samples, exp(-jw(bB + i)) =
+    exp(-jwbB) exp(-jwi), so only B + nb phasors are computed per bin and
+    the block sums are a single batched matmul.
+    '''
+    nChannels = Seg.shape[1]
+    B = math.gcd(nFFT, 2 ** int(np.ceil(np.log2(np.sqrt(nFFT)))))
+    nb = nFFT // B
+    nBins = len(FFTInds)
+    w = 2 * np.pi * np.asarray(FFTInds, dtype=float) / nFFT
+    wi = np.outer(w, np.arange(B))
+    Base = np.vstack((np.cos(wi), np.sin(wi)))
+    R = np.matmul(Base, Seg.reshape((nb, B, nChannels)))
+    Blocks = R[:, :nBins, :] - 1j * R[:, nBins:, :]
+    Rot = np.exp(-1j * np.outer(np.arange(nb) * B, w))
+    return np.einsum('bkc,bk->kc', Blocks, Rot)
+
+
+# The DFT at the bins is used below DFTBinsFactor * log2(nFFT) tones, it
+# is faster than the full rfft up to ~4 * log2(nFFT) tones with one channel
+# and more with 16 (Benchmarks.BenchBodeDemod)
+DFTBinsFactor = 2
+
+
+def DemodBode(Data, nFFT, FFTInds, FFTAmps, **kwargs):
+    '''
+    Demodulates the multi-tone response of all channels at once.
+
+    Data is (nAvg * nFFT x channels), returns the (tones x channels)
+    transfer function, the mean segment spectrum (2 * rfft / nFFT) at the
+    tone bins divided by FFTAmps. A single rfft of the averaged segment is
+    used, or a DFT only at the tone bins when there are few tones.
+    '''
+    Seg = AvgSegments(Data, nFFT)
+    if len(FFTInds) < DFTBinsFactor * np.log2(nFFT):
+        X = BinsDFT(Seg, FFTInds, nFFT)
+    else:
+        X = np.fft.rfft(Seg, axis=0)[FFTInds, :]
+    return (2 / nFFT) * X / np.asarray(FFTAmps)[:, None]
@@ -0,0 +1,57 @@
+# -*- coding: utf-8 -*-
+"""
+Bounded status log of the characterization.
+
+@author: aguimera
+"""
+
+from collections import deque
+from datetime import datetime
+
+StatusLogFile = 'Status.log'
+
+
+class StatusLog():
+    '''
+    Keeps the last MaxLines status messages, the full history can be
+    appended to a file with SetFile(). Listeners are called with each new
+    message, Clear() also calls them with None.
+    '''
+
+    def __init__(self, MaxLines=1000, FileName=None):
+        self.Lines = deque(maxlen=MaxLines)
+        self.nLines = 0
+        self.Listeners = []
+        self.File = None
+        self.SetFile(FileName)
+
+    def AddListener(self, Funct):
+        self.Listeners.append(Funct)
+
+    def SetFile(self, FileName):
+        if self.File is not None:
+            self.File.close()
+            self.File = None
+        if FileName is not None:
+            self.File = open(FileName, 'a')
+
+    def Add(self, Text):
+        self.Lines.append(Text)
+        self.nLines += 1
+        if self.File is not None:
+            self.File.write('{:%Y-%m-%d %H:%M:%S} {}\n'.format(datetime.now(),
+                                                             Text))
+            self.File.flush()
+        for l in self.Listeners:
+            l(Text)
+
+    def Clear(self):
+        self.Lines.clear()
+        for l in self.Listeners:
+            l(None)
+
+    def GetText(self):
+        return '\n'.join(self.Lines)
+
+    def Close(self):
+        self.SetFile(None)
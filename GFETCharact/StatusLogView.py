@@ -0,0 +1,53 @@
+# -*- coding: utf-8 -*-
+"""
+Status log widget.
+
+@author: aguimera
+"""
+
+from collections import deque
+from PyQt5 import Qt
+
+
+class StatusLogView(Qt.QPlainTextEdit):
+    '''
+    Read only view of a StatusLog. New messages are queued and appended to
+    the end of the document at most every RefreshTime ms, the document is
+    limited to the MaxLines of the log, so each message costs the same
+    whatever the length of the history.
+    '''
+
+    def __init__(self, Log, RefreshTime=200, parent=None):
+        super(StatusLogView, self).__init__(parent)
+        self.Log = Log
+        self.setReadOnly(True)
+        self.setMaximumBlockCount(Log.Lines.maxlen)
+        self.Pending = deque(maxlen=Log.Lines.maxlen)
+        self.bClear = False
+
+        self.Timer = Qt.QTimer(self)
+        self.Timer.timeout.connect(self.on_Refresh)
+        self.Timer.start(RefreshTime)
+
+        self.Pending.extend(Log.Lines)
+        Log.AddListener(self.on_Message)
+
+    def on_Message(self, Text):
+        if Text is None:
+            self.Pending.clear()
+            self.bClear = True
+        else:
+            self.Pending.append(Text)
+
+    def on_Refresh(self):
+        if self.bClear:
+            self.clear()
+            self.bClear = False
+        if not len(self.Pending):
+            return
+        Lines = []
+        while len(self.Pending):
+            Lines.append(self.Pending.popleft())
+        self.appendPlainText('\n'.join(Lines))
+        Bar = self.verticalScrollBar()
+        Bar.setValue(Bar.maximum())
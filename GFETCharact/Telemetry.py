@@ -0,0 +1,199 @@
+# -*- coding: utf-8 -*-
+"""
+Per step timing telemetry of the characterization, logged as json lines,
+and the profile summary of a run.
+
+@author: aguimera
+"""
+
+import json
+import time
+import numpy as np
+
+TelemetryFile = 'Telemetry.jsonl'
+
+StepTimes = ('Acq', 'Settle', 'Analysis', 'Queue', 'Save', 'Plot')
+
+
+class CallbackMonitor():
+    '''
+    Arrival times of the DAQ EveryN callbacks. Latency is the delay of each
+    callback after the end of its block, Start() time plus (k+1) periods,
+    jitter the standard deviation of the intervals between callbacks.
+
+    A step made of several acquisitions (sequential Bode channels) calls
+    NewSegment() at each one, the latencies are relative to the start of
+    their segment and the stats merge all the segments of the step.
+    '''
+
+    def __init__(self):
+        self.Start(Period=None)
+
+    def Start(self, Period):
+        self.Period = Period
+        self.Segments = []
+        self.NewSegment()
+
+    def NewSegment(self):
+        self.t0 = time.perf_counter()
+        self.Times = []
+        self.Segments.append((self.t0, self.Times))
+
+    def Tick(self):
+        self.Times.append(time.perf_counter())
+
+    def GetStats(self):
+        if self.Period is None:
+            return None
+        Latency = []
+        Intervals = []
+        for t0, Times in self.Segments:
+            Times = np.array(Times) - t0
+            Latency.append(Times - self.Period * np.arange(1, Times.size + 1))
+            Intervals.append(np.diff(Times))
+        Latency = np.concatenate(Latency)
+        Intervals = np.concatenate(Intervals)
+        n = Latency.size
+        if n == 0:
+            return None
+        Stats = {'n': n,
+                 'Period': self.Period,
+                 'Latency': float(np.mean(Latency)),
+                 'MaxLatency': float(np.max(Latency))}
+        if len(self.Segments) > 1:
+            Stats['Segments'] = len(self.Segments)
+        if Intervals.size:
+            Stats['Interval'] = float(np.mean(Intervals))
+            Stats['Jitter'] = float(np.std(Intervals))
+        return Stats
+
+
+class StepTelemetry():
+    '''
+    One record per characterization step, written as a json line when the
+    step is saved, or at Close() if it was never completed. Times are in
+    seconds, Start relative to the beginning of the run.
+    '''
+
+    def __init__(self, FileName=None):
+        self.FileName = FileName
+        self.File = None
+        if FileName is not None:
+            self.File = open(FileName, 'a')
+        self.StartTime = time.perf_counter()
+        self.Steps = {}
+        self.FunctTimes = {}
+        self.nWritten = 0
+        self.Write({'Event': 'Start',
+                    'Time': time.strftime('%Y-%m-%d %H:%M:%S')})
+
+    def Write(self, Record):
+        if self.File is None:
+            return
+        self.File.write(json.dumps(Record) + '\n')
+        self.File.flush()
+
+    def BeginStep(self, Step):
+        self.Steps[Step['Index']] = {'Event': 'Step',
+                                     'Index': Step['Index'],
+                                     'Funct': Step['Funct'],
+                                     'Info': Step['Info'],
+                                     'Start': time.perf_counter() - self.StartTime}
+
+    def Update(self, Index, **kwargs):
+        if Index in self.Steps:
+            self.Steps[Index].update(kwargs)
+
+    def AddTime(self, Index, Key, Time):
+        if Index in self.Steps:
+            self.Steps[Index][Key] = self.Steps[Index].get(Key, 0) + Time
+
+    def EndStep(self, Index, Complete=True, **kwargs):
+        Record = self.Steps.pop(Index, None)
+        if Record is None:
+            return
+        Record.update(kwargs)
+        Record['Complete'] = Complete
+        self.Write(Record)
+        self.nWritten += 1
+        if Complete:
+            Time = sum(Record.get(k, 0) for k in ('Acq', 'Save', 'Plot'))
+            n, Total = self.FunctTimes.get(Record['Funct'], (0, 0))
+            self.FunctTimes[Record['Funct']] = (n + 1, Total + Time)
+
+    def GetMeanTimes(self):
+        # {Funct: mean time} of the completed steps
+        return {f: Total / n for f, (n, Total) in self.FunctTimes.items()}
+
+    def Close(self):
+        for Index in sorted(self.Steps):
+            self.EndStep(Index, Complete=False)
+        self.Write({'Event': 'End',
+                    'Wall': time.perf_counter() - self.StartTime,
+                    'nSteps': self.nWritten})
+        if self.File is not None:
+            self.File.close()
+            self.File = None
+
+
+def LoadTelemetry(FileName):
+    with open(FileName, 'r') as f:
+        return [json.loads(l) for l in f if l.strip()]
+
+
+def SummarizeTelemetry(Records, nSlowest=5):
+    '''
+    Lines with the time of each step type by stage, the slowest steps and
+    the DAQ callback statistics. Records of several (resumed) runs are
+    summed.
+    '''
+    Steps = [r for r in Records if r.get('Event') == 'Step']
+    Wall = sum(r['Wall'] for r in Records if r.get('Event') == 'End')
+    if len(Steps) == 0:
+        return ['No steps']
+
+    Lines = ['Steps {}, incomplete {}, wall {:.1f} s'.format(len(Steps),
+                                                            sum(not r['Complete'] for r in Steps),
+                                                            Wall)]
+    Lines.append('{:>10} {:>6}'.format('Step', 'n') +
+                 ''.join('{:>13}'.format(k + ' [s]') for k in StepTimes) +
+                 '{:>8}'.format('% wall'))
+    Total = {}
+    for Funct in sorted(set(r['Funct'] for r in Steps)):
+        fSteps = [r for r in Steps if r['Funct'] == Funct]
+        Times = [sum(r.get(k, 0) for r in fSteps) for k in StepTimes]
+        Busy = sum(t for k, t in zip(StepTimes, Times)
+                   if k not in ('Settle', 'Queue'))
+        for k, t in zip(StepTimes, Times):
+            Total[k] = Total.get(k, 0) + t
+        Lines.append('{:>10} {:>6}'.format(Funct, len(fSteps)) +
+                     ''.join('{:>13.2f}'.format(t) for t in Times) +
+                     '{:>8.1f}'.format(100 * Busy / Wall if Wall else np.nan))
+    Lines.append('{:>10} {:>6}'.format('Total', len(Steps)) +
+                 ''.join('{:>13.2f}'.format(Total[k]) for k in StepTimes))
+
+    DCSteps = [r for r in Steps if 'EndBy' in r]
+    if len(DCSteps):
+        Ends = {}
+        for r in DCSteps:
+            Ends[r['EndBy']] = Ends.get(r['EndBy'], 0) + 1
+        Lines.append('DC steps end by: ' +
+                     ', '.join('{} {}'.format(k, v) for k, v in sorted(Ends.items())))
+        Lines.append('DC blocks until end: mean {:.1f}, max {}'.format(np.mean([r['nBlocks'] for r in DCSteps]),
+                                                                        max(r['nBlocks'] for r in DCSteps)))
+
+    Cbs = [r['Callbacks'] for r in Steps if r.get('Callbacks')]
+    if len(Cbs):
+        Jitter = [c['Jitter'] for c in Cbs if 'Jitter' in c]
+        Lines.append('Callbacks {}, mean latency {:.1f} ms, max latency {:.1f} ms, mean jitter {:.2f} ms'.format(sum(c['n'] for c in Cbs),
+                                                                                                              1e3 * np.mean([c['Latency'] for c in Cbs]),
+                                                                                                              1e3 * max(c['MaxLatency'] for c in Cbs),
+                                                                                                              1e3 * np.mean(Jitter) if len(Jitter) else np.nan))
+
+    Lines.append('Slowest steps:')
+    Slow = sorted(Steps, key=lambda r: r.get('Acq', 0) + r.get('Save', 0) + r.get('Plot', 0),
+                  reverse=True)
+    for r in Slow[:nSlowest]:
+        Lines.append('  {} {} -- '.format(r['Index'], r['Info']) +
+                     ', '.join('{} {:.2f} s'.format(k, r[k]) for k in StepTimes if k in r))
+    return Lines
@@ -34,6 +34,7 @@ install_requires = [
 					]
 
 console_scripts = ['GFETCharact = GFETCharact.MainGUI:main',
+                   'gfetcharact = GFETCharact.CharactCLI:main',
                    ]
 
 entry_points = {'console_scripts': console_scripts, }